@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+"""
+Startup time benchmark
+
+Measures how long `sheets2contacts.py --help` takes, compared to starting a
+bare interpreter, and checks which heavy modules it imports. Heavy modules
+are only meant to be imported once a sync actually needs them.
+
+Exits with status 1 if the median time is over budget, or if any heavy
+module was imported.
+
+Example:
+    ./bench_startup.py --runs 20 --budget-ms 100
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Modules that are slow to import, and should not be needed for --help
+HEAVY_MODULES = [
+    "gdata",
+    "atom",
+    "apiclient",
+    "googleapiclient",
+    "oauth2client",
+    "httplib2",
+]
+
+# Runs --help, then reports which heavy modules were imported
+CHILD_SCRIPT = """
+import sys, json
+sys.path.insert(0, %r)
+sys.argv = ["sheets2contacts.py", "--help"]
+import sheets2contacts
+try:
+    sheets2contacts.sheets2contacts().main()
+except SystemExit:
+    pass
+heavy = sorted(set(m.split('.')[0] for m in sys.modules if m.split('.')[0] in %r))
+sys.stderr.write(json.dumps(heavy))
+"""
+
+#-------------------------------------------------------------------------------
+def time_command(cmd, runs):
+    """
+    Run a command several times
+    Returns the run times in milliseconds
+    """
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for i in range(runs):
+            t_start = time.time()
+            subprocess.check_call(cmd, stdout=devnull, cwd=REPO_DIR)
+            times.append((time.time() - t_start) * 1000)
+    return(times)
+
+def median(l):
+    l = sorted(l)
+    return(l[len(l) // 2])
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Measure the startup time of sheets2contacts.py")
+    parser.add_argument('--runs', default=10, type=int,
+                        help='Number of times to run each command (default: %(default)s)')
+    parser.add_argument('--budget-ms', dest='budget_ms', default=100, type=float,
+                        help='Maximum median time of --help, in milliseconds (default: %(default)s)')
+    options = parser.parse_args()
+    
+    python = sys.executable
+    script = os.path.join(REPO_DIR, "sheets2contacts.py")
+    
+    baseline = time_command([python, "-c", "pass"], options.runs)
+    help_times = time_command([python, script, "--help"], options.runs)
+    
+    p = subprocess.Popen(
+        [python, "-c", CHILD_SCRIPT % (REPO_DIR, HEAVY_MODULES)],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=REPO_DIR
+    )
+    out, err = p.communicate()
+    heavy = json.loads(err.decode("utf-8").strip().splitlines()[-1])
+    
+    print("%-24s %8s %8s" % ("", "median", "min"))
+    print("%-24s %6.1fms %6.1fms" % ("interpreter", median(baseline), min(baseline)))
+    print("%-24s %6.1fms %6.1fms" % ("sheets2contacts --help", median(help_times), min(help_times)))
+    print("heavy modules imported: %s" % (", ".join(heavy) or "none"))
+    
+    ok = True
+    if(median(help_times) > options.budget_ms):
+        print("FAIL: --help took longer than %.0fms" % options.budget_ms)
+        ok = False
+    if(heavy):
+        print("FAIL: --help imported heavy modules")
+        ok = False
+    if(not ok):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
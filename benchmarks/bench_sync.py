@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+"""
+End-to-end sync benchmark against the local API stand-in (fake_google.py)
+
+For each roster size, a fake server is started with a synthetic sheet and
+address book, and sheets2contacts is run against it in a separate process.
+Each run reports the wall time, API request count and peak memory of every
+phase of the sync. The peak memory of a phase is its own high-water mark,
+where the kernel supports resetting it. The total is the peak of the whole
+run.
+
+Scenarios:
+    initial - None of the people exist as contacts yet
+    steady  - All people exist, 1% of them are out of date and a few extra
+              contacts need to be deleted
+
+Example:
+    ./bench_sync.py --sizes 1000 10000 --latency 0.02
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import resource
+import subprocess
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# Functions that are timed as phases of the sync, in the order they run
+# The sheet is fetched at the same time as the groups, so the request counts
+# and peak memory of those two phases include each other's
+PHASES = [
+    ("sheet",   "py_modules.google_sheets",   "Sheets",   "fetch_column_data"),
+    ("groups",  "py_modules.google_contacts", "Contacts", "fetch_groups"),
+    ("elaborate", "py_modules.contact_source", "ContactSource", "elaborate_column_data"),
+    ("reconcile", "sheets2contacts",          None,       "reconcile"),
+    ("create_groups", "py_modules.google_contacts", "Contacts", "batch_create_groups"),
+    ("batch",   "py_modules.google_contacts", "Contacts", "batch_contacts_job"),
+]
+
+#===============================================================================
+# Child: runs one sync
+#===============================================================================
+def get_server_stats(api_root):
+    import urllib2
+    return(json.load(urllib2.urlopen(api_root + "/_stats")))
+
+def count_requests(stats):
+    return(sum(s["requests"] for k, s in stats.items() if not k.startswith("_")))
+
+def peak_rss_mb():
+    """
+    Peak memory of the whole process so far
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+def reset_phase_peak():
+    """
+    Reset the peak returned by phase_peak_rss_mb() to the current memory use
+    Returns False if that is not supported, as on kernels without
+    /proc/self/clear_refs
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return(True)
+    except (IOError, OSError):
+        return(False)
+
+def phase_peak_rss_mb():
+    """
+    Peak memory since the last reset_phase_peak(), from VmHWM
+    """
+    with open("/proc/self/status") as f:
+        for line in f:
+            if(line.startswith("VmHWM:")):
+                return(int(line.split()[1]) / 1024.0)
+    return(None)
+
+#-------------------------------------------------------------------------------
+def run_child(params):
+    sys.path.insert(0, REPO_DIR)
+    import importlib
+    from oauth2client.client import AccessTokenCredentials
+    from py_modules import cache
+    import sheets2contacts as s2c
+    
+    cache.CACHE_DIR = params["cache_dir"]
+    api_root = params["api_root"]
+    results = []
+    
+    def timed(name, func):
+        def wrapper(*args, **kwargs):
+            n_requests = count_requests(get_server_stats(api_root))
+            per_phase = reset_phase_peak()
+            t_start = time.time()
+            try:
+                return(func(*args, **kwargs))
+            finally:
+                results.append({
+                    "phase": name,
+                    "seconds": time.time() - t_start,
+                    "requests": count_requests(get_server_stats(api_root)) - n_requests,
+                    # Without a per-phase peak, fall back on the peak so far
+                    "peak_rss_mb": phase_peak_rss_mb() if per_phase else peak_rss_mb(),
+                })
+        return(wrapper)
+    
+    for name, module_name, class_name, func_name in PHASES:
+        module = importlib.import_module(module_name)
+        owner = getattr(module, class_name) if class_name else module
+        setattr(owner, func_name, timed(name, getattr(owner, func_name)))
+    
+    class BenchApp(s2c.sheets2contacts):
+        def get_credentials(self):
+            return(AccessTokenCredentials("bench-token", "sheets2contacts-bench"))
+    
+    sys.argv = [
+        "sheets2contacts",
+        "--quiet",
+        "--sheet", "bench-sheet",
+        "--email", "bench@example.com",
+        "--api-root", api_root,
+        "--force",
+    ] + params["args"]
+    
+    t_start = time.time()
+    BenchApp().main()
+    stats = get_server_stats(api_root)
+    total = {
+        "phase": "total",
+        "seconds": time.time() - t_start,
+        "requests": count_requests(stats),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    json.dump({"phases": results, "total": total, "connections": stats["_connections"]}, sys.stdout)
+
+#===============================================================================
+# Parent: starts servers and runs children
+#===============================================================================
+def start_server(server_args):
+    p = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_google.py")] + server_args,
+        stdout=subprocess.PIPE
+    )
+    line = p.stdout.readline().decode("utf-8").strip()
+    if(not line.startswith("READY ")):
+        p.kill()
+        raise RuntimeError("Fake server failed to start: %r" % line)
+    return(p, line.split(" ", 1)[1])
+
+#-------------------------------------------------------------------------------
+def run_scenario(options, n_people, scenario):
+    server_args = [
+        "--people", str(n_people),
+        "--group-columns", str(options.group_columns),
+        "--latency", str(options.latency),
+    ]
+    if(scenario == "steady"):
+        server_args.extend([
+            "--existing", str(n_people),
+            "--stale", str(max(1, n_people // 100)),
+            "--extra", str(max(1, n_people // 1000)),
+        ])
+    
+    server, api_root = start_server(server_args)
+    cache_dir = tempfile.mkdtemp(prefix="s2c-bench-")
+    try:
+        params = {
+            "api_root": api_root,
+            "cache_dir": cache_dir,
+            "args": options.sync_args,
+        }
+        out = subprocess.check_output(
+            [sys.executable, os.path.abspath(__file__), "--child", json.dumps(params)],
+            cwd=REPO_DIR
+        )
+        return(json.loads(out.decode("utf-8")))
+    finally:
+        server.kill()
+        server.wait()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+#-------------------------------------------------------------------------------
+def print_report(n_people, scenario, report):
+    print("")
+    print("%d people, %s" % (n_people, scenario))
+    print("  %-14s %10s %10s %12s" % ("phase", "seconds", "requests", "peak RSS MB"))
+    for row in report["phases"] + [report["total"]]:
+        print("  %-14s %10.3f %10d %12.1f" % (
+            row["phase"], row["seconds"], row["requests"], row["peak_rss_mb"]
+        ))
+    print("  %d connections" % report["connections"])
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a full sync against a local API stand-in")
+    parser.add_argument('--sizes', default=[1000, 10000, 100000], type=int, nargs='+',
+                        help='Numbers of people to benchmark (default: %(default)s)')
+    parser.add_argument('--scenarios', default=["initial", "steady"], nargs='+',
+                        choices=["initial", "steady"])
+    parser.add_argument('--group-columns', dest='group_columns', default=5, type=int)
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='Seconds of latency the fake server adds to each request')
+    parser.add_argument('--json', dest='json_path', default=None,
+                        help='Also write the results to this file')
+    parser.add_argument('--child', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('sync_args', nargs=argparse.REMAINDER,
+                        help='Extra arguments passed to sheets2contacts, after "--"')
+    options = parser.parse_args()
+    
+    if(options.child):
+        run_child(json.loads(options.child))
+        return
+    
+    options.sync_args = [a for a in options.sync_args if a != "--"]
+    all_results = []
+    for n_people in options.sizes:
+        for scenario in options.scenarios:
+            report = run_scenario(options, n_people, scenario)
+            print_report(n_people, scenario, report)
+            all_results.append({"people": n_people, "scenario": scenario, "report": report})
+    
+    if(options.json_path):
+        with open(options.json_path, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
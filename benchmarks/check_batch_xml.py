@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+"""
+Checks the contacts batch feed writer against gdata
+
+Contacts._batch_feed_xml() writes batch request feeds directly, instead of
+building them from gdata entries. This writes a batch of sample creates,
+updates and deletes both ways, and checks that they are the same XML. gdata
+picks its own namespace prefixes, so the feeds are compared element by
+element rather than byte by byte. Deleted entries are only written with
+their ID and etag, so only those are compared.
+
+Exits with status 1 if any entry differs.
+
+Example:
+    ./check_batch_xml.py --verbose
+"""
+
+import os
+import sys
+import logging
+import argparse
+from xml.etree import cElementTree as ElementTree
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+GD_NS = '{http://schemas.google.com/g/2005}'
+BATCH_NS = '{http://schemas.google.com/gdata/batch}'
+
+CONTACTS_URL = "https://www.google.com/m8/feeds/contacts/default/full"
+
+# An existing contact, with fields and namespaces sheets2contacts does not
+# manage
+EXISTING_ENTRY = """<entry xmlns='http://www.w3.org/2005/Atom'
+    xmlns:gd='http://schemas.google.com/g/2005'
+    xmlns:gContact='http://schemas.google.com/contact/2008'
+    xmlns:app='http://www.w3.org/2007/app'
+    xmlns:other='urn:other' gd:etag='"Rn0.123"'>
+  <id>http://www.google.com/m8/feeds/contacts/default/base/1c</id>
+  <updated>2020-01-01T00:00:00.000Z</updated>
+  <app:edited>2020-01-01T00:00:00.000Z</app:edited>
+  <category scheme='http://schemas.google.com/g/2005#kind' term='http://schemas.google.com/contact/2008#contact'/>
+  <title>Ann Old &amp; Co</title>
+  <link rel='edit' type='application/atom+xml' href='https://www.google.com/m8/feeds/contacts/default/full/1c'/>
+  <gd:name><gd:givenName>Ann</gd:givenName><gd:familyName>Old &amp; Co</gd:familyName></gd:name>
+  <gd:organization rel='http://schemas.google.com/g/2005#work'><gd:orgName>Acme \xc3\xa9</gd:orgName></gd:organization>
+  <gContact:website href='http://example.com/?x=1&amp;y=2' rel='home'/>
+  <other:note>Kept</other:note>
+  <gd:extendedProperty name='other.app' value='v&lt;'/>
+  <gd:extendedProperty name='sheets2contacts.hash' value='old'/>
+  <gContact:groupMembershipInfo deleted='false' href='http://www.google.com/m8/feeds/groups/default/base/1'/>
+</entry>"""
+
+#-------------------------------------------------------------------------------
+def sample_batch():
+    """
+    A batch of creates, updates and deletes covering the fields that are
+    written, escaping and non-ASCII text
+    Returns a new list of (operation, Person) each time, as writing a batch
+    modifies the entries of updated contacts
+    """
+    import atom.core
+    import atom.data
+    import gdata.contacts.data
+    from py_modules import contact_defs as cd
+    
+    def group(name, id):
+        G = cd.Group(name)
+        G.entry = gdata.contacts.data.GroupEntry(id=atom.data.Id(text=id))
+        return(G)
+    friends = group("Friends", "http://www.google.com/m8/feeds/groups/default/base/12")
+    quoted = group(u"B\xe4nd", 'http://www.google.com/m8/feeds/groups/default/base/13?a=1&b="2"')
+    
+    def existing():
+        P = cd.Person()
+        P.entry = atom.core.parse(EXISTING_ENTRY, gdata.contacts.data.ContactEntry)
+        P.entry_id = P.entry.id.text
+        P.etag = P.entry.etag
+        return(P)
+    
+    full = cd.Person()
+    full.first_name = u"J\xf6rg \u4e2d"
+    full.last_name = 'O\'Neil & "Co" <x>'
+    full.nickname = "JJ"
+    full.email = "jorg@example.com"
+    full.phone = "+1 (555) 0100"
+    full.groups = [friends, quoted]
+    full.sync_hash = "abc"
+    
+    bare = cd.Person()
+    bare.first_name = "Bare"
+    
+    updated = existing()
+    updated.email = "ann@example.com"
+    updated.phone = "1"
+    updated.nickname = u"n\xe9"
+    updated.groups = [friends]
+    updated.groups_changed = True
+    updated.sync_hash = "new"
+    
+    unhashed = existing()
+    unhashed.sync_hash = None
+    
+    return([
+        ("create", full),
+        ("create", bare),
+        ("update", updated),
+        ("update", unhashed),
+        ("delete", existing()),
+    ])
+
+#-------------------------------------------------------------------------------
+def make_contacts():
+    """
+    A Contacts object that only writes feeds, without credentials
+    """
+    from py_modules import google_contacts
+    google_contacts.import_gdata()
+    
+    class FeedWriter(google_contacts.Contacts):
+        def __init__(self):
+            self.contacts_client = google_contacts.gdata.contacts.client.ContactsClient()
+            self.contacts_url = CONTACTS_URL
+            self.log = logging.getLogger("contacts")
+    return(FeedWriter())
+
+def gdata_feed_xml(C, request_batch):
+    """
+    Write a batch request feed the way sheets2contacts did before
+    _batch_feed_xml(): built from gdata entries, with the generated prefix
+    of the gd namespace renamed, as Google requires
+    """
+    import gdata.client
+    import gdata.contacts.data
+    feed = gdata.contacts.data.ContactsFeed()
+    for i, (req_type, P) in enumerate(request_batch):
+        if(req_type == "create"):
+            feed.AddInsert(entry=C._create_ContactEntry(P), batch_id_string=str(i))
+        elif(req_type == "update"):
+            C._update_ContactEntry(P)
+            feed.AddUpdate(entry=P.entry, batch_id_string=str(i))
+        elif(req_type == "delete"):
+            feed.AddDelete(entry=P.entry, batch_id_string=str(i))
+    version = gdata.client.get_xml_version(C.contacts_client.api_version)
+    return(feed.to_string(version).replace('ns1', 'gd'))
+
+#-------------------------------------------------------------------------------
+def canonical(elem):
+    """
+    Comparable form of an element. Whitespace around text is ignored, as is
+    the order of attributes and children
+    """
+    return((
+        elem.tag,
+        tuple(sorted(elem.items())),
+        (elem.text or "").strip() or None,
+        tuple(sorted(canonical(child) for child in elem))
+    ))
+
+def compare_entries(old, new):
+    """
+    Returns True if the batch entries old and new are equivalent
+    """
+    if(old.find(BATCH_NS + 'operation').get('type') == "delete"):
+        return(
+            (old.get(GD_NS + 'etag') == new.get(GD_NS + 'etag')) and
+            (old.findtext(ATOM_NS + 'id') == new.findtext(ATOM_NS + 'id')) and
+            (old.findtext(BATCH_NS + 'id') == new.findtext(BATCH_NS + 'id'))
+        )
+    return(canonical(old) == canonical(new))
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Check the contacts batch feed writer against gdata")
+    parser.add_argument('-v', '--verbose', default=False, action="store_true",
+                        help='Print both feeds')
+    options = parser.parse_args()
+    
+    sys.path.insert(0, REPO_DIR)
+    C = make_contacts()
+    old_xml = gdata_feed_xml(C, sample_batch())
+    new_xml = C._batch_feed_xml(sample_batch())
+    if(options.verbose):
+        print("gdata:\n%s\n\n_batch_feed_xml():\n%s\n" % (old_xml, new_xml))
+    
+    old_entries = ElementTree.fromstring(old_xml).findall(ATOM_NS + 'entry')
+    new_entries = ElementTree.fromstring(new_xml).findall(ATOM_NS + 'entry')
+    if(len(old_entries) != len(new_entries)):
+        print("Different number of entries: %d, %d" % (len(old_entries), len(new_entries)))
+        sys.exit(1)
+    
+    n_different = 0
+    for old, new in zip(old_entries, new_entries):
+        op = old.find(BATCH_NS + 'operation').get('type')
+        batch_id = old.findtext(BATCH_NS + 'id')
+        if(compare_entries(old, new)):
+            print("  %s %-6s same" % (batch_id, op))
+        else:
+            n_different += 1
+            print("  %s %-6s DIFFERENT" % (batch_id, op))
+            print("    gdata: %r" % (canonical(old),))
+            print("    new:   %r" % (canonical(new),))
+    
+    if(n_different):
+        print("%d of %d entries differ" % (n_different, len(old_entries)))
+        sys.exit(1)
+    print("All %d entries are the same" % len(old_entries))
+
+if __name__ == '__main__':
+    main()
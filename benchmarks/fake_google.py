@@ -0,0 +1,863 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Google APIs used by sheets2contacts.
+
+Serves:
+    - Sheets v4 discovery document, values.get and values.batchGet
+    - Contacts m8 contacts and groups feeds, including paging, total_results,
+      updated-min/showdeleted queries, single entry GETs and batch requests,
+      including batch queries
+
+The spreadsheet and the initial address book are generated synthetically.
+Latency, error rates and a simple requests-per-second quota can be
+configured to approximate the real services.
+
+Statistics are available as JSON from /_stats. These requests are not counted.
+The number of client connections that made API requests is reported as
+"_connections".
+
+Example:
+    ./fake_google.py --people 10000 --group-columns 10 --latency 0.05
+"""
+
+import sys
+import time
+import json
+import random
+import urllib
+import urlparse
+import argparse
+import threading
+import SocketServer
+import BaseHTTPServer
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape, quoteattr
+
+ATOM_NS = 'http://www.w3.org/2005/Atom'
+GD_NS = 'http://schemas.google.com/g/2005'
+GCONTACT_NS = 'http://schemas.google.com/contact/2008'
+BATCH_NS = 'http://schemas.google.com/gdata/batch'
+OPENSEARCH_NS = 'http://a9.com/-/spec/opensearch/1.1/'
+
+FEED_NAMESPACES = (
+    "xmlns='%s' xmlns:gd='%s' xmlns:gContact='%s' xmlns:batch='%s' xmlns:openSearch='%s'"
+    % (ATOM_NS, GD_NS, GCONTACT_NS, BATCH_NS, OPENSEARCH_NS)
+)
+
+SYNC_GROUP_NAME = "Synced with sheets2contacts"
+
+#===============================================================================
+# Synthetic data
+#===============================================================================
+class SheetData:
+    """
+    A synthetic roster spreadsheet with a "sheets2contacts" mapping tab
+    """
+    def __init__(self, n_people, n_groups, n_group_columns, seed=0):
+        rnd = random.Random(seed)
+        self.group_names = ["Group %d" % i for i in range(n_groups)]
+        self.group_columns = ["Column group %d" % i for i in range(n_group_columns)]
+        
+        headings = ["First", "Last", "Nickname", "Email", "Phone", "Groups"]
+        headings.extend(self.group_columns)
+        rows = [headings]
+        for i in range(n_people):
+            row = [
+                "First%d" % i,
+                "Last%d" % i,
+                "Nick%d" % i if (i % 4 == 0) else "",
+                "person%d@example.com" % i,
+                "555-%04d" % (i % 10000),
+                ", ".join(rnd.sample(self.group_names, min(2, n_groups))),
+            ]
+            for gc in self.group_columns:
+                row.append(rnd.choice(["1", "0", "", "yes"]))
+            rows.append(row)
+        
+        mapping = [
+            ["key", "value"],
+            ["sheet", "Roster"],
+            ["first_name", "First"],
+            ["last_name", "Last"],
+            ["nickname", "Nickname"],
+            ["email", "Email"],
+            ["phone", "Phone"],
+            ["groups", "Groups"],
+            ["group_columns", ", ".join(self.group_columns)],
+        ]
+        
+        self.tabs = {
+            "Roster": rows,
+            "sheets2contacts": mapping,
+        }
+        self.rnd = rnd
+    
+    def mutate(self, fraction):
+        """
+        Change the email address of a fraction of the people in the sheet
+        """
+        rows = self.tabs["Roster"]
+        n = int((len(rows) - 1) * fraction)
+        for i in self.rnd.sample(range(1, len(rows)), n):
+            rows[i][3] = "changed%d.%d@example.com" % (i, self.rnd.randint(0, 1 << 30))
+        return(n)
+    
+    def get_range(self, a1_range, major_dimension="ROWS"):
+        """
+        Get the values of an A1 range such as "Roster!C2:C" or "Roster!1:1"
+        """
+        if("!" in a1_range):
+            tab, cells = a1_range.split("!", 1)
+        else:
+            tab, cells = "Roster", a1_range
+        rows = self.tabs.get(tab.strip("'"), [])
+        
+        if(":" in cells):
+            start, end = cells.split(":", 1)
+        else:
+            start, end = cells, cells
+        c0, r0 = parse_a1_cell(start)
+        c1, r1 = parse_a1_cell(end)
+        
+        r0 = 0 if r0 is None else r0
+        r1 = len(rows) - 1 if r1 is None else r1
+        values = []
+        for row in rows[r0:r1 + 1]:
+            cc0 = 0 if c0 is None else c0
+            cc1 = len(row) - 1 if c1 is None else c1
+            values.append(list(row[cc0:cc1 + 1]))
+        
+        if(major_dimension == "COLUMNS"):
+            n_cols = max([len(r) for r in values] + [0])
+            columns = []
+            for i in range(n_cols):
+                columns.append([r[i] if i < len(r) else "" for r in values])
+            values = columns
+        
+        # Like the real API, trailing empty cells and lines are omitted
+        values = [trim_empty(v) for v in values]
+        while(len(values) and (len(values[-1]) == 0)):
+            values.pop()
+        return(values)
+
+def parse_a1_cell(s):
+    """
+    Parse "C2" into (2, 1), "C" into (2, None) and "2" into (None, 1)
+    Indexes are 0-based
+    """
+    col = None
+    row = None
+    letters = "".join(c for c in s if c.isalpha()).upper()
+    digits = "".join(c for c in s if c.isdigit())
+    if(letters):
+        col = 0
+        for c in letters:
+            col = col * 26 + (ord(c) - ord('A') + 1)
+        col -= 1
+    if(digits):
+        row = int(digits) - 1
+    return(col, row)
+
+def trim_empty(cells):
+    cells = list(cells)
+    while(len(cells) and (cells[-1] == "")):
+        cells.pop()
+    return(cells)
+
+#===============================================================================
+class AddressBook:
+    """
+    Synthetic Google Contacts account
+    """
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.lock = threading.Lock()
+        self.contacts = {}
+        self.groups = {}
+        self.next_id = 1
+        self.last_updated = 0.0
+        
+        self.add_group("System Group: My Contacts", system=True)
+    
+    def timestamp(self):
+        """
+        Get a unique, increasing modification time
+        """
+        t = max(time.time(), self.last_updated + 0.001)
+        self.last_updated = t
+        return(t)
+    
+    def new_id(self):
+        i = "%x" % self.next_id
+        self.next_id += 1
+        return(i)
+    
+    def add_group(self, name, system=False):
+        gid = self.new_id()
+        group = {
+            "id": "%s/m8/feeds/groups/default/base/%s" % (self.base_url, gid),
+            "short_id": gid,
+            "title": name,
+            "system": system,
+            "updated": self.timestamp(),
+            "etag": '"g%s"' % gid,
+        }
+        self.groups[gid] = group
+        return(group)
+    
+    def add_contact(self, fields):
+        cid = self.new_id()
+        contact = dict(fields)
+        contact["short_id"] = cid
+        contact["id"] = "%s/m8/feeds/contacts/default/base/%s" % (self.base_url, cid)
+        self.touch(contact)
+        self.contacts[cid] = contact
+        return(contact)
+    
+    def touch(self, contact):
+        contact["updated"] = self.timestamp()
+        contact["etag"] = '"%s.%d"' % (contact["short_id"], int(contact["updated"] * 1000))
+    
+    def populate(self, sheet, n_existing, n_stale, n_extra):
+        """
+        Pre-populate the account as if the sheet was synced before.
+        The first n_existing people of the sheet exist as contacts, n_stale
+        of which have an outdated email. n_extra contacts are not in the sheet.
+        """
+        sync_group = self.add_group(SYNC_GROUP_NAME)
+        my_contacts = self.find_group("System Group: My Contacts")
+        by_name = {}
+        for name in sheet.group_names + sheet.group_columns:
+            by_name[name] = self.add_group(name)
+        
+        rows = sheet.tabs["Roster"][1:]
+        for i, row in enumerate(rows[:n_existing]):
+            hrefs = [my_contacts["id"], sync_group["id"]]
+            for name in row[5].split(","):
+                if(name.strip()):
+                    hrefs.append(by_name[name.strip()]["id"])
+            for j, gc in enumerate(sheet.group_columns):
+                if(row[6 + j] in ["1", "yes"]):
+                    hrefs.append(by_name[gc]["id"])
+            self.add_contact({
+                "first_name": row[0],
+                "last_name": row[1],
+                "nickname": row[2] or None,
+                "email": row[3] if (i >= n_stale) else "stale%d@example.com" % i,
+                "phone": row[4],
+                "groups": hrefs,
+                "properties": {},
+            })
+        for i in range(n_extra):
+            self.add_contact({
+                "first_name": "Extra%d" % i,
+                "last_name": "Person",
+                "nickname": None,
+                "email": "extra%d@example.com" % i,
+                "phone": None,
+                "groups": [my_contacts["id"], sync_group["id"]],
+                "properties": {},
+            })
+    
+    def find_group(self, name):
+        for group in self.groups.values():
+            if(group["title"] == name):
+                return(group)
+        return(None)
+
+#===============================================================================
+# Atom serialization
+#===============================================================================
+def format_time(t):
+    return(time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(t)) + ".%03dZ" % (int(t * 1000) % 1000))
+
+def parse_time(s):
+    """
+    Parse a timestamp produced by format_time()
+    """
+    s = s.rstrip("Z")
+    if("." in s):
+        s, ms = s.split(".", 1)
+    else:
+        ms = "0"
+    t = time.mktime(time.strptime(s, "%Y-%m-%dT%H:%M:%S")) - time.timezone
+    return(t + int(ms[:3].ljust(3, "0")) / 1000.0)
+
+def contact_xml(book, c, extra="", projection="full"):
+    """
+    projection is "full", "thin" (no extended properties) or "property-KEY"
+    (only the extended property named KEY)
+    """
+    if(c.get("deleted")):
+        return(
+            "<entry gd:etag=%s><id>%s</id><updated>%s</updated><gd:deleted/>%s</entry>" % (
+                quoteattr(c["etag"]), escape(c["id"]), format_time(c["updated"]), extra
+            )
+        )
+    href = "%s/m8/feeds/contacts/default/full/%s" % (book.base_url, c["short_id"])
+    parts = [
+        "<entry gd:etag=%s>" % quoteattr(c["etag"]),
+        "<id>%s</id>" % escape(c["id"]),
+        "<updated>%s</updated>" % format_time(c["updated"]),
+        "<category scheme='http://schemas.google.com/g/2005#kind' term='http://schemas.google.com/contact/2008#contact'/>",
+        "<title>%s</title>" % escape(" ".join(x for x in [c["first_name"], c["last_name"]] if x)),
+        "<link rel='self' type='application/atom+xml' href=%s/>" % quoteattr(href),
+        "<link rel='edit' type='application/atom+xml' href=%s/>" % quoteattr(href),
+        "<gd:name>",
+    ]
+    if(c["first_name"]):
+        parts.append("<gd:givenName>%s</gd:givenName>" % escape(c["first_name"]))
+    if(c["last_name"]):
+        parts.append("<gd:familyName>%s</gd:familyName>" % escape(c["last_name"]))
+    parts.append("</gd:name>")
+    if(c["nickname"]):
+        parts.append("<gContact:nickname>%s</gContact:nickname>" % escape(c["nickname"]))
+    if(c["email"]):
+        parts.append(
+            "<gd:email rel='http://schemas.google.com/g/2005#work' address=%s primary='true'/>"
+            % quoteattr(c["email"])
+        )
+    if(c["phone"]):
+        parts.append(
+            "<gd:phoneNumber rel='http://schemas.google.com/g/2005#work' primary='true'>%s</gd:phoneNumber>"
+            % escape(c["phone"])
+        )
+    for href in c["groups"]:
+        parts.append("<gContact:groupMembershipInfo deleted='false' href=%s/>" % quoteattr(href))
+    for name, value in sorted(c["properties"].items()):
+        if((projection == "thin") or
+           (projection.startswith("property-") and (name != projection[9:]))):
+            continue
+        parts.append("<gd:extendedProperty name=%s value=%s/>" % (quoteattr(name), quoteattr(value)))
+    parts.append(extra)
+    parts.append("</entry>")
+    return("".join(parts))
+
+def group_xml(book, g, extra=""):
+    href = "%s/m8/feeds/groups/default/full/%s" % (book.base_url, g["short_id"])
+    parts = [
+        "<entry gd:etag=%s>" % quoteattr(g["etag"]),
+        "<id>%s</id>" % escape(g["id"]),
+        "<updated>%s</updated>" % format_time(g["updated"]),
+        "<category scheme='http://schemas.google.com/g/2005#kind' term='http://schemas.google.com/contact/2008#group'/>",
+        "<title>%s</title>" % escape(g["title"]),
+        "<link rel='self' type='application/atom+xml' href=%s/>" % quoteattr(href),
+        "<link rel='edit' type='application/atom+xml' href=%s/>" % quoteattr(href),
+    ]
+    if(g["system"]):
+        parts.append("<gContact:systemGroup id='Contacts'/>")
+    parts.append(extra)
+    parts.append("</entry>")
+    return("".join(parts))
+
+def feed_xml(book, feed_url, title, entries_xml, total, start_index, page_size, updated):
+    parts = [
+        "<?xml version='1.0' encoding='UTF-8'?>",
+        "<feed %s>" % FEED_NAMESPACES,
+        "<id>%s</id>" % escape(feed_url),
+        "<updated>%s</updated>" % format_time(updated),
+        "<title>%s</title>" % escape(title),
+        "<openSearch:totalResults>%d</openSearch:totalResults>" % total,
+        "<openSearch:startIndex>%d</openSearch:startIndex>" % start_index,
+        "<openSearch:itemsPerPage>%d</openSearch:itemsPerPage>" % page_size,
+    ]
+    if(start_index - 1 + page_size < total):
+        next_url = "%s?start-index=%d&max-results=%d" % (feed_url, start_index + page_size, page_size)
+        parts.append("<link rel='next' type='application/atom+xml' href=%s/>" % quoteattr(next_url))
+    parts.extend(entries_xml)
+    parts.append("</feed>")
+    return("".join(parts))
+
+def batch_result(batch_id, op, code, reason):
+    return(
+        "<batch:id>%s</batch:id><batch:operation type='%s'/><batch:status code='%d' reason=%s/>"
+        % (escape(batch_id), op, code, quoteattr(reason))
+    )
+
+#===============================================================================
+# Server
+#===============================================================================
+class FakeGoogleServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    
+    def __init__(self, address, sheet, options):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeGoogleHandler)
+        self.base_url = "http://%s:%d" % (address[0], self.server_address[1])
+        self.sheet = sheet
+        self.book = AddressBook(self.base_url)
+        self.options = options
+        self.rnd = random.Random(options.seed)
+        
+        self.stats_lock = threading.Lock()
+        self.stats = {}
+        self.quota_window = []
+        self.connections = 0
+    
+    def count_connection(self):
+        with self.stats_lock:
+            self.connections += 1
+    
+    def count(self, kind, bytes_in, bytes_out, status):
+        with self.stats_lock:
+            s = self.stats.setdefault(kind, {
+                "requests": 0, "bytes_in": 0, "bytes_out": 0, "errors": 0
+            })
+            s["requests"] += 1
+            s["bytes_in"] += bytes_in
+            s["bytes_out"] += bytes_out
+            if(status >= 400):
+                s["errors"] += 1
+    
+    def over_quota(self):
+        """
+        Returns True if the request exceeds the requests-per-second quota
+        """
+        if(not self.options.quota_rps):
+            return(False)
+        with self.stats_lock:
+            now = time.time()
+            self.quota_window = [t for t in self.quota_window if now - t < 1.0]
+            if(len(self.quota_window) >= self.options.quota_rps):
+                return(True)
+            self.quota_window.append(now)
+            return(False)
+
+#-------------------------------------------------------------------------------
+class FakeGoogleHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        # A handler serves all requests on one connection
+        self.connection_counted = False
+    
+    def log_message(self, fmt, *args):
+        if(self.server.options.verbose):
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, fmt, *args)
+    
+    def send(self, status, body, content_type, kind, bytes_in=0, headers=None):
+        if(isinstance(body, unicode)):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        if(kind is not None):
+            self.server.count(kind, bytes_in, len(body), status)
+            if(not self.connection_counted):
+                self.server.count_connection()
+                self.connection_counted = True
+    
+    def send_json(self, obj, kind, bytes_in=0):
+        self.send(200, json.dumps(obj), "application/json; charset=UTF-8", kind, bytes_in)
+    
+    def send_atom(self, body, kind, bytes_in=0, status=200):
+        self.send(status, body, "application/atom+xml; charset=UTF-8", kind, bytes_in)
+    
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return(self.rfile.read(length))
+    
+    def simulate_network(self, kind, bytes_in=0):
+        """
+        Apply latency, quota and random errors
+        Returns True if the request was rejected
+        """
+        options = self.server.options
+        if(options.latency):
+            time.sleep(options.latency)
+        if(self.server.over_quota()):
+            self.send(429, "Rate limit exceeded", "text/plain", kind, bytes_in,
+                      {"Retry-After": "1"})
+            return(True)
+        if(options.error_rate and (self.server.rnd.random() < options.error_rate)):
+            self.send(503, "Service unavailable", "text/plain", kind, bytes_in)
+            return(True)
+        return(False)
+    
+    #---------------------------------------------------------------------------
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        query = urlparse.parse_qs(url.query)
+        path = urllib.unquote(url.path)
+        
+        if(path == "/_stats"):
+            with self.server.stats_lock:
+                stats = json.loads(json.dumps(self.server.stats))
+                stats["_connections"] = self.server.connections
+            self.send_json(stats, None)
+            return
+        
+        if(path.startswith("/sheets/$discovery/rest")):
+            self.send_json(discovery_document(self.server.base_url), "sheets.discovery")
+        elif(path.startswith("/v4/spreadsheets/")):
+            self.handle_sheets(path, query)
+        elif(path.startswith("/m8/feeds/contacts/")):
+            self.handle_contacts_get(path, query)
+        elif(path.startswith("/m8/feeds/groups/")):
+            self.handle_groups_get(path, query)
+        else:
+            self.send(404, "Not found", "text/plain", "unknown")
+    
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        path = urllib.unquote(url.path)
+        body = self.read_body()
+        
+        if(path == "/_mutate"):
+            params = json.loads(body or "{}")
+            n = self.server.sheet.mutate(params.get("fraction", 0.01))
+            self.send_json({"changed": n}, None)
+            return
+        
+        if(path == "/_rename"):
+            params = json.loads(body or "{}")
+            sheet = self.server.sheet
+            # Rename a tab, and point the mapping at its new name
+            sheet.tabs[params["to"]] = sheet.tabs.pop(params["from"])
+            for row in sheet.tabs["sheets2contacts"]:
+                if(row[0] == "sheet"):
+                    row[1] = params["to"]
+            self.send_json({}, None)
+            return
+        
+        if(path == "/m8/feeds/contacts/default/full/batch"):
+            self.handle_contacts_batch(body)
+        elif(path == "/m8/feeds/groups/default/full/batch"):
+            self.handle_groups_batch(body)
+        else:
+            self.send(404, "Not found", "text/plain", "unknown", len(body))
+    
+    #---------------------------------------------------------------------------
+    def handle_sheets(self, path, query):
+        kind = "sheets.values"
+        if(self.simulate_network(kind)):
+            return
+        sheet = self.server.sheet
+        major = query.get("majorDimension", ["ROWS"])[0]
+        
+        if(path.endswith(":batchGet")):
+            kind = "sheets.batchGet"
+            valueRanges = []
+            for r in query.get("ranges", []):
+                # Like the real API, a range in a missing tab fails the request
+                if(("!" in r) and (r.split("!", 1)[0].strip("'") not in sheet.tabs)):
+                    self.send(400, json.dumps({"error": {"code": 400,
+                        "message": "Unable to parse range: %s" % r}}),
+                        "application/json; charset=UTF-8", kind)
+                    return
+                vr = {"range": r, "majorDimension": major}
+                values = sheet.get_range(r, major)
+                if(values):
+                    vr["values"] = values
+                valueRanges.append(vr)
+            self.send_json({"spreadsheetId": path.split("/")[3], "valueRanges": valueRanges}, kind)
+        else:
+            kind = "sheets.get"
+            r = path.split("/values/", 1)[1]
+            result = {"range": r, "majorDimension": major}
+            values = sheet.get_range(r, major)
+            if(values):
+                result["values"] = values
+            self.send_json(result, kind)
+    
+    #---------------------------------------------------------------------------
+    def handle_contacts_get(self, path, query):
+        book = self.server.book
+        # /m8/feeds/contacts/default/<projection>[/<contact id>]
+        parts = path.rstrip("/").split("/")
+        projection = parts[5]
+        feed_url = "%s/m8/feeds/contacts/default/%s" % (book.base_url, projection)
+        
+        if(len(parts) > 6):
+            # Single entry
+            kind = "contacts.entry"
+            if(self.simulate_network(kind)):
+                return
+            with book.lock:
+                c = book.contacts.get(parts[-1])
+                if((c is None) or c.get("deleted")):
+                    self.send(404, "Contact not found", "text/plain", kind)
+                    return
+                body = (
+                    "<?xml version='1.0' encoding='UTF-8'?>" +
+                    contact_xml(book, c, projection=projection).replace(
+                        "<entry ", "<entry %s " % FEED_NAMESPACES, 1
+                    )
+                )
+            self.send_atom(body, kind)
+            return
+        
+        kind = "contacts.feed"
+        if(self.simulate_network(kind)):
+            return
+        start_index = int(query.get("start-index", ["1"])[0])
+        page_size = int(query.get("max-results", ["25"])[0])
+        group = query.get("group", [None])[0]
+        updated_min = query.get("updated-min", [None])[0]
+        show_deleted = (query.get("showdeleted", ["false"])[0] == "true")
+        
+        with book.lock:
+            now = book.timestamp()
+            selected = []
+            t_min = parse_time(updated_min) if updated_min else None
+            for cid in sorted(book.contacts, key=lambda x: int(x, 16)):
+                c = book.contacts[cid]
+                if(c.get("deleted") and not show_deleted):
+                    continue
+                if((t_min is not None) and (c["updated"] <= t_min)):
+                    continue
+                if(group and (c.get("deleted") or (group not in c["groups"]))):
+                    continue
+                selected.append(c)
+            page = selected[start_index - 1:start_index - 1 + page_size]
+            entries = [contact_xml(book, c, projection=projection) for c in page]
+        body = feed_xml(book, feed_url, "Contacts", entries, len(selected),
+                        start_index, page_size, now)
+        self.send_atom(body, kind)
+    
+    #---------------------------------------------------------------------------
+    def handle_groups_get(self, path, query):
+        kind = "groups.feed"
+        if(self.simulate_network(kind)):
+            return
+        book = self.server.book
+        feed_url = "%s/m8/feeds/groups/default/full" % book.base_url
+        start_index = int(query.get("start-index", ["1"])[0])
+        page_size = int(query.get("max-results", ["25"])[0])
+        updated_min = query.get("updated-min", [None])[0]
+        
+        with book.lock:
+            now = book.timestamp()
+            t_min = parse_time(updated_min) if updated_min else None
+            selected = []
+            for gid in sorted(book.groups, key=lambda x: int(x, 16)):
+                g = book.groups[gid]
+                if((t_min is not None) and (g["updated"] <= t_min)):
+                    continue
+                selected.append(g)
+            page = selected[start_index - 1:start_index - 1 + page_size]
+            entries = [group_xml(book, g) for g in page]
+        body = feed_xml(book, feed_url, "Groups", entries, len(selected),
+                        start_index, page_size, now)
+        self.send_atom(body, kind)
+    
+    #---------------------------------------------------------------------------
+    def parse_batch(self, body):
+        """
+        Returns a list of (batch_id, operation, entry element)
+        """
+        root = ET.fromstring(body)
+        ops = []
+        for entry in root.findall("{%s}entry" % ATOM_NS):
+            batch_id = entry.findtext("{%s}id" % BATCH_NS)
+            op = entry.find("{%s}operation" % BATCH_NS)
+            ops.append((batch_id, op.get("type") if op is not None else "insert", entry))
+        return(ops)
+    
+    def handle_contacts_batch(self, body):
+        kind = "contacts.batch"
+        if(self.simulate_network(kind, len(body))):
+            return
+        book = self.server.book
+        options = self.server.options
+        results = []
+        with book.lock:
+            for batch_id, op, entry in self.parse_batch(body):
+                if(options.entry_error_rate and (self.server.rnd.random() < options.entry_error_rate)):
+                    results.append("<entry>%s</entry>" % batch_result(batch_id, op, 503, "Service Unavailable"))
+                    continue
+                
+                if(op == "insert"):
+                    c = book.add_contact(parse_contact(entry))
+                    results.append(contact_xml(book, c, batch_result(batch_id, op, 201, "Created")))
+                    continue
+                
+                cid = (entry.findtext("{%s}id" % ATOM_NS) or "").rstrip("/").split("/")[-1]
+                c = book.contacts.get(cid)
+                if(op == "query"):
+                    if((c is None) or c.get("deleted")):
+                        results.append("<entry>%s</entry>" % batch_result(batch_id, op, 404, "Not Found"))
+                    else:
+                        results.append(contact_xml(book, c, batch_result(batch_id, op, 200, "Success")))
+                elif(entry.get("{%s}etag" % GD_NS) is None):
+                    results.append("<entry>%s</entry>" % batch_result(
+                        batch_id, op, 403, "If-match or If-none-match header or entry etag attribute required"
+                    ))
+                elif((c is None) or c.get("deleted")):
+                    results.append("<entry>%s</entry>" % batch_result(batch_id, op, 404, "Not Found"))
+                elif(op == "update"):
+                    c.update(parse_contact(entry))
+                    book.touch(c)
+                    results.append(contact_xml(book, c, batch_result(batch_id, op, 200, "Success")))
+                elif(op == "delete"):
+                    c["deleted"] = True
+                    book.touch(c)
+                    results.append("<entry>%s</entry>" % batch_result(batch_id, op, 200, "Success"))
+                else:
+                    results.append("<entry>%s</entry>" % batch_result(batch_id, op, 400, "Bad Request"))
+            now = book.timestamp()
+        
+        feed_url = "%s/m8/feeds/contacts/default/full/batch" % book.base_url
+        resp = feed_xml(book, feed_url, "Batch Feed", results, len(results), 1, len(results), now)
+        self.send_atom(resp, kind, len(body))
+    
+    def handle_groups_batch(self, body):
+        kind = "groups.batch"
+        if(self.simulate_network(kind, len(body))):
+            return
+        book = self.server.book
+        results = []
+        with book.lock:
+            for batch_id, op, entry in self.parse_batch(body):
+                if(op != "insert"):
+                    results.append("<entry>%s</entry>" % batch_result(batch_id, op, 400, "Bad Request"))
+                    continue
+                g = book.add_group(entry.findtext("{%s}title" % ATOM_NS))
+                results.append(group_xml(book, g, batch_result(batch_id, op, 201, "Created")))
+            now = book.timestamp()
+        
+        feed_url = "%s/m8/feeds/groups/default/full/batch" % book.base_url
+        resp = feed_xml(book, feed_url, "Batch Feed", results, len(results), 1, len(results), now)
+        self.send_atom(resp, kind, len(body))
+
+#-------------------------------------------------------------------------------
+def parse_contact(entry):
+    """
+    Extract contact fields from a request entry element
+    """
+    name = entry.find("{%s}name" % GD_NS)
+    first_name = last_name = None
+    if(name is not None):
+        first_name = name.findtext("{%s}givenName" % GD_NS)
+        last_name = name.findtext("{%s}familyName" % GD_NS)
+    email = entry.find("{%s}email" % GD_NS)
+    phone = entry.find("{%s}phoneNumber" % GD_NS)
+    properties = {}
+    for prop in entry.findall("{%s}extendedProperty" % GD_NS):
+        properties[prop.get("name")] = prop.get("value")
+    return({
+        "first_name": first_name,
+        "last_name": last_name,
+        "nickname": entry.findtext("{%s}nickname" % GCONTACT_NS),
+        "email": email.get("address") if email is not None else None,
+        "phone": phone.text if phone is not None else None,
+        "groups": [g.get("href") for g in entry.findall("{%s}groupMembershipInfo" % GCONTACT_NS)],
+        "properties": properties,
+    })
+
+#-------------------------------------------------------------------------------
+def discovery_document(base_url):
+    """
+    Minimal discovery document describing the Sheets API methods that are
+    served
+    """
+    string_param = {"type": "string", "location": "query"}
+    return({
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "sheets:v4",
+        "name": "sheets",
+        "version": "v4",
+        "protocol": "rest",
+        "rootUrl": base_url + "/",
+        "servicePath": "",
+        "baseUrl": base_url + "/",
+        "batchPath": "batch",
+        "parameters": {
+            "fields": string_param,
+            "key": string_param,
+            "alt": {"type": "string", "location": "query", "default": "json"},
+        },
+        "schemas": {
+            "ValueRange": {"id": "ValueRange", "type": "object"},
+            "BatchGetValuesResponse": {"id": "BatchGetValuesResponse", "type": "object"},
+        },
+        "resources": {
+            "spreadsheets": {
+                "resources": {
+                    "values": {
+                        "methods": {
+                            "get": {
+                                "id": "sheets.spreadsheets.values.get",
+                                "path": "v4/spreadsheets/{spreadsheetId}/values/{range}",
+                                "httpMethod": "GET",
+                                "parameters": {
+                                    "spreadsheetId": {"type": "string", "required": True, "location": "path"},
+                                    "range": {"type": "string", "required": True, "location": "path"},
+                                    "majorDimension": string_param,
+                                    "valueRenderOption": string_param,
+                                },
+                                "parameterOrder": ["spreadsheetId", "range"],
+                                "response": {"$ref": "ValueRange"},
+                            },
+                            "batchGet": {
+                                "id": "sheets.spreadsheets.values.batchGet",
+                                "path": "v4/spreadsheets/{spreadsheetId}/values:batchGet",
+                                "httpMethod": "GET",
+                                "parameters": {
+                                    "spreadsheetId": {"type": "string", "required": True, "location": "path"},
+                                    "ranges": {"type": "string", "repeated": True, "location": "query"},
+                                    "majorDimension": string_param,
+                                    "valueRenderOption": string_param,
+                                },
+                                "parameterOrder": ["spreadsheetId"],
+                                "response": {"$ref": "BatchGetValuesResponse"},
+                            },
+                        }
+                    }
+                }
+            }
+        }
+    })
+
+################################################################################
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in for the Google Sheets and Contacts APIs")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=0, type=int,
+                        help='Port to listen on. 0 picks a free one (default)')
+    parser.add_argument('--people', default=1000, type=int,
+                        help='Number of people in the synthetic sheet')
+    parser.add_argument('--groups', default=20, type=int,
+                        help='Number of groups used by the "groups" column')
+    parser.add_argument('--group-columns', dest='group_columns', default=5, type=int,
+                        help='Number of group columns')
+    parser.add_argument('--existing', default=0, type=int,
+                        help='Number of people from the sheet that already exist as contacts')
+    parser.add_argument('--stale', default=0, type=int,
+                        help='Number of existing contacts that are out of date')
+    parser.add_argument('--extra', default=0, type=int,
+                        help='Number of existing contacts that are not in the sheet')
+    parser.add_argument('--latency', default=0.0, type=float,
+                        help='Seconds of latency added to each request')
+    parser.add_argument('--quota-rps', dest='quota_rps', default=0, type=int,
+                        help='Reject requests beyond this many per second with 429')
+    parser.add_argument('--error-rate', dest='error_rate', default=0.0, type=float,
+                        help='Fraction of requests that fail with 503')
+    parser.add_argument('--entry-error-rate', dest='entry_error_rate', default=0.0, type=float,
+                        help='Fraction of batch entries that fail with 503')
+    parser.add_argument('--seed', default=0, type=int)
+    parser.add_argument('--verbose', action='store_true', default=False)
+    options = parser.parse_args()
+    
+    sheet = SheetData(options.people, options.groups, options.group_columns, options.seed)
+    server = FakeGoogleServer((options.host, options.port), sheet, options)
+    if(options.existing or options.extra):
+        server.book.populate(sheet, options.existing, options.stale, options.extra)
+    
+    # The benchmark harness waits for this line
+    print("READY %s" % server.base_url)
+    sys.stdout.flush()
+    
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+import sys
+import time
+import random
+import logging
+
+# register logger
+logging.getLogger("batch")
+
+# Status codes of failed operations that are worth retrying
+RETRY_CODES = (429, 500, 502, 503, 504)
+
+class RetryPolicy:
+    def __init__(self, max_attempts=5, batch_size=100, min_batch_size=10,
+                 base_delay=1.0, max_delay=60.0):
+        # Number of times an operation is submitted before giving up
+        self.max_attempts = max_attempts
+        
+        # Number of operations per batch request. Halved, down to
+        # min_batch_size, whenever requests are throttled
+        self.batch_size = batch_size
+        self.min_batch_size = min_batch_size
+        
+        # Seconds to wait before the first retry. Doubles with each retry, up
+        # to max_delay
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    #---------------------------------------------------------------------------
+    def delay(self, attempt, retry_after=None):
+        """
+        Seconds to wait before the given retry attempt (1 = first retry)
+        Exponential backoff, with jitter so that concurrent workers do not
+        retry in lockstep. Never shorter than a Retry-After given by the
+        server.
+        """
+        d = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        d = d / 2 + random.uniform(0, d / 2)
+        if(retry_after):
+            d = max(d, retry_after)
+        return(d)
+
+#===============================================================================
+class BatchError(Exception):
+    """
+    Raised by a batch submit function if the whole batch request failed
+    status is the HTTP status code, or None if no response was received.
+    """
+    def __init__(self, status, reason, retry_after=None):
+        Exception.__init__(self, "%s %s" % (status, reason))
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+#===============================================================================
+class BatchResult:
+    def __init__(self):
+        # Operations that succeeded
+        self.succeeded = []
+        
+        # (operation, status code, reason) of operations that failed for good
+        self.failed = []
+        
+        # Number of batch requests sent, and how many of those were retries
+        self.requests = 0
+        self.retries = 0
+
+#===============================================================================
+def submit(operations, submit_batch, policy=None, workers=1, resubmit_unanswered=None):
+    """
+    Submit operations in batches, retrying the ones that fail.
+    
+    submit_batch(batch) sends a list of operations as one batch request. It
+    returns a list with a (status code, reason) for each operation in the
+    batch, in order. A status of None means the response did not mention the
+    operation. If the whole request failed, it raises BatchError instead.
+    
+    Only the operations that failed with a retryable status are submitted
+    again, after a backoff delay. Operations that failed with any other
+    status are not retried.
+    
+    Operations without a status may have been carried out all the same, e.g.
+    if the connection dropped before the response arrived. If given,
+    resubmit_unanswered(op) tells whether that is safe for op. Operations it
+    returns False for, such as inserts that would be duplicated, fail instead.
+    
+    If workers > 1, batches are submitted concurrently using a pool of that
+    many threads.
+    
+    Returns a BatchResult
+    """
+    log = logging.getLogger("batch")
+    if(policy is None):
+        policy = RetryPolicy()
+    batch_size = policy.batch_size
+    
+    R = BatchResult()
+    pending = list(operations)
+    attempt = 1
+    while(pending):
+        def submit_one(batch):
+            try:
+                return(submit_batch(batch))
+            except BatchError as e:
+                return(e)
+        
+        batches = split_list(pending, batch_size)
+        outcomes = parallel_map(submit_one, batches, workers)
+        R.requests += len(batches)
+        if(attempt > 1):
+            R.retries += len(batches)
+        
+        retry = []
+        throttled = False
+        retry_after = None
+        for batch, outcome in zip(batches, outcomes):
+            if(isinstance(outcome, BatchError)):
+                statuses = [(outcome.status, outcome.reason)] * len(batch)
+                if(outcome.retry_after):
+                    retry_after = max(retry_after or 0, outcome.retry_after)
+            else:
+                statuses = list(outcome)
+                statuses.extend([(None, "No response")] * (len(batch) - len(statuses)))
+            
+            for op, (code, reason) in zip(batch, statuses):
+                if((code is not None) and (200 <= code < 300)):
+                    R.succeeded.append(op)
+                elif((code is None) and resubmit_unanswered and (not resubmit_unanswered(op))):
+                    R.failed.append((op, code, reason))
+                elif((code is None) or (code in RETRY_CODES)):
+                    if(code == 429):
+                        throttled = True
+                    if(attempt < policy.max_attempts):
+                        retry.append(op)
+                    else:
+                        R.failed.append((op, code, reason))
+                else:
+                    R.failed.append((op, code, reason))
+        
+        if(retry):
+            if(throttled and (batch_size > policy.min_batch_size)):
+                batch_size = max(policy.min_batch_size, batch_size // 2)
+                log.debug("Throttled. Reducing batch size to %d" % batch_size)
+            delay = policy.delay(attempt, retry_after)
+            log.info("Retrying %d failed operations in %.1f seconds..." % (len(retry), delay))
+            time.sleep(delay)
+        
+        pending = retry
+        attempt += 1
+    
+    return(R)
+
+#===============================================================================
+def parallel_map(func, items, workers=1):
+    """
+    Same as map(), but if workers > 1, items are processed concurrently by a
+    pool of that many threads.
+    Results are returned in the same order as items
+    """
+    items = list(items)
+    if((workers <= 1) or (len(items) <= 1)):
+        return([func(item) for item in items])
+    
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(workers, len(items)))
+    try:
+        return(pool.map(func, items))
+    finally:
+        pool.close()
+        pool.join()
+
+def split_list(l, n):
+    """
+    Splits a list into sublists, ensuring each sublist doesn't exceed n items
+    For example, input:
+        l = [1,2,3,4,5,6,7,8,9,10], n = 3
+    output:
+        [[1,2,3],[4,5,6],[7,8,9],[10]]
+    """
+    new_l = []
+    while(len(l) > n):
+        new_l.append(l[:n])
+        l = l[n:]
+    if(len(l)): new_l.append(l)
+    return(new_l)
+
+#===============================================================================
+class Background:
+    """
+    Runs func(*args, **kwargs) in a background thread, so that the caller can
+    get on with something else in the meantime.
+    result() waits for it to finish and returns what it returned. If it
+    raised an exception, including SystemExit, result() raises it instead.
+    """
+    def __init__(self, func, *args, **kwargs):
+        import threading
+        self._result = None
+        self._exc_info = None
+        self._thread = threading.Thread(target=self._run, args=(func, args, kwargs))
+        # Don't keep the process alive if the caller exits first
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def _run(self, func, args, kwargs):
+        try:
+            self._result = func(*args, **kwargs)
+        except BaseException:
+            self._exc_info = sys.exc_info()
+    
+    def result(self):
+        # join() with a timeout, so the wait can still be interrupted
+        while(self._thread.is_alive()):
+            self._thread.join(0.5)
+        if(self._exc_info):
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return(self._result)
+
+def prefetch(items, max_items):
+    """
+    Iterate over items in a background thread, ahead of the consumer.
+    The background thread starts right away, before the returned iterator is
+    first used.
+    Up to max_items are buffered. Once that many are waiting, the producer
+    waits for the consumer to catch up, so memory use does not depend on
+    how far ahead it gets. If the consumer stops early, or drops the
+    iterator without using it, so does the producer. Exceptions raised by
+    the producer are raised by the consumer once it gets to them.
+    """
+    import Queue
+    import weakref
+    import threading
+    q = Queue.Queue(maxsize=max_items)
+    stopped = threading.Event()
+    
+    def put(entry):
+        # put() with a timeout, so the producer can tell the consumer is gone
+        while(not stopped.is_set()):
+            try:
+                q.put(entry, True, 0.5)
+                return(True)
+            except Queue.Full:
+                continue
+        return(False)
+    
+    def produce(consumer):
+        try:
+            for item in items:
+                if(not put((True, item))):
+                    return
+        except BaseException:
+            put((False, sys.exc_info()))
+        else:
+            put((False, None))
+    
+    def consume():
+        try:
+            while(True):
+                # get() with a timeout, so the wait can still be interrupted
+                try:
+                    ok, item = q.get(True, 0.5)
+                except Queue.Empty:
+                    continue
+                if(ok):
+                    yield item
+                elif(item is None):
+                    return
+                else:
+                    raise item[0], item[1], item[2]
+        finally:
+            stopped.set()
+    
+    consumer = consume()
+    # The producer holds a weak reference to the consumer, which stops it
+    # once the consumer is garbage collected. A generator that was never
+    # started does not run its finally clause
+    Background(produce, weakref.ref(consumer, lambda ref: stopped.set()))
+    return(consumer)
@@ -0,0 +1,40 @@
+import os
+import json
+import tempfile
+
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'sheets2contacts')
+
+def get_cache_path(*names):
+    """
+    Get the path of a file in the sheets2contacts cache directory.
+    Any missing directories are created
+    """
+    path = os.path.join(CACHE_DIR, *names)
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    return(path)
+
+#-------------------------------------------------------------------------------
+def load_json(path):
+    """
+    Load a JSON cache file
+    Returns None if it does not exist or is corrupt
+    """
+    try:
+        with open(path, 'r') as f:
+            return(json.load(f))
+    except (IOError, OSError, ValueError):
+        return(None)
+
+#-------------------------------------------------------------------------------
+def save_json(path, data):
+    """
+    Save a JSON cache file.
+    The file is written to a temporary file first and then moved into place
+    so that an interrupted write does not leave a corrupt file behind
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(data, f)
+    os.rename(tmp_path, path)
@@ -1,12 +1,31 @@
+import json
+import hashlib
 import logging
-logging.getLogger("person")
 
-class Person:
+# register logger
+log = logging.getLogger("person")
+
+class Person(object):
+    # Slots avoid a per-instance __dict__. There can be a lot of these.
+    __slots__ = (
+        "entry", "entry_id", "etag", "deleted",
+        "first_name", "last_name", "nickname", "email", "phone", "groups",
+        "sync_hash", "groups_changed", "group_delta", "group_mask", "_group_hrefs"
+    )
+    
     def __init__(self):
         
         # Google Contact entry object
         self.entry = None
         
+        # ID and etag of the Google Contact entry
+        # These are kept even if the entry object itself is not available
+        self.entry_id = None
+        self.etag = None
+        
+        # Set if the contact was deleted from Google Contacts
+        self.deleted = False
+        
         self.first_name = None
         self.last_name = None
         self.nickname = None
@@ -14,52 +33,95 @@ class Person:
         self.phone = None
         self.groups = []
         
-        # store group hrefs before resolving them into Group objects
-        self._group_hrefs = []
+        # Set by update() if group membership changed
+        self.groups_changed = False
         
-        self.log = logging.getLogger("person")
+        # (added, removed) lists of groups, set by update() along with
+        # groups_changed. None if only the new groups are known
+        self.group_delta = None
+        
+        # Bitmask of self.groups, from GroupRegistry.mask(). Set when the
+        # groups are resolved against a registry. None if not known
+        # Only comparable between people resolved against the same registry
+        self.group_mask = None
+        
+        # fingerprint() of the sheet data this contact was last synced from
+        self.sync_hash = None
+        
+        # store group hrefs before resolving them into Group objects
+        self._group_hrefs = ()
     
-    def update(self, P):
+    def update(self, P, registry=None):
         """
         Update self with potential new data form a different Person object
         entries with None are not updated
         
+        If both group masks are known, registry is the GroupRegistry they
+        came from, used to look up the groups that were added and removed
+        
         Returns True if anything got updated
         """
         changed = False
         
         if((P.first_name != None) and (P.first_name != self.first_name)):
-            self.log.debug("first_name changed: '%s' --> '%s'" % (self.first_name, P.first_name))
+            log.debug("first_name changed: '%s' --> '%s'" % (self.first_name, P.first_name))
             self.first_name = P.first_name
             changed = True
         
         if((P.last_name != None) and (P.last_name != self.last_name)):
-            self.log.debug("last_name changed: '%s' --> '%s'" % (self.last_name, P.last_name))
+            log.debug("last_name changed: '%s' --> '%s'" % (self.last_name, P.last_name))
             self.last_name = P.last_name
             changed = True
         
         if((P.nickname != None) and (P.nickname != self.nickname)):
-            self.log.debug("nickname changed: '%s' --> '%s'" % (self.nickname, P.nickname))
+            log.debug("nickname changed: '%s' --> '%s'" % (self.nickname, P.nickname))
             self.nickname = P.nickname
             changed = True
         
         if((P.email != None) and (P.email != self.email)):
-            self.log.debug("email changed: '%s' --> '%s'" % (self.email, P.email))
+            log.debug("email changed: '%s' --> '%s'" % (self.email, P.email))
             self.email = P.email
             changed = True
         
         if((P.phone != None) and (P.phone != self.phone)):
-            self.log.debug("phone changed: '%s' --> '%s'" % (self.phone, P.phone))
+            log.debug("phone changed: '%s' --> '%s'" % (self.phone, P.phone))
             self.phone = P.phone
             changed = True
         
-        if(set(P.groups) != set(self.groups)):
-            self.log.debug("groups changed: '%s' --> '%s'" % (self.groups, P.groups))
+        if((self.group_mask is None) or (P.group_mask is None)):
+            # Not both resolved against a registry. Compare the slow way
+            groups_differ = (set(P.groups) != set(self.groups))
+        else:
+            groups_differ = (self.group_mask != P.group_mask)
+        
+        if(groups_differ):
+            if((registry is not None) and (self.group_mask is not None) and (P.group_mask is not None)):
+                delta_mask = self.group_mask ^ P.group_mask
+                added = registry.groups_in(delta_mask & P.group_mask)
+                removed = registry.groups_in(delta_mask & self.group_mask)
+            else:
+                old_groups = set(self.groups)
+                new_groups = set(P.groups)
+                added = [G for G in P.groups if G not in old_groups]
+                removed = [G for G in self.groups if G not in new_groups]
+            log.debug("groups changed: added %s, removed %s" % (added, removed))
             self.groups = P.groups
+            self.group_mask = P.group_mask
+            self.group_delta = (added, removed)
+            self.groups_changed = True
             changed = True
         
         return(changed)
         
+    def fingerprint(self):
+        """
+        Hash of the fields that are synced from the sheet, and group membership
+        """
+        fields = [self.first_name, self.last_name, self.nickname, self.email, self.phone]
+        fields.append(sorted(set(G.name for G in self.groups)))
+        s = json.dumps(fields)
+        return(hashlib.sha1(s.encode('utf-8')).hexdigest())
+    
     def __str__(self):
         s = [
             "%s %s:" % (self.first_name, self.last_name),
@@ -70,7 +132,9 @@ class Person:
         return("\n".join(s))
         
 #===============================================================================
-class Group:
+class Group(object):
+    __slots__ = ("entry", "name")
+    
     def __init__(self, name):
         # Google Contact Group entry object
         self.entry = None
@@ -80,11 +144,105 @@ class Group:
     def __repr__(self):
         return("<%s>" % self.name)
 
+#===============================================================================
+class GroupRegistry:
+    """
+    Collection of Group objects, indexed by name and by ID
+    
+    Each group is also numbered 0..n-1 in the order it was added, for
+    group membership bitmasks. See mask()
+    """
+    def __init__(self, Groups=()):
+        self.groups = []
+        self.by_name = {}
+        self.by_id = {}
+        self.indexes = {}
+        self.by_index = []
+        for G in Groups:
+            self.add(G)
+    
+    def add(self, G):
+        """
+        Add a group to the registry.
+        Adding a group that is already registered updates its ID index. This
+        is necessary once a new group gets its entry from Google.
+        """
+        if(self.by_name.get(G.name) is not G):
+            if(G not in self.indexes):
+                self.indexes[G] = len(self.by_index)
+                self.by_index.append(G)
+            self.groups.append(G)
+            self.by_name[G.name] = G
+        if(G.entry):
+            self.by_id[G.entry.id.text] = G
+    
+    def extend(self, Groups):
+        for G in Groups:
+            self.add(G)
+    
+    def copy(self):
+        """
+        Copy of the registry, which is not affected by groups added to this
+        one later. This lets another thread resolve groups while this
+        registry is added to.
+        The groups keep their indexes, so masks from the copy can be compared
+        with masks from this registry.
+        """
+        R = GroupRegistry()
+        R.groups = list(self.groups)
+        R.by_name = dict(self.by_name)
+        R.by_id = dict(self.by_id)
+        R.indexes = dict(self.indexes)
+        R.by_index = list(self.by_index)
+        return(R)
+    
+    def get_by_name(self, group_name):
+        return(self.by_name.get(group_name))
+    
+    def get_by_id(self, gid):
+        return(self.by_id.get(gid))
+    
+    def mask(self, Groups):
+        """
+        Get the group membership bitmask of a list of groups
+        Returns None if any of the groups is not in this registry
+        """
+        mask = 0
+        for G in Groups:
+            i = self.indexes.get(G)
+            if(i is None):
+                return(None)
+            mask |= (1 << i)
+        return(mask)
+    
+    def groups_in(self, mask):
+        """
+        Get the groups in a group membership bitmask, in index order
+        Only looks at the set bits, so a small mask is cheap to expand
+        """
+        Groups = []
+        while(mask):
+            bit = mask & -mask
+            Groups.append(self.by_index[bit.bit_length() - 1])
+            mask ^= bit
+        return(Groups)
+    
+    def __iter__(self):
+        return(iter(self.groups))
+    
+    def __len__(self):
+        return(len(self.groups))
+    
+    def __contains__(self, G):
+        return(self.by_name.get(G.name) is G)
+
 #===============================================================================
 def get_group_by_name(Groups, group_name):
     """
     Lookup a group by name
     """
+    if(isinstance(Groups, GroupRegistry)):
+        return(Groups.get_by_name(group_name))
     for G in Groups:
         if(G.name == group_name):
             return(G)
@@ -95,7 +253,9 @@ def get_group_by_id(Groups, gid):
     """
     Lookup a group by ID
     """
+    if(isinstance(Groups, GroupRegistry)):
+        return(Groups.get_by_id(gid))
     for G in Groups:
         if(G.entry and G.entry.id.text == gid):
             return(G)
-    return(None)
\ No newline at end of file
+    return(None)
@@ -0,0 +1,147 @@
+import os
+import sys
+import logging
+import tempfile
+from . import batch
+
+# register logger
+logging.getLogger("sink")
+
+class ContactSink:
+    """
+    Base class of the places synced contacts can be written to.
+    
+    The apply step of a sync creates the missing groups with
+    batch_create_groups(), then writes the contacts with batch_contacts_job()
+    """
+    def __init__(self):
+        self.log = logging.getLogger("sink")
+    
+    #---------------------------------------------------------------------------
+    def batch_create_groups(self, Groups, registry=None, workers=1, retry=None):
+        """
+        Create new groups.
+        If a GroupRegistry is given, the created groups are added to it.
+        Returns a batch.BatchResult
+        """
+        raise NotImplementedError
+    
+    #---------------------------------------------------------------------------
+    def batch_contacts_job(self, create=[], update=[], delete=[], workers=1, retry=None):
+        """
+        Create, update and delete contacts
+        Returns a batch.BatchResult of ("create"|"update"|"delete", Person)
+        operations
+        """
+        raise NotImplementedError
+    
+    #---------------------------------------------------------------------------
+    def close(self):
+        """
+        Finish writing. Nothing to do by default
+        """
+        pass
+
+#===============================================================================
+class FileSink(ContactSink):
+    """
+    Base class of sinks that export contacts to a file.
+    
+    Each contact is written out as soon as it is passed in, and nothing is
+    kept once it has been written, so memory use does not grow with the
+    number of contacts. Group membership is written with each contact, so
+    groups do not need to be created.
+    
+    The file is written to a temporary file and moved into place by close(),
+    so an interrupted export does not clobber an earlier one. A path of "-"
+    writes to stdout instead.
+    
+    Subclasses call open() once they are set up, and implement write_person()
+    """
+    def __init__(self, path):
+        ContactSink.__init__(self)
+        self.path = path
+        self.tmp_path = None
+        self.n_written = 0
+    
+    #---------------------------------------------------------------------------
+    def open(self):
+        """
+        Open the file and write its header
+        """
+        try:
+            if(self.path == "-"):
+                self.f = sys.stdout
+            else:
+                fd, self.tmp_path = tempfile.mkstemp(
+                    dir=os.path.dirname(os.path.abspath(self.path)),
+                    prefix=os.path.basename(self.path) + "."
+                )
+                # mkstemp makes the file private. Give it the permissions
+                # of any other new file instead
+                umask = os.umask(0)
+                os.umask(umask)
+                os.chmod(self.tmp_path, 0o666 & ~umask)
+                self.f = os.fdopen(fd, 'wb')
+            self.write_header()
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write %s: %s" % (self.path, e))
+            sys.exit(1)
+    
+    #---------------------------------------------------------------------------
+    def batch_create_groups(self, Groups, registry=None, workers=1, retry=None):
+        R = batch.BatchResult()
+        for G in Groups:
+            if(registry is not None):
+                registry.add(G)
+            R.succeeded.append(G)
+        return(R)
+    
+    #---------------------------------------------------------------------------
+    def batch_contacts_job(self, create=[], update=[], delete=[], workers=1, retry=None):
+        """
+        Write the created and updated contacts to the file, in order.
+        Deleted contacts are simply left out.
+        
+        The returned batch.BatchResult does not list the written contacts, to
+        keep memory use constant. self.n_written counts them instead.
+        """
+        R = batch.BatchResult()
+        try:
+            for P in create:
+                self.write_person(P)
+                self.n_written += 1
+            for P in update:
+                self.write_person(P)
+                self.n_written += 1
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write %s: %s" % (self.path, e))
+            sys.exit(1)
+        return(R)
+    
+    #---------------------------------------------------------------------------
+    def close(self):
+        """
+        Finish the file and move it into place
+        """
+        try:
+            self.write_footer()
+            if(self.tmp_path is None):
+                self.f.flush()
+            else:
+                self.f.close()
+                os.rename(self.tmp_path, self.path)
+                self.tmp_path = None
+        except (IOError, OSError) as e:
+            self.log.error("Unable to write %s: %s" % (self.path, e))
+            sys.exit(1)
+    
+    #---------------------------------------------------------------------------
+    def write_header(self):
+        pass
+    
+    def write_person(self, P):
+        raise NotImplementedError
+    
+    def write_footer(self):
+        pass
@@ -0,0 +1,256 @@
+import re
+import sys
+import json
+import hashlib
+import logging
+from itertools import compress
+from collections import OrderedDict
+from . import contact_defs
+
+# register logger
+logging.getLogger("source")
+
+# Separates group names in the "groups" column and the group_columns setting
+GROUP_SEPARATOR = re.compile(r'[,;]')
+
+# Keys of the sheets2contacts mapping
+MAPPING_KEYS = [
+    "sheet",
+    "first_name",
+    "last_name",
+    "nickname",
+    "email",
+    "phone",
+    "groups",
+    "group_columns"
+]
+
+class ContactSource:
+    """
+    Base class of the places contact data can be read from.
+    
+    Subclasses read the columns named by a sheets2contacts mapping, and
+    implement fetch_column_data()
+    """
+    def __init__(self, source_id):
+        # Identifies the source in the state of the last sync
+        self.source_id = source_id
+        
+        self.log = logging.getLogger("source")
+        
+        # Fingerprint of the data from the last fetch_column_data()
+        self.fingerprint = None
+        
+        # Column mapping used by the last fetch_column_data(), if the source
+        # can use it to speed up the next fetch
+        self.sheet_map = None
+    
+    #---------------------------------------------------------------------------
+    def fetch_sheet_data(self, sheet_map=None):
+        """
+        Read the contact data
+        Returns (Groups, People), and sets self.fingerprint
+        
+        sheet_map is the self.sheet_map of an earlier fetch, if known
+        """
+        column_data, group_data = self.fetch_column_data(sheet_map)
+        return(self.elaborate_column_data(column_data, group_data))
+    
+    #---------------------------------------------------------------------------
+    def fetch_column_data(self, sheet_map=None):
+        """
+        Read the mapped columns, without turning them into Person and Group
+        objects. Enough to tell whether the contact data changed, using
+        self.fingerprint
+        Returns (column_data, group_data) for elaborate_column_data(), and
+        sets self.fingerprint
+        
+        sheet_map is the self.sheet_map of an earlier fetch, if known
+        """
+        raise NotImplementedError
+    
+    #---------------------------------------------------------------------------
+    def parse_mapping(self, mapping, require_sheet=True):
+        """
+        Parse the rows of a sheets2contacts mapping
+        Returns the sheet name, a dict of contact keys to column headings and a
+        list of group column headings
+        
+        If require_sheet is False, the sheet name is optional, and None if not
+        given
+        """
+        # convert to dict
+        kv_dict = {}
+        for row in mapping:
+            if((len(row) < 2) or (len(row[0].strip()) == 0)): continue
+            kv_dict[row[0].strip()] = row[1].strip()
+        
+        # Sanitize dict to only contain valid keys
+        bad_keys = set(kv_dict) - set(MAPPING_KEYS)
+        for bad_key in bad_keys:
+            self.log.warning("Ignoring key: %s" % bad_key)
+            del(kv_dict[bad_key])
+        
+        # Extract sheet name from dict
+        if(("sheet" not in kv_dict) and require_sheet):
+            self.log.error("sheet2contacts tab is missing required key: sheet")
+            sys.exit(1)
+        sheet_name = kv_dict.pop('sheet', None)
+        self.log.debug("Got sheet name: %s" % sheet_name)
+        
+        # if group_columns is used, extract that
+        group_columns = kv_dict.pop("group_columns", "")
+        group_columns = [gc.strip() for gc in GROUP_SEPARATOR.split(group_columns)]
+        group_columns = [gc for gc in group_columns if len(gc)]
+        
+        return(sheet_name, kv_dict, group_columns)
+    
+    #---------------------------------------------------------------------------
+    def get_bool(self, value):
+        def RepresentsInt(s):
+            try:
+                int(s)
+                return True
+            except ValueError:
+                return False
+        
+        if((type(value) is int) or (RepresentsInt(value))):
+            return(bool(int(value)))
+        elif(type(value) in [str, unicode]):
+            return(value.lower() in ["t", "true", "y", "yes"])
+        else:
+            self.log.error("Internal error: type=%s" % type(value).__name__)
+            sys.exit(1)
+    
+    #---------------------------------------------------------------------------
+    def elaborate_column_data(self, column_data, group_data):
+        """
+        converts the column_data into Person and Group lists
+        
+        Works one column at a time: each column is padded and normalized in a
+        single pass, and each distinct "groups" cell is only parsed once.
+        """
+        
+        # Determine number of people (the largest dimension in the table)
+        n_people = 0
+        for v in column_data.values():
+            n_people = max(n_people, len(v))
+        self.log.debug("Received %d contact entries" % n_people)
+        
+        # Normalize contact columns
+        columns = {}
+        for key in ["first_name", "last_name", "nickname", "email", "phone", "groups"]:
+            columns[key] = normalize_column(column_data.get(key, []), n_people)
+        
+        # normalize group_data to bool. Delete any that are all false
+        # Cells tend to repeat the same few values, so convert each only once
+        bool_values = {}
+        group_columns = {}
+        for k, column in group_data.items():
+            bools = [False] * n_people
+            for i, cell in enumerate(column[:n_people]):
+                try:
+                    bools[i] = bool_values[cell]
+                except KeyError:
+                    bools[i] = bool_values[cell] = self.get_bool(cell)
+            if(any(bools)):
+                group_columns[k] = bools
+        
+        # Parse each distinct "groups" cell into a list of group names
+        parsed_groups = {}
+        for groups_str in columns["groups"]:
+            if((groups_str is None) or (groups_str in parsed_groups)):
+                continue
+            group_names = set()
+            for group_name in GROUP_SEPARATOR.split(groups_str):
+                group_name = group_name.strip()
+                if(len(group_name)):
+                    group_names.add(group_name)
+            parsed_groups[groups_str] = group_names
+        
+        # Collect all the groups that exist
+        group_names = set(group_columns.keys())
+        for names in parsed_groups.values():
+            group_names |= names
+        
+        # Convert groups into Group objects
+        # also store into a dict for convenience
+        Groups = []
+        groups_dict = {}
+        for group_name in sorted(group_names):
+            G = contact_defs.Group(group_name)
+            Groups.append(G)
+            groups_dict[group_name] = G
+        self.log.debug("Received %d unique groups" % len(Groups))
+        
+        for groups_str in parsed_groups:
+            parsed_groups[groups_str] = [groups_dict[name] for name in parsed_groups[groups_str]]
+        
+        # Convert column_data into People objects
+        People = []
+        rows = zip(
+            columns["first_name"], columns["last_name"], columns["nickname"],
+            columns["email"], columns["phone"], columns["groups"]
+        )
+        for first_name, last_name, nickname, email, phone, groups_str in rows:
+            P = contact_defs.Person()
+            P.first_name = first_name
+            P.last_name = last_name
+            P.nickname = nickname
+            P.email = email
+            P.phone = phone
+            if(groups_str is not None):
+                P.groups = list(parsed_groups[groups_str])
+            People.append(P)
+        
+        # Add group membership from group columns
+        for group_name, bools in group_columns.items():
+            G = groups_dict[group_name]
+            for P in compress(People, bools):
+                P.groups.append(G)
+        
+        return(Groups, People)
+    
+    def get_cell(self, column_data, col, idx, default=None):
+        """
+        Fetch a single cell from column_data
+        """
+        column = column_data.get(col, [])
+        if(idx >= len(column)):
+            return(default)
+        else:
+            cell = column[idx]
+            if((type(cell) == str) or (type(cell) == unicode)):
+                cell = cell.strip()
+                if(cell == ""):
+                    return(None)
+            return(cell)
+
+
+def normalize_column(column, n):
+    """
+    Pad or truncate a column to n cells.
+    Strings are stripped, and empty cells become None
+    """
+    normalized = [None] * n
+    for i, cell in enumerate(column[:n]):
+        if((type(cell) == str) or (type(cell) == unicode)):
+            cell = cell.strip()
+            if(cell == ""):
+                cell = None
+        normalized[i] = cell
+    return(normalized)
+
+def get_fingerprint(column_data, group_data):
+    """
+    Compute a stable hash of the contents of the mapped columns and group
+    columns.
+    
+    Same as json.dumps(..., sort_keys=True), but sorting the keys up front
+    lets json use its C encoder
+    """
+    s = json.dumps([
+        OrderedDict(sorted(column_data.items())),
+        OrderedDict(sorted(group_data.items()))
+    ])
+    return(hashlib.sha1(s.encode('utf-8')).hexdigest())
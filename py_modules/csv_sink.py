@@ -0,0 +1,64 @@
+import csv
+import logging
+from .contact_sink import FileSink
+from .csv_source import TSV_EXTENSIONS
+
+# register logger
+logging.getLogger("csv")
+
+# Heading of each exported column, and the Person attribute it holds
+CSV_COLUMNS = [
+    ("First name", "first_name"),
+    ("Last name", "last_name"),
+    ("Nickname", "nickname"),
+    ("Email", "email"),
+    ("Phone", "phone"),
+]
+GROUPS_HEADING = "Groups"
+
+class CsvSink(FileSink):
+    def __init__(self, path):
+        """
+        Exports contacts to a CSV file, or a TSV file if path ends in .tsv or
+        .tab. Cells are written as UTF-8.
+        
+        Each contact's groups are listed in one "Groups" column, separated by
+        semicolons, so the file can be read back with --csv using a mapping
+        like:
+            key,value
+            first_name,First name
+            last_name,Last name
+            nickname,Nickname
+            email,Email
+            phone,Phone
+            groups,Groups
+        """
+        if(path.lower().endswith(TSV_EXTENSIONS)):
+            self.delimiter = '\t'
+        else:
+            self.delimiter = ','
+        FileSink.__init__(self, path)
+        self.log = logging.getLogger("csv")
+        self.open()
+    
+    #---------------------------------------------------------------------------
+    def write_header(self):
+        self.writer = csv.writer(self.f, delimiter=self.delimiter, lineterminator='\n')
+        self.writer.writerow([heading for heading, attr in CSV_COLUMNS] + [GROUPS_HEADING])
+    
+    #---------------------------------------------------------------------------
+    def write_person(self, P):
+        row = [csv_cell(getattr(P, attr)) for heading, attr in CSV_COLUMNS]
+        row.append(csv_cell(u"; ".join(G.name for G in P.groups)))
+        self.writer.writerow(row)
+
+
+def csv_cell(value):
+    """
+    Convert a value to a UTF-8 encoded cell. None becomes an empty cell
+    """
+    if(value is None):
+        return("")
+    if(type(value) is unicode):
+        return(value.encode('utf-8'))
+    return(str(value))
@@ -0,0 +1,142 @@
+import os
+import csv
+import sys
+import mmap
+import codecs
+import hashlib
+import logging
+from .contact_source import ContactSource, get_fingerprint
+
+# register logger
+logging.getLogger("csv")
+
+# Extensions of tab separated files. Other files are tab separated if their
+# heading row has more tabs than commas
+TSV_EXTENSIONS = (".tsv", ".tab")
+
+class CsvSource(ContactSource):
+    def __init__(self, path, mapping_path):
+        """
+        Reads contacts from a local CSV or TSV file, such as a sheet exported
+        from Google Sheets. Cells must be UTF-8.
+        
+        mapping_path is a CSV or TSV file laid out like the sheets2contacts
+        tab: a heading row, followed by key/value rows. The "sheet" key is not
+        needed.
+        
+        The file is memory-mapped and parsed in a single pass, keeping only
+        the mapped columns, so even very large files are never loaded whole.
+        """
+        path = os.path.abspath(path)
+        ContactSource.__init__(self,
+            "csv-" + hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        )
+        self.path = path
+        self.mapping_path = mapping_path
+        self.log = logging.getLogger("csv")
+    
+    #---------------------------------------------------------------------------
+    def fetch_column_data(self, sheet_map=None):
+        """
+        Read the mapped columns from the file
+        Returns (column_data, group_data)
+        
+        sheet_map is not used. The mapping file is small, so it is simply
+        read again each time
+        """
+        try:
+            mapping = [
+                [cell.decode('utf-8') for cell in row]
+                for row in list(self.read_rows(self.mapping_path))[1:]
+            ]
+        except (csv.Error, UnicodeDecodeError) as e:
+            self.log.error("Unable to read %s: %s" % (self.mapping_path, e))
+            sys.exit(1)
+        kv_dict, group_columns = self.parse_mapping(mapping, require_sheet=False)[1:]
+        
+        rows = self.read_rows(self.path)
+        headings = [cell.strip() for cell in next(rows, [])]
+        
+        column_data = {}
+        group_data = {}
+        wanted = []
+        for k, v in kv_dict.items():
+            column_data[k] = []
+            wanted.append((column_data[k], self.find_heading(headings, v, "key: %s" % k)))
+        for gc in group_columns:
+            group_data[gc] = []
+            wanted.append((group_data[gc], self.find_heading(headings, gc, "group")))
+        
+        self.log.debug("Reading %s..." % self.path)
+        try:
+            for row in rows:
+                n = len(row)
+                for column, i in wanted:
+                    if(i < n):
+                        column.append(row[i].decode('utf-8'))
+                    else:
+                        column.append(u"")
+        except (csv.Error, UnicodeDecodeError) as e:
+            self.log.error("Unable to read %s: %s" % (self.path, e))
+            sys.exit(1)
+        
+        # Like the Sheets API, leave out empty cells at the end of each column
+        for column, i in wanted:
+            trim_column(column)
+        
+        self.fingerprint = get_fingerprint(column_data, group_data)
+        return(column_data, group_data)
+    
+    #---------------------------------------------------------------------------
+    def find_heading(self, headings, heading, what):
+        """
+        Get the index of a column by its heading
+        """
+        heading = heading.encode('utf-8')
+        if(heading not in headings):
+            self.log.error("Heading '%s' not found for %s" % (heading, what))
+            sys.exit(1)
+        return(headings.index(heading))
+    
+    #---------------------------------------------------------------------------
+    def read_rows(self, path):
+        """
+        Iterate over the rows of a CSV or TSV file, as lists of UTF-8 encoded
+        cells.
+        The file is memory-mapped, so only the part being parsed needs to be in
+        memory.
+        """
+        try:
+            f = open(path, 'rb')
+        except IOError as e:
+            self.log.error("Unable to open %s: %s" % (path, e))
+            sys.exit(1)
+        
+        with f:
+            if(os.fstat(f.fileno()).st_size == 0):
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                heading_line = m.readline()
+                if(path.lower().endswith(TSV_EXTENSIONS) or
+                   (heading_line.count('\t') > heading_line.count(','))):
+                    delimiter = '\t'
+                else:
+                    delimiter = ','
+                
+                m.seek(0)
+                if(heading_line.startswith(codecs.BOM_UTF8)):
+                    m.seek(len(codecs.BOM_UTF8))
+                
+                for row in csv.reader(iter(m.readline, ""), delimiter=delimiter):
+                    yield row
+            finally:
+                m.close()
+
+
+def trim_column(column):
+    """
+    Remove empty cells from the end of a column
+    """
+    while(len(column) and (column[-1].strip() == "")):
+        column.pop()
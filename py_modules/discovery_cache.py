@@ -0,0 +1,68 @@
+import os
+import time
+import json
+import hashlib
+import logging
+import threading
+
+from . import cache
+
+# register logger
+logging.getLogger("discovery_cache")
+
+# Bump this if the layout of the cache changes
+CACHE_VERSION = 1
+
+# Default number of seconds a cached discovery document is used for
+DISCOVERY_TTL = 24 * 3600
+
+# Discovery documents already loaded by this process, keyed by cache path.
+# Lets concurrent syncs share them instead of each reading or fetching their
+# own copy
+_documents = {}
+_documents_lock = threading.Lock()
+
+def build(serviceName, version, http, discoveryServiceUrl, ttl=DISCOVERY_TTL):
+    """
+    Same as apiclient.discovery.build(), but the discovery document is cached
+    on disk and only fetched again once it is older than ttl seconds.
+    Documents are also kept in memory, and shared by all services built by
+    this process.
+    """
+    # apiclient takes a while to import. Only do so when needed
+    from apiclient import discovery
+    
+    log = logging.getLogger("discovery_cache")
+    url_hash = hashlib.sha1(discoveryServiceUrl.encode('utf-8')).hexdigest()[:12]
+    path = cache.get_cache_path(
+        "discovery", "v%d" % CACHE_VERSION,
+        "%s.%s.%s.json" % (serviceName, version, url_hash)
+    )
+    
+    with _documents_lock:
+        doc = None
+        if(path in _documents):
+            loaded, doc = _documents[path]
+            if(time.time() - loaded >= ttl):
+                doc = None
+        
+        if((doc is None) and os.path.exists(path) and (time.time() - os.path.getmtime(path) < ttl)):
+            doc = cache.load_json(path)
+            if((doc is not None) and ("rootUrl" not in doc)):
+                doc = None
+            if(doc is not None):
+                log.debug("Using cached discovery document: %s" % path)
+                _documents[path] = (os.path.getmtime(path), doc)
+        
+        if(doc is None):
+            log.debug("Fetching discovery document: %s" % discoveryServiceUrl)
+            resp, content = http.request(discoveryServiceUrl)
+            if(resp.status >= 400):
+                # Let the regular build() report the error
+                return(discovery.build(serviceName, version, http=http,
+                                       discoveryServiceUrl=discoveryServiceUrl))
+            doc = json.loads(content)
+            cache.save_json(path, doc)
+            _documents[path] = (time.time(), doc)
+    
+    return(discovery.build_from_document(doc, http=http))
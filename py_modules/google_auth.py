@@ -4,9 +4,8 @@ import json
 import argparse
 import tempfile
 
-from oauth2client import client
-from oauth2client import tools
-from oauth2client.file import Storage
+# oauth2client takes a while to import. It is only imported by the functions
+# that need it
 
 from .google_people import People
 
@@ -31,7 +30,28 @@ def add_oauth2client_args(parser):
                         choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'],
                         help=argparse.SUPPRESS)
                         
+def get_stored_credentials(email):
+    """
+    Load the stored credentials of an account without starting the OAuth2
+    flow.
+    Returns None if there are none, or they are no longer valid
+    """
+    credential_dir = os.path.join(os.path.expanduser('~'), '.credentials')
+    file_path = os.path.join(credential_dir, "sheets2contacts.%s.json" % email)
+    if(not os.path.exists(file_path)):
+        return(None)
+    
+    from oauth2client.file import Storage
+    credentials = Storage(file_path).get()
+    if not credentials or credentials.invalid:
+        return(None)
+    return(credentials)
+    
 def get_credentials(flags, file_path = None):
+    from oauth2client import client
+    from oauth2client import tools
+    from oauth2client.file import Storage
+    
     # Setup credentials cache file
     credential_dir = os.path.join(os.path.expanduser('~'), '.credentials')
     if not os.path.exists(credential_dir):
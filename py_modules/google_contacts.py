@@ -1,39 +1,127 @@
 import sys
+import time
 import logging
 
-import atom
-import gdata.contacts.client
 from pprint import pprint
 
 from . import contact_defs
+from . import transport
+from . import batch
+from .batch import parallel_map
+from .contact_sink import ContactSink
 
 # register logger
 logging.getLogger("contacts")
 
-class Contacts:
-    def __init__(self, credentials):
+# gdata and atom take a while to import, so they are only imported once the
+# first Contacts object is created. See import_gdata()
+gdata = None
+atom = None
+
+# Base URL of the Google Contacts feeds
+FEEDS_URL = 'https://www.google.com/m8/feeds'
+
+# Number of entries to request per page of the contacts feed
+PAGE_SIZE = 100
+
+# Name of the extended property that stores Person.sync_hash in a contact
+SYNC_HASH_PROPERTY = "sheets2contacts.hash"
+
+# XML namespaces of contacts feeds
+ATOM_NS = '{http://www.w3.org/2005/Atom}'
+GD_NS = '{http://schemas.google.com/g/2005}'
+GCONTACT_NS = '{http://schemas.google.com/contact/2008}'
+OPENSEARCH_NS = '{http://a9.com/-/spec/opensearch/1.1/}'
+BATCH_NS = '{http://schemas.google.com/gdata/batch}'
+APP_NS = '{http://www.w3.org/2007/app}'
+
+# Prefixes of the namespaces in batch request feeds. Google requires the etag
+# attribute of updated and deleted entries to be gd:etag
+FEED_PREFIXES = {
+    ATOM_NS: '',
+    GD_NS: 'gd',
+    GCONTACT_NS: 'gContact',
+    BATCH_NS: 'batch',
+    APP_NS: 'app',
+}
+BATCH_FEED_START = "<feed %s>" % " ".join(
+    ('xmlns:%s="%s"' % (prefix, ns[1:-1])) if prefix else ('xmlns="%s"' % ns[1:-1])
+    for ns, prefix in sorted(FEED_PREFIXES.items(), key=lambda x: x[1])
+)
+
+# rel of email addresses and phone numbers. Same as gdata.data.WORK_REL
+WORK_REL = 'http://schemas.google.com/g/2005#work'
+
+class ChangesUnavailable(Exception):
+    """
+    Raised if Google no longer has the changes since the requested updated_min
+    timestamp. A full fetch is required instead.
+    """
+    pass
+
+class Contacts(ContactSink):
+    def __init__(self, credentials, keep_entries=True, feeds_url=FEEDS_URL,
+                 stats=None, pool=None):
+        """
+        If keep_entries is False, people fetched from Google Contacts do not
+        hold on to their contact entry objects. Only the entry ID and etag are
+        kept, and the full entry is fetched again, in batch requests, if the
+        contact needs to be updated or deleted.
+        This also lets the contacts feed be fetched in a projection without
+        other applications' extended properties, and parsed straight into
+        Person objects, which is much faster.
+        
+        feeds_url is the base URL of the contacts feeds. Only changes for
+        testing
+        
+        If a Stats object is given, API calls are recorded in it. This
+        includes batch requests sent with post_batch_feed()
+        
+        If a transport.HttpPool is given, requests are sent through it instead
+        of opening a new connection for each one
+        """
+        ContactSink.__init__(self)
         
+        import_gdata()
         auth2token = gdata.gauth.OAuth2TokenFromCredentials(credentials)
-        self.contacts_client = gdata.contacts.client.ContactsClient()
+        if(pool):
+            self.contacts_client = gdata.contacts.client.ContactsClient(
+                http_client=pool.gdata_client()
+            )
+        else:
+            self.contacts_client = gdata.contacts.client.ContactsClient()
+        # gdata forces https unless told otherwise
+        self.contacts_client.ssl = feeds_url.startswith('https:')
         self.contacts_client = auth2token.authorize(self.contacts_client)
+        if(stats):
+            stats.instrument_gdata(self.contacts_client, api_name)
         
         self.log = logging.getLogger("contacts")
         
+        self.keep_entries = keep_entries
+        self.contacts_url = feeds_url + '/contacts/default/full'
+        self.people_url = feeds_url + '/contacts/default/property-' + SYNC_HASH_PROPERTY
+        self.groups_url = feeds_url + '/groups/default/full'
+        
+        # Updated timestamp reported by the last contacts feed fetched
+        self.feed_updated = None
+        
     #---------------------------------------------------------------------------
     def fetch_groups(self):
         """
         Get all the contact groups in Google Contacts
+        Returns a GroupRegistry
         """
-        Groups = []
+        Groups = contact_defs.GroupRegistry()
         
-        feed = self.contacts_client.GetGroups()
+        feed = self.contacts_client.GetGroups(uri=self.groups_url)
         while(feed):
             if(feed.entry):
                 self.log.debug("current feed has %d entries" % len(feed.entry))
                 for entry in feed.entry:
                     G = contact_defs.Group(entry.title.text)
                     G.entry = entry
-                    Groups.append(G)
+                    Groups.add(G)
             
             # Traverse to next "page" of feed
             next_link = feed.GetNextLink()
@@ -46,70 +134,288 @@ class Contacts:
     
     #---------------------------------------------------------------------------
     def fetch_group_entry_by_name(self, group_name):
-        feed = self.contacts_client.GetGroups()
+        feed = self.contacts_client.GetGroups(uri=self.groups_url)
         for entry in feed.entry:
             if entry.title.text == group_name:
                 return(entry)
                 
     #---------------------------------------------------------------------------
-    def fetch_people(self, in_Group=None):
+    def has_changes_since(self, updated_min):
+        """
+        Check whether any contacts or groups changed since the updated_min
+        server timestamp.
+        Only requests a single entry from each feed, so this is cheap.
+        """
+        query = gdata.contacts.client.ContactsQuery()
+        query.max_results = 1
+        query.updated_min = updated_min
+        query.showdeleted = 'true'
+        try:
+            feed = self.contacts_client.GetContacts(uri=self.contacts_url, q=query)
+            if(int(feed.total_results.text) > 0):
+                return(True)
+            feed = self.contacts_client.GetGroups(uri=self.groups_url, q=query)
+            if(int(feed.total_results.text) > 0):
+                return(True)
+        except gdata.client.RequestError as e:
+            if(e.status == 410):
+                # Changes are too old to be known
+                return(True)
+            raise
+        return(False)
+    
+    #---------------------------------------------------------------------------
+    def fetch_people(self, in_Group=None, workers=1):
         """
         Get all the people in Google Contacts.
         Filter by a specific contacts group using the in_group option
         
+        If workers > 1, pages of the feed are fetched concurrently using a pool
+        of that many threads.
+        """
+        return(list(self.iter_people(in_Group, workers=workers)))
+    
+    #---------------------------------------------------------------------------
+    def iter_people(self, in_Group=None, Groups=None, workers=1, updated_min=None):
+        """
+        Same as fetch_people(), but yields people one page at a time instead of
+        building the whole list.
+        If Groups is given, group membership references of each person are
+        resolved before it is yielded.
+        If updated_min is given, only contacts that changed since that server
+        timestamp are returned. This includes deleted contacts, which have
+        Person.deleted set.
+        
+        The timestamp reported by the feed is stored in self.feed_updated, so
+        that it can be used as updated_min for a later fetch.
+        
         FYI: It was discovered that the "next" link is not given if the last
         page in the feed only has 1 item. Instead of relying on the "next" href
         mechanism, pages are traversed manually
+        
+        The first page reports the total number of results, so the remaining
+        pages are known up front. If workers > 1, that many pages are fetched
+        concurrently at a time.
         """
-        query = gdata.contacts.client.ContactsQuery()
-        query.max_results=100
-        query.start_index=1
+        group_id = None
         if(in_Group):
             if(in_Group.entry is None):
                 in_Group.entry = self.fetch_group_entry_by_name(in_Group.name)
-            query.group = in_Group.entry.id.text
+            group_id = in_Group.entry.id.text
+        
+        if((Groups is not None) and not isinstance(Groups, contact_defs.GroupRegistry)):
+            Groups = contact_defs.GroupRegistry(Groups)
+        
+        page, total_results, self.feed_updated = self._fetch_people_page(
+            group_id, 1, updated_min
+        )
+        pages = [page]
+        start_indexes = list(range(1 + PAGE_SIZE, total_results + 1, PAGE_SIZE))
+        window = max(workers, 1)
+        while(1):
+            for page in pages:
+                if(Groups is not None):
+                    self.resolve_group_refs(page, Groups)
+                for P in page:
+                    yield P
             
+            if(len(start_indexes) == 0):
+                break
+            
+            # Fetch the next set of pages
+            pages = parallel_map(
+                lambda start_index: self._fetch_people_page(group_id, start_index, updated_min)[0],
+                start_indexes[:window], workers
+            )
+            start_indexes = start_indexes[window:]
+        
+    #---------------------------------------------------------------------------
+    def _fetch_people_page(self, group_id, start_index, updated_min=None):
+        """
+        Fetch a single page of the contacts feed
+        Returns the list of people in the page, the total number of results
+        in the feed and the feed's updated timestamp
+        """
+        if(not self.keep_entries):
+            return(self._stream_people_page(group_id, start_index, updated_min))
+        
+        query = gdata.contacts.client.ContactsQuery()
+        query.max_results = PAGE_SIZE
+        query.start_index = start_index
+        if(group_id):
+            query.group = group_id
+        if(updated_min):
+            query.updated_min = updated_min
+            query.showdeleted = 'true'
+        
+        self.log.debug("Fetching feed starting at index: %d" % query.start_index)
+        try:
+            feed = self.contacts_client.GetContacts(uri=self.contacts_url, q=query)
+        except gdata.client.RequestError as e:
+            if(updated_min and (e.status == 410)):
+                raise ChangesUnavailable("No changes available since %s" % updated_min)
+            raise
+        
         People = []
-        while(1):
-            self.log.debug("Fetching feed starting at index: %d" % query.start_index)
-            feed = self.contacts_client.GetContacts(q=query)
-            if(feed.entry):
-                self.log.debug("current feed has %d entries" % len(feed.entry))
-                for entry in feed.entry:
-                    P = contact_defs.Person()
-                    P.entry = entry
-                    People.append(P)
-                    
-                    if(entry.name is not None):
-                        if(entry.name.family_name):
-                            P.last_name = entry.name.family_name.text
-                        if(entry.name.given_name):
-                            P.first_name = entry.name.given_name.text
-                    else:
-                        P.first_name = entry.title.text
-                    
-                    if(entry.nickname is not None):
-                        P.nickname = entry.nickname.text
-                    
-                    for email in entry.email:
-                        if email.primary and email.primary == 'true':
-                            P.email = email.address
-                            break
-                    
-                    if(len(entry.phone_number) != 0):
-                        P.phone = entry.phone_number[0].text
-                    
-                    for grp in entry.group_membership_info:
-                        P._group_hrefs.append(grp.href)
+        if(feed.entry):
+            self.log.debug("current feed has %d entries" % len(feed.entry))
+            for entry in feed.entry:
+                People.append(self._entry_to_Person(entry))
+        
+        total_results = int(feed.total_results.text)
+        return(People, total_results, feed.updated.text)
+    
+    #---------------------------------------------------------------------------
+    def _stream_people_page(self, group_id, start_index, updated_min=None):
+        """
+        Same as _fetch_people_page(), but the page is parsed incrementally
+        into Person objects, without building gdata entry objects.
+        Only the sync hash extended property is requested.
+        """
+        import urllib
+        params = [('max-results', PAGE_SIZE), ('start-index', start_index)]
+        if(group_id):
+            params.append(('group', group_id))
+        if(updated_min):
+            params.append(('updated-min', updated_min))
+            params.append(('showdeleted', 'true'))
+        uri = "%s?%s" % (self.people_url, urllib.urlencode(params))
+        
+        self.log.debug("Fetching feed starting at index: %d" % start_index)
+        try:
+            return(self.contacts_client.request('GET', uri, converter=self._parse_people_feed))
+        except gdata.client.RequestError as e:
+            if(updated_min and (e.status == 410)):
+                raise ChangesUnavailable("No changes available since %s" % updated_min)
+            raise
+    
+    def _parse_people_feed(self, response):
+        """
+        Parse a contacts feed response as it is read
+        Each entry is discarded once it has been turned into a Person
+        Returns the same as _fetch_people_page()
+        """
+        from xml.etree import cElementTree as ElementTree
+        People = []
+        total_results = 0
+        updated = None
+        
+        depth = 0
+        for event, elem in ElementTree.iterparse(response, events=("start", "end")):
+            if(event == "start"):
+                if(depth == 0):
+                    feed = elem
+                depth += 1
+                continue
             
-            # Traverse to next "page" of feed
-            total_results = int(feed.total_results.text)
-            query.start_index += query.max_results
-            if(query.start_index > total_results):
-                break;
-
-        return(People)
+            depth -= 1
+            if(depth != 1):
+                continue
+            if(elem.tag == ATOM_NS + 'entry'):
+                People.append(self._element_to_Person(elem))
+            elif(elem.tag == ATOM_NS + 'updated'):
+                updated = elem.text
+            elif(elem.tag == OPENSEARCH_NS + 'totalResults'):
+                total_results = int(elem.text)
+            feed.clear()
+        
+        self.log.debug("current feed has %d entries" % len(People))
+        return(People, total_results, updated)
+    
+    def _element_to_Person(self, elem):
+        """
+        Same as _entry_to_Person(), for an entry parsed by _parse_people_feed()
+        """
+        P = contact_defs.Person()
+        P.entry_id = child_text(elem, ATOM_NS + 'id')
+        P.etag = elem.get(GD_NS + 'etag')
+        P.deleted = (elem.find(GD_NS + 'deleted') is not None)
+        
+        name = elem.find(GD_NS + 'name')
+        if(name is not None):
+            P.last_name = child_text(name, GD_NS + 'familyName')
+            P.first_name = child_text(name, GD_NS + 'givenName')
+        else:
+            # Deleted entries have neither
+            P.first_name = child_text(elem, ATOM_NS + 'title')
+        
+        P.nickname = child_text(elem, GCONTACT_NS + 'nickname')
+        
+        for email in elem.iterfind(GD_NS + 'email'):
+            if(email.get('primary') == 'true'):
+                P.email = email.get('address')
+                break
+        
+        P.phone = child_text(elem, GD_NS + 'phoneNumber')
         
+        P._group_hrefs = [grp.get('href') for grp in elem.iterfind(GCONTACT_NS + 'groupMembershipInfo')]
+        
+        for prop in elem.iterfind(GD_NS + 'extendedProperty'):
+            if(prop.get('name') == SYNC_HASH_PROPERTY):
+                P.sync_hash = prop.get('value')
+                break
+        
+        return(P)
+    
+    #---------------------------------------------------------------------------
+    def _entry_to_Person(self, entry):
+        P = contact_defs.Person()
+        P.entry = entry
+        P.entry_id = entry.id.text
+        P.etag = entry.etag
+        P.deleted = (entry.deleted is not None)
+        
+        if(entry.name is not None):
+            if(entry.name.family_name):
+                P.last_name = entry.name.family_name.text
+            if(entry.name.given_name):
+                P.first_name = entry.name.given_name.text
+        elif(entry.title is not None):
+            # Deleted entries have neither
+            P.first_name = entry.title.text
+        
+        if(entry.nickname is not None):
+            P.nickname = entry.nickname.text
+        
+        for email in entry.email:
+            if email.primary and email.primary == 'true':
+                P.email = email.address
+                break
+        
+        if(len(entry.phone_number) != 0):
+            P.phone = entry.phone_number[0].text
+        
+        P._group_hrefs = [grp.href for grp in entry.group_membership_info]
+        
+        for prop in entry.extended_property:
+            if(prop.name == SYNC_HASH_PROPERTY):
+                P.sync_hash = prop.value
+                break
+        
+        if(not self.keep_entries):
+            P.entry = None
+        
+        return(P)
+        
+    #---------------------------------------------------------------------------
+    def fetch_entries(self, People, workers=1, retry=None):
+        """
+        People that were not fetched from Google Contacts directly (such as
+        ones loaded from a Snapshot) only know the ID of their contact entry.
+        Fetch the full entries for any of these, using batch query operations.
+        
+        Queries that fail are retried according to the batch.RetryPolicy
+        retry.
+        Returns a batch.BatchResult of ("query", Person) operations
+        """
+        missing = [("query", P) for P in People if P.entry is None]
+        if(len(missing)):
+            self.log.debug("Fetching %d contact entries" % len(missing))
+        R = batch.submit(missing, self._submit_contacts_batch, retry, workers)
+        for req_type, P in R.succeeded:
+            P.etag = P.entry.etag
+        return(R)
+    
     #---------------------------------------------------------------------------
     def resolve_group_refs(self, People, Groups):
         """
@@ -117,13 +423,17 @@ class Contacts:
         group membership references.
         If a list of Groups exists, resolve their references
         """
+        if(not isinstance(Groups, contact_defs.GroupRegistry)):
+            Groups = contact_defs.GroupRegistry(Groups)
+        
         for P in People:
             P.groups = []
             for href in P._group_hrefs:
-                G = contact_defs.get_group_by_id(Groups, href)
+                G = Groups.get_by_id(href)
                 if(G):
                     P.groups.append(G)
-            P._group_hrefs = []
+            P.group_mask = Groups.mask(P.groups)
+            P._group_hrefs = ()
         
     #---------------------------------------------------------------------------
     def create_new_group(self, Group):
@@ -140,34 +450,66 @@ class Contacts:
         Group.entry = entry
 
     #---------------------------------------------------------------------------
-    def batch_create_groups(self, Groups):
-        batches = split_list(Groups, 100)
-        for Groups in batches:
-            req_feed = gdata.contacts.data.GroupsFeed()
-            for i,G in enumerate(Groups):
-                grp = gdata.contacts.data.GroupEntry(title=atom.data.Title(text=G.name))
-                req_feed.AddInsert(entry=grp, batch_id_string=str(i))
-            
+    def batch_create_groups(self, Groups, registry=None, workers=1, retry=None):
+        """
+        Registers new groups with Google Contacts.
+        If a GroupRegistry is given, it is updated with the IDs of the newly
+        created groups.
+        If workers > 1, batches are submitted concurrently using a pool of that
+        many threads.
+        Groups that fail to be created are retried according to the
+        batch.RetryPolicy retry.
+        Returns a batch.BatchResult
+        """
+        # A group may have been created even if no response came back.
+        # Submitting it again could create it twice
+        R = batch.submit(Groups, self._submit_groups_batch, retry, workers,
+                         resubmit_unanswered=lambda G: False)
+        
+        if(registry is not None):
+            for G in R.succeeded:
+                registry.add(G)
+        return(R)
+    
+    #---------------------------------------------------------------------------
+    def _submit_groups_batch(self, Groups):
+        req_feed = gdata.contacts.data.GroupsFeed()
+        for i,G in enumerate(Groups):
+            grp = gdata.contacts.data.GroupEntry(title=atom.data.Title(text=G.name))
+            req_feed.AddInsert(entry=grp, batch_id_string=str(i))
+        
+        statuses = [(None, "No response")] * len(Groups)
+        try:
             resp_feed = self.contacts_client.ExecuteBatch(req_feed,
-                'https://www.google.com/m8/feeds/groups/default/full/batch')
-            while(resp_feed):
-                if(resp_feed.entry):
-                    for entry in resp_feed.entry:
-                        idx = int(entry.batch_id.text)
+                self.groups_url + '/batch')
+        except gdata.client.RequestError as e:
+            raise to_BatchError(e)
+        except transport.network_errors() as e:
+            raise batch.BatchError(None, str(e))
+        
+        while(resp_feed):
+            if(resp_feed.entry):
+                for entry in resp_feed.entry:
+                    idx = int(entry.batch_id.text)
+                    code = int(entry.batch_status.code)
+                    statuses[idx] = (code, entry.batch_status.reason)
+                    if(200 <= code < 300):
                         Groups[idx].entry = entry
-                        
-                        self.log.debug('%s: %s (%s)' % (
-                            entry.batch_id.text,
-                            entry.batch_status.code,
-                            entry.batch_status.reason
-                        ))
-                        
-                # Traverse to next "page" of resp_feed
-                next_link = resp_feed.GetNextLink()
-                resp_feed = None
-                if(next_link):
-                    self.log.debug("Traversing to next feed page")
-                    resp_feed = self.contacts_client.GetContacts(uri=next_link.href)
+                    
+                    self.log.debug('%s: %s (%s)' % (
+                        entry.batch_id.text,
+                        entry.batch_status.code,
+                        entry.batch_status.reason
+                    ))
+                    
+            # Traverse to next "page" of resp_feed
+            next_link = resp_feed.GetNextLink()
+            resp_feed = None
+            if(next_link):
+                self.log.debug("Traversing to next feed page")
+                resp_feed = self.contacts_client.GetContacts(uri=next_link.href)
+        
+        return(statuses)
         
     #---------------------------------------------------------------------------
     def _update_ContactEntry(self, Person):
@@ -188,10 +530,38 @@ class Contacts:
                 rel=gdata.data.WORK_REL
             )]
         
-        Person.entry.group_membership_info = []
-        for G in Person.groups:
-            membership = gdata.contacts.data.GroupMembershipInfo(href=G.entry.id.text)
-            Person.entry.group_membership_info.append(membership)
+        # Only touch group membership if it changed. Otherwise the entry
+        # already has the right groups
+        if(Person.groups_changed and (Person.group_delta is not None)):
+            # Just drop the removed groups and add the new ones. The rest of
+            # the memberships are left as they are
+            added, removed = Person.group_delta
+            removed_hrefs = set(G.entry.id.text for G in removed)
+            memberships = [
+                membership for membership in Person.entry.group_membership_info
+                if membership.href not in removed_hrefs
+            ]
+            hrefs = set(membership.href for membership in memberships)
+            for G in added:
+                if(G.entry.id.text not in hrefs):
+                    memberships.append(gdata.contacts.data.GroupMembershipInfo(href=G.entry.id.text))
+            Person.entry.group_membership_info = memberships
+        elif(Person.groups_changed):
+            Person.entry.group_membership_info = []
+            for G in Person.groups:
+                membership = gdata.contacts.data.GroupMembershipInfo(href=G.entry.id.text)
+                Person.entry.group_membership_info.append(membership)
+        
+        # Replace the sync hash, leaving any other extended properties alone
+        Person.entry.extended_property = [
+            prop for prop in Person.entry.extended_property
+            if prop.name != SYNC_HASH_PROPERTY
+        ]
+        if(Person.sync_hash):
+            Person.entry.extended_property.append(gdata.data.ExtendedProperty(
+                name=SYNC_HASH_PROPERTY,
+                value=Person.sync_hash
+            ))
         
     #---------------------------------------------------------------------------
     def update_contact(self, Person):
@@ -232,6 +602,12 @@ class Contacts:
             membership = gdata.contacts.data.GroupMembershipInfo(href=G.entry.id.text)
             new_contact.group_membership_info.append(membership)
         
+        if(Person.sync_hash):
+            new_contact.extended_property = [gdata.data.ExtendedProperty(
+                name=SYNC_HASH_PROPERTY,
+                value=Person.sync_hash
+            )]
+        
         return(new_contact)
     #---------------------------------------------------------------------------
     def create_new_contact(self, Person):
@@ -254,7 +630,16 @@ class Contacts:
         self.contacts_client.Delete(Person.entry)
         
     #---------------------------------------------------------------------------
-    def batch_contacts_job(self, create = [], update = [], delete = []):
+    def batch_contacts_job(self, create = [], update = [], delete = [], workers=1, retry=None):
+        """
+        Create, update and delete contacts using batch requests.
+        If workers > 1, batches are submitted concurrently using a pool of that
+        many threads.
+        Operations that fail are retried according to the batch.RetryPolicy
+        retry.
+        Returns a batch.BatchResult of ("create"|"update"|"delete", Person)
+        operations
+        """
         
         # Combine all requests into one big list to process.
         # Keep track of what the operation type is with tuple
@@ -266,84 +651,285 @@ class Contacts:
         for P in delete:
             requests.append(("delete",P))
         
+        # Updates need the contact entry to work with. Deletes only need its
+        # ID and etag
+        QR = self.fetch_entries(
+            list(update) + [P for P in delete if P.etag is None],
+            workers, retry
+        )
+        
+        # Contacts whose entry could not be fetched can't be submitted
+        unfetched = {}
+        for (req_type, P), code, reason in QR.failed:
+            unfetched[id(P)] = (code, reason)
+        if(unfetched):
+            failed = [op for op in requests if id(op[1]) in unfetched]
+            requests = [op for op in requests if id(op[1]) not in unfetched]
+        
         # Process in batches. Google only allows 100 operations per batch
-        batches = split_list(requests, 100)
-        for request_batch in batches:
-            request_feed = gdata.contacts.data.ContactsFeed()
-            
-            for i,(req_type,P) in enumerate(request_batch):
-                if(req_type == "create"):
-                    new_c = self._create_ContactEntry(P)
-                    request_feed.AddInsert(entry=new_c, batch_id_string=str(i))
-                elif(req_type == "update"):
-                    self._update_ContactEntry(P)
-                    request_feed.AddUpdate(entry=P.entry, batch_id_string=str(i))
-                elif(req_type == "delete"):
-                    request_feed.AddDelete(entry=P.entry, batch_id_string=str(i))
+        # Each batch only refers to its own people, so they are independent
+        # Creates that got no response are not submitted again, as that
+        # could duplicate the contact. They count as failed, so the next
+        # sync runs, and creates them unless it finds they exist by now
+        R = batch.submit(requests, self._submit_contacts_batch, retry, workers,
+                         resubmit_unanswered=lambda op: op[0] != "create")
+        R.requests += QR.requests
+        R.retries += QR.retries
+        if(unfetched):
+            for op in failed:
+                R.failed.append((op,) + unfetched[id(op[1])])
+        return(R)
+    
+    #---------------------------------------------------------------------------
+    def _submit_contacts_batch(self, request_batch):
+        statuses = [(None, "No response")] * len(request_batch)
+        try:
+            resp_feed = post_batch_feed(self.contacts_client,
+                self._batch_feed_xml(request_batch),
+                self.contacts_url + '/batch')
+        except gdata.client.RequestError as e:
+            raise to_BatchError(e)
+        except transport.network_errors() as e:
+            raise batch.BatchError(None, str(e))
+        
+        while(resp_feed):
+            if(resp_feed.entry):
+                for entry in resp_feed.entry:
+                    idx = int(entry.batch_id.text)
+                    code = int(entry.batch_status.code)
+                    statuses[idx] = (code, entry.batch_status.reason)
+                    if((request_batch[idx][0] in ("create", "query")) and (200 <= code < 300)):
+                        request_batch[idx][1].entry = entry
                     
-            # submit the batch request to the server. (use patched method)
-            resp_feed = patched_post(self.contacts_client, request_feed,
-                'https://www.google.com/m8/feeds/contacts/default/full/batch')
-            #resp_feed = self.contacts_client.ExecuteBatch(request_feed,
-            #    'https://www.google.com/m8/feeds/contacts/default/full/batch')
-            
-            while(resp_feed):
-                if(resp_feed.entry):
-                    for entry in resp_feed.entry:
-                        idx = int(entry.batch_id.text)
-                        if(request_batch[idx][0] == "create"):
-                            request_batch[idx][1].entry = entry
-                        
-                        self.log.debug('%s: %s (%s)' % (
-                            entry.batch_id.text,
-                            entry.batch_status.code,
-                            entry.batch_status.reason
-                        ))
+                    self.log.debug('%s: %s (%s)' % (
+                        entry.batch_id.text,
+                        entry.batch_status.code,
+                        entry.batch_status.reason
+                    ))
+                    
+            # Traverse to next "page" of resp_feed
+            next_link = resp_feed.GetNextLink()
+            resp_feed = None
+            if(next_link):
+                self.log.debug("Traversing to next feed page")
+                resp_feed = self.contacts_client.GetContacts(uri=next_link.href)
+        
+        return(statuses)
+    
+    #---------------------------------------------------------------------------
+    def _batch_feed_xml(self, request_batch):
+        """
+        Write the body of a contacts batch request.
+        New and deleted contacts are written straight from the Person, without
+        building gdata entries. Updated contacts are written from their
+        modified entry, so that fields sheets2contacts does not manage are
+        kept. Queries for the full entry of a contact only give its ID.
+        """
+        version = gdata.client.get_xml_version(self.contacts_client.api_version)
+        out = [BATCH_FEED_START]
+        for i,(req_type,P) in enumerate(request_batch):
+            if(req_type == "create"):
+                write_new_contact(out, P, str(i))
+            elif(req_type == "update"):
+                self._update_ContactEntry(P)
+                tree = P.entry._to_tree(version)
+                # Drop the batch results of an earlier request
+                for child in list(tree):
+                    if(child.tag.startswith(BATCH_NS)):
+                        tree.remove(child)
+                write_element(out, tree, batch_xml(str(i), "update"))
+            elif(req_type == "delete"):
+                out.append('<entry gd:etag=%s>' % xml_attr(P.etag))
+                out.append(batch_xml(str(i), "delete"))
+                out.append(xml_element('id', P.entry_id))
+                out.append('</entry>')
+            elif(req_type == "query"):
+                # Entry IDs refer to the "base" projection. Need the full one.
+                out.append('<entry>')
+                out.append(batch_xml(str(i), "query"))
+                out.append(xml_element('id', "%s/%s" % (self.contacts_url, P.entry_id.split('/')[-1])))
+                out.append('</entry>')
+        out.append('</feed>')
+        return("".join(out))
+        
+def import_gdata():
+    """
+    Import the gdata and atom modules used by this module
+    """
+    global gdata, atom
+    if(gdata is None):
+        import atom
+        import gdata.contacts.client
 
-                        
-                # Traverse to next "page" of resp_feed
-                next_link = resp_feed.GetNextLink()
-                resp_feed = None
-                if(next_link):
-                    self.log.debug("Traversing to next feed page")
-                    resp_feed = self.contacts_client.GetContacts(uri=next_link.href)
-        
-def split_list(l, n):
+def to_BatchError(e):
     """
-    Splits a list into sublists, ensuring each sublist doesn't exceed n items
-    For example, input:
-        l = [1,2,3,4,5,6,7,8,9,10], n = 3
-    output:
-        [[1,2,3],[4,5,6],[7,8,9],[10]]
+    Convert a gdata RequestError for a whole batch request to a BatchError
     """
-    new_l = []
-    while(len(l) > n):
-        new_l.append(l[:n])
-        l = l[n:]
-    if(len(l)): new_l.append(l)
-    return(new_l)
+    retry_after = None
+    for k, v in (getattr(e, 'headers', None) or []):
+        if(k.lower() != 'retry-after'):
+            continue
+        if(v.strip().isdigit()):
+            retry_after = int(v)
+        else:
+            # HTTP date
+            import email.utils
+            t = email.utils.parsedate_tz(v)
+            if(t):
+                retry_after = max(0, email.utils.mktime_tz(t) - time.time())
+    return(batch.BatchError(e.status, e.reason, retry_after))
 
+def child_text(elem, tag):
+    """
+    Text of the first child element with the given tag
+    Unlike elem.findtext(), returns None if the child is empty, like gdata
+    """
+    child = elem.find(tag)
+    if(child is None):
+        return(None)
+    return(child.text)
 
-def patched_post(client, entry, uri, auth_token=None, converter=None, desired_class=None, **kwargs):
+def api_name(uri):
     """
-    ExecuteBatch() has a bug when handling Update and Delete jobs.
-    This is the workaround function as described here:
-    http://stackoverflow.com/questions/23576729/getting-if-match-or-if-none-match-header-or-entry-etag-attribute-required-erro
-    
-    When it comes time to do a batched delete/updatem instead of calling
-    client.ExecuteBatch, instead directly call patched_post:
-        patched_post(client_instance, entry_feed,
-            'https://www.google.com/m8/feeds/contacts/default/full/batch')
+    Name that requests to a contacts feed URI are recorded as in Stats
     """
+    path = uri.path.rstrip('/')
+    if('/groups/' in path):
+        name = "groups"
+    else:
+        name = "contacts"
+    if(path.endswith('/batch')):
+        name += ".batch"
+    return(name)
+
+def post_batch_feed(client, body, uri):
+    """
+    Post a batch request feed written by Contacts._batch_feed_xml()
+    Returns the response as a ContactsFeed
     
-    if converter is None and desired_class is None:
-        desired_class = entry.__class__
+    ExecuteBatch() can not be used for updates and deletes, because gdata
+    writes their etag attribute with a generated namespace prefix, which
+    Google rejects. See:
+    http://stackoverflow.com/questions/23576729/getting-if-match-or-if-none-match-header-or-entry-etag-attribute-required-erro
+    """
     http_request = atom.http_core.HttpRequest()
-    entry_string = entry.to_string(gdata.client.get_xml_version(client.api_version))
-    entry_string = entry_string.replace('ns1', 'gd')  # where the magic happens
-    http_request.add_body_part(
-        entry_string,
-        'application/atom+xml')
-    return client.request(method='POST', uri=uri, auth_token=auth_token,
-                          http_request=http_request, converter=converter,
-                          desired_class=desired_class, **kwargs)
\ No newline at end of file
+    http_request.add_body_part(body, 'application/atom+xml')
+    return(client.request(method='POST', uri=uri, http_request=http_request,
+                          desired_class=gdata.contacts.data.ContactsFeed))
+
+#===============================================================================
+# Batch feed writing
+#===============================================================================
+def write_new_contact(out, P, batch_id):
+    """
+    Write a batch insert entry for a new contact
+    Same content as the entry built by Contacts._create_ContactEntry()
+    """
+    out.append('<entry>')
+    out.append(batch_xml(batch_id, "insert"))
+    out.append('<gd:name>')
+    out.append(xml_element('gd:givenName', P.first_name))
+    out.append(xml_element('gd:familyName', P.last_name))
+    out.append('</gd:name>')
+    if(P.nickname):
+        out.append(xml_element('gContact:nickname', P.nickname))
+    if(P.email):
+        out.append('<gd:email rel=%s primary="true" address=%s/>' % (
+            xml_attr(WORK_REL), xml_attr(P.email)
+        ))
+    if(P.phone):
+        out.append('<gd:phoneNumber rel=%s primary="true">%s</gd:phoneNumber>' % (
+            xml_attr(WORK_REL), xml_text(P.phone)
+        ))
+    for G in P.groups:
+        out.append('<gContact:groupMembershipInfo href=%s/>' % xml_attr(G.entry.id.text))
+    if(P.sync_hash):
+        out.append('<gd:extendedProperty name=%s value=%s/>' % (
+            xml_attr(SYNC_HASH_PROPERTY), xml_attr(P.sync_hash)
+        ))
+    out.append('</entry>')
+
+def write_element(out, elem, inner="", default_ns=ATOM_NS):
+    """
+    Write an ElementTree element using the FEED_PREFIXES namespace prefixes.
+    Other namespaces are declared on the elements that use them.
+    inner is written before the element's children.
+    default_ns is the default namespace where the element is written.
+    """
+    declarations = {}
+    tag = xml_qname(elem.tag, declarations)
+    if(':' not in tag):
+        # Unprefixed. Either Atom, or no namespace at all
+        ns = ATOM_NS if elem.tag.startswith(ATOM_NS) else ''
+        if(ns != default_ns):
+            declarations[ns] = None
+            default_ns = ns
+    attrs = [(xml_qname(k, declarations), v) for k, v in sorted(elem.items())]
+    
+    out.append('<' + tag)
+    for ns, prefix in sorted(declarations.items()):
+        if(prefix is None):
+            out.append(' xmlns=%s' % xml_attr(ns[1:-1]))
+        else:
+            out.append(' xmlns:%s=%s' % (prefix, xml_attr(ns[1:-1])))
+    for k, v in attrs:
+        out.append(' %s=%s' % (k, xml_attr(v)))
+    if((not inner) and (not elem.text) and (len(elem) == 0)):
+        out.append('/>')
+        if(elem.tail):
+            out.append(xml_text(elem.tail))
+        return
+    out.append('>' + inner)
+    if(elem.text):
+        out.append(xml_text(elem.text))
+    for child in elem:
+        write_element(out, child, default_ns=default_ns)
+    out.append('</%s>' % tag)
+    if(elem.tail):
+        out.append(xml_text(elem.tail))
+
+def xml_qname(name, declarations):
+    """
+    Prefixed name of an ElementTree "{namespace}name" tag or attribute name
+    Namespaces that are not in FEED_PREFIXES are given a prefix, and added to
+    declarations
+    """
+    if(name[0] != '{'):
+        return(name)
+    ns, local = name[1:].split('}', 1)
+    ns = '{' + ns + '}'
+    prefix = FEED_PREFIXES.get(ns)
+    if(prefix is None):
+        if(ns not in declarations):
+            declarations[ns] = "ns%d" % len(declarations)
+        prefix = declarations[ns]
+    if(prefix == ''):
+        return(local)
+    return(prefix + ':' + local)
+
+def batch_xml(batch_id, operation):
+    return('<batch:id>%s</batch:id><batch:operation type="%s"/>' % (xml_text(batch_id), operation))
+
+def xml_element(tag, text):
+    if(text is None):
+        return('<%s/>' % tag)
+    return('<%s>%s</%s>' % (tag, xml_text(text), tag))
+
+def xml_text(s):
+    """
+    Escape text for XML. Non-ASCII characters are written as character
+    references, like ElementTree.tostring() does, so the result is ASCII
+    """
+    from xml.sax.saxutils import escape
+    if(isinstance(s, str)):
+        s = s.decode('utf-8')
+    return(escape(s).encode('ascii', 'xmlcharrefreplace'))
+
+def xml_attr(s):
+    """
+    Same as xml_text(), but quoted for use as an attribute value
+    """
+    from xml.sax.saxutils import quoteattr
+    if(isinstance(s, str)):
+        s = s.decode('utf-8')
+    return(quoteattr(s).encode('ascii', 'xmlcharrefreplace'))
\ No newline at end of file
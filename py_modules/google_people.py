@@ -1,19 +1,24 @@
 import re
 import sys
 import logging
-from apiclient import discovery
-import httplib2
 from pprint import pprint
 
+from . import discovery_cache
+from . import transport
+
 # register logger
 logging.getLogger("people")
 
 class People:
-    def __init__(self, credentials):
-        http = credentials.authorize(httplib2.Http())
+    def __init__(self, credentials, discovery_ttl=discovery_cache.DISCOVERY_TTL,
+                 stats=None, pool=None):
+        http = credentials.authorize(transport.new_http(pool))
+        if(stats):
+            stats.instrument_http(http, "people")
         discoveryUrl = 'https://people.googleapis.com/$discovery/rest'
-        self.service = discovery.build('people', 'v1', http=http,
-                                  discoveryServiceUrl=discoveryUrl)
+        self.service = discovery_cache.build('people', 'v1', http=http,
+                                  discoveryServiceUrl=discoveryUrl,
+                                  ttl=discovery_ttl)
                                   
         self.log = logging.getLogger("people")
         
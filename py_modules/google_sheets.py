@@ -1,83 +1,130 @@
 
-import re
 import sys
 import logging
-from apiclient import discovery
-import httplib2
-from . import contact_defs
+from . import transport
+from . import discovery_cache
+from .contact_source import ContactSource, get_fingerprint
 from pprint import pprint
 
 # register logger
 logging.getLogger("sheets")
 
-class Sheets:
-    def __init__(self, credentials, sheet_id):
-        http = credentials.authorize(httplib2.Http())
-        discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                        'version=v4')
-        self.sheets_service = discovery.build('sheets', 'v4', http=http,
-                                  discoveryServiceUrl=discoveryUrl)
+# Location of the Google Sheets API discovery document
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+
+# Range of the key/value settings in the mapping tab
+MAPPING_RANGE = 'sheets2contacts!A2:B'
+
+class Sheets(ContactSource):
+    def __init__(self, credentials, sheet_id,
+                 discovery_ttl=discovery_cache.DISCOVERY_TTL,
+                 discovery_url=DISCOVERY_URL, stats=None, pool=None):
+        """
+        Reads contacts from a Google Sheet using the Sheets API
+        
+        If a Stats object is given, API calls are recorded in it
+        If a transport.HttpPool is given, requests are sent through it
+        """
+        ContactSource.__init__(self, sheet_id)
+        
+        http = credentials.authorize(transport.new_http(pool))
+        if(stats):
+            stats.instrument_http(http, "sheets")
+        self.sheets_service = discovery_cache.build('sheets', 'v4', http=http,
+                                  discoveryServiceUrl=discovery_url,
+                                  ttl=discovery_ttl)
                                   
         self.sheet_id = sheet_id
         self.log = logging.getLogger("sheets")
         
     #---------------------------------------------------------------------------
-    def fetch_sheet_data(self):
-        column_map, group_map = self.get_column_map()
-        column_data = self.get_column_data(column_map)
-        group_data = self.get_column_data(group_map)
-        Groups, People = self.elaborate_column_data(column_data, group_data)
-        return(Groups, People)
+    def fetch_column_data(self, sheet_map=None):
+        """
+        Fetch the mapped columns from the sheet
+        Returns (column_data, group_data)
+        
+        The column mapping used is stored in self.sheet_map. If it is passed
+        back in as sheet_map on a later fetch, the mapping tab, headings and
+        all columns are requested in a single batchGet. The columns are used
+        as long as the mapping tab and headings did not change. If that
+        request is rejected, for example because the tab was renamed, the
+        mapping is fetched from scratch instead.
+        Otherwise the mapping tab and headings are fetched first, followed by
+        all contact and group columns in one batchGet.
+        """
+        column_data = None
+        values = None
+        if(sheet_map):
+            # apiclient takes a while to import. Only do so when needed
+            from apiclient.errors import HttpError
+            ranges = [MAPPING_RANGE, sheet_map["sheet"] + "!1:1"]
+            ranges.extend(get_map_ranges(sheet_map))
+            try:
+                values = self.batch_get(ranges)
+            except HttpError as e:
+                # A range in a tab that no longer exists, e.g. because it was
+                # renamed, fails the whole request
+                if(e.resp.status != 400):
+                    raise
+                self.log.debug("Cached column mapping is invalid: %s" % e)
+        
+        if(values is not None):
+            mapping = columns_to_rows(values[0])
+            headings = columns_to_row(values[1])
+            
+            if((mapping == sheet_map["mapping"]) and (headings == sheet_map["headings"])):
+                self.log.debug("Column mapping is unchanged")
+                column_data, group_data = split_map_data(sheet_map, values[2:])
+            else:
+                self.log.debug("Column mapping changed")
+                sheet_name = self.parse_mapping(mapping)[0]
+                if(sheet_name != sheet_map["sheet"]):
+                    headings = None
+        else:
+            mapping = columns_to_rows(self.batch_get([MAPPING_RANGE])[0])
+            headings = None
+        
+        if(column_data is None):
+            sheet_name, kv_dict, group_columns = self.parse_mapping(mapping)
+            if(headings is None):
+                headings = columns_to_row(self.batch_get([sheet_name + "!1:1"])[0])
+            column_map, group_map = self.resolve_column_map(
+                sheet_name, kv_dict, group_columns, headings
+            )
+            sheet_map = {
+                "sheet": sheet_name,
+                "mapping": mapping,
+                "headings": headings,
+                "column_map": column_map,
+                "group_map": group_map
+            }
+            values = self.batch_get(get_map_ranges(sheet_map))
+            column_data, group_data = split_map_data(sheet_map, values)
+        
+        self.sheet_map = sheet_map
+        self.fingerprint = get_fingerprint(column_data, group_data)
+        return(column_data, group_data)
+    
     #---------------------------------------------------------------------------
     def get_column_map(self):
         """
         Lookup the Google Sheet's mapping tab and fetch the settings
         """
-        valid_keys = [
-            "sheet",
-            "first_name",
-            "last_name",
-            "nickname",
-            "email",
-            "phone",
-            "groups",
-            "group_columns"
-        ]
-        
-        rangeName = 'sheets2contacts!A2:B'
-        result = self.sheets_service.spreadsheets().values().get(
-            spreadsheetId=self.sheet_id, range=rangeName).execute()
-        values = result.get('values', [])
-        
-        # convert to dict
-        kv_dict = {}
-        for row in values:
-            kv_dict[row[0].strip()] = row[1].strip()
-        
-        # Sanitize dict to only contain valid keys
-        bad_keys = set(kv_dict) - set(valid_keys)
-        for bad_key in bad_keys:
-            self.log.warning("Ignoring key: %s" % bad_key)
-            del(kv_dict[bad_key])
-        
-        # Extract sheet name from dict
-        if("sheet" not in kv_dict):
-            self.log.error("sheet2contacts tab is missing required key: sheet")
-            sys.exit(1)
-        sheet_name = kv_dict['sheet']
-        del(kv_dict['sheet'])
-        self.log.debug("Got sheet name: %s" % sheet_name)
-        
-        # if group_columns is used, extract that
-        group_columns = kv_dict.get("group_columns", "")
-        del(kv_dict['group_columns'])
-        group_columns = re.split(r'[,;]', group_columns)
+        mapping = columns_to_rows(self.batch_get([MAPPING_RANGE])[0])
+        sheet_name, kv_dict, group_columns = self.parse_mapping(mapping)
         
         # Fetch sheet headings
-        rangeName = sheet_name + "!1:1"
-        result = self.sheets_service.spreadsheets().values().get(
-            spreadsheetId=self.sheet_id, range=rangeName).execute()
-        headings = result.get('values', [])[0]
+        headings = columns_to_row(self.batch_get([sheet_name + "!1:1"])[0])
+        
+        return(self.resolve_column_map(sheet_name, kv_dict, group_columns, headings))
+    
+    #---------------------------------------------------------------------------
+    def resolve_column_map(self, sheet_name, kv_dict, group_columns, headings):
+        """
+        Resolve the column headings used by the mapping tab into ranges
+        Returns (column_map, group_map)
+        """
+        column_map = {}
         
         # Resolve headings in kv_dict
         self.log.debug("Resolving column mappings...")
@@ -86,13 +133,12 @@ class Sheets:
                 self.log.error("Heading '%s' not found for key: %s" % (v, k))
                 sys.exit(1)
             column = idx2col(headings.index(v))
-            kv_dict[k] = "%s!%s2:%s" % (sheet_name, column, column)
-            self.log.debug("  %s: %s --> %s" % (k,v,kv_dict[k]))
+            column_map[k] = "%s!%s2:%s" % (sheet_name, column, column)
+            self.log.debug("  %s: %s --> %s" % (k,v,column_map[k]))
         
         # Resolve group_columns into group_map
         group_map = {}
         for gc in group_columns:
-            gc = gc.strip()
             if(gc not in headings):
                 self.log.error("Group '%s' not found in headings" % (gc))
                 sys.exit(1)
@@ -100,7 +146,7 @@ class Sheets:
             group_map[gc] = "%s!%s2:%s" % (sheet_name, column, column)
             self.log.debug("  %s --> %s" % (gc,group_map[gc]))
         
-        return(kv_dict, group_map)
+        return(column_map, group_map)
         
     #---------------------------------------------------------------------------
     def get_column_data(self, column_map):
@@ -115,125 +161,100 @@ class Sheets:
             keys.append(k)
             ranges.append(v)
         
-        ranges = column_map.values()
-        result = self.sheets_service.spreadsheets().values().batchGet(
-            spreadsheetId=self.sheet_id,
-            ranges=ranges,
-            majorDimension="COLUMNS",
-            fields="valueRanges/values"
-        ).execute()
-        valueRanges = result.get('valueRanges', [])
+        values = self.batch_get(ranges)
         
         column_data = {}
         for i, key in enumerate(keys):
-            v = valueRanges[i].get('values', [[]])
-            column_data[key] = v[0]
+            column_data[key] = first_column(values[i])
         
         return(column_data)
     
     #---------------------------------------------------------------------------
-    def get_bool(self, value):
-        def RepresentsInt(s):
-            try: 
-                int(s)
-                return True
-            except ValueError:
-                return False
-        
-        if((type(value) is int) or (RepresentsInt(value))):
-            return(bool(int(value)))
-        elif(type(value) in [str, unicode]):
-            return(value.lower() in ["t", "true", "y", "yes"])
-        else:
-            self.log.error("Internal error: type=%s" % type(value).__name__)
-            sys.exit(1)
-        
-    #---------------------------------------------------------------------------
-    def elaborate_column_data(self, column_data, group_data):
+    def batch_get(self, ranges):
         """
-        converts the column_data into Person and Group lists
+        Fetch multiple ranges in one request.
+        Returns the values of each range as a list of columns
         """
+        result = self.sheets_service.spreadsheets().values().batchGet(
+            spreadsheetId=self.sheet_id,
+            ranges=ranges,
+            majorDimension="COLUMNS",
+            fields="valueRanges/values"
+        ).execute()
+        valueRanges = result.get('valueRanges', [])
         
-        # normalize group_data to bool. Delete any that are all false
-        new_group_data = {}
-        for k in group_data.keys():
-            has_members = False
-            for i,cell in enumerate(group_data[k]):
-                group_data[k][i] = self.get_bool(group_data[k][i])
-                has_members |= group_data[k][i]
-            
-            if(has_members):
-                new_group_data[k] = group_data[k]
-        group_data = new_group_data
-        
-        Groups = []
-        People = []
-        
-        # Collect all the groups that exist
-        group_names = set()
-        group_rows = column_data.get('groups', [])
-        for row in group_rows:
-            group_names |= set(re.split(r'[,;]', row))
-        group_names |= set(group_data.keys())
-        
-        # Convert groups into Group objects
-        # also store into a dict for convenience
-        groups_dict = {}
-        for group_name in group_names:
-            group_name = group_name.strip()
-            if(len(group_name) == 0): continue
-            G = contact_defs.Group(group_name)
-            Groups.append(G)
-            groups_dict[group_name] = G
-        self.log.debug("Received %d unique groups" % len(Groups))
-            
-        # Determine number of people (the largest dimension in the table)
-        n_people = 0
-        for v in column_data.values():
-            n_people = max(n_people, len(v))
-        self.log.debug("Received %d contact entries" % n_people)
-        
-        # Convert column_data into People objects
-        for i in range(n_people):
-            P = contact_defs.Person()
-            P.first_name = self.get_cell(column_data, "first_name",i)
-            P.last_name = self.get_cell(column_data, "last_name",i)
-            P.nickname = self.get_cell(column_data, "nickname",i)
-            P.email = self.get_cell(column_data, "email",i)
-            P.phone = self.get_cell(column_data, "phone",i)
-            
-            # Determine group membership
-            groups_str = self.get_cell(column_data, "groups",i)
-            if(groups_str != None):
-                group_names = set(re.split(r'[,;]', groups_str))
-                for group_name in group_names:
-                    group_name = group_name.strip()
-                    if(len(group_name) == 0): continue
-                    P.groups.append(groups_dict[group_name])
-            for group_name in group_data.keys():
-                is_member = self.get_cell(group_data, group_name, i, False)
-                if(is_member):
-                    P.groups.append(groups_dict[group_name])
-            
-            People.append(P)
-        return(Groups, People)
-            
-    def get_cell(self, column_data, col, idx, default=None):
-        """
-        Fetch a single cell from column_data
-        """
-        column = column_data.get(col, [])
-        if(idx >= len(column)):
-            return(default)
-        else:
-            cell = column[idx]
-            if((type(cell) == str) or (type(cell) == unicode)):
-                cell = cell.strip()
-                if(cell == ""):
-                    return(None)
-            return(cell)
+        values = []
+        for i in range(len(ranges)):
+            if(i < len(valueRanges)):
+                values.append(valueRanges[i].get('values', []))
+            else:
+                values.append([])
+        return(values)
     
     
+def get_map_ranges(sheet_map):
+    """
+    Get the ranges of all contact columns followed by all group columns in a
+    sheet map
+    """
+    ranges = []
+    for k in sorted(sheet_map["column_map"]):
+        ranges.append(sheet_map["column_map"][k])
+    for k in sorted(sheet_map["group_map"]):
+        ranges.append(sheet_map["group_map"][k])
+    return(ranges)
+
+def split_map_data(sheet_map, values):
+    """
+    Split values fetched using the ranges from get_map_ranges() into
+    column_data and group_data dicts
+    """
+    column_keys = sorted(sheet_map["column_map"])
+    group_keys = sorted(sheet_map["group_map"])
+    column_data = {}
+    for i, key in enumerate(column_keys):
+        column_data[key] = first_column(values[i])
+    group_data = {}
+    for i, key in enumerate(group_keys):
+        group_data[key] = first_column(values[len(column_keys) + i])
+    return(column_data, group_data)
+
+def first_column(columns):
+    if(len(columns)):
+        return(columns[0])
+    return([])
+
+def columns_to_rows(columns):
+    """
+    Transpose a list of columns into a list of rows.
+    Short columns are padded with empty cells
+    """
+    n_rows = 0
+    for column in columns:
+        n_rows = max(n_rows, len(column))
+    rows = []
+    for i in range(n_rows):
+        row = []
+        for column in columns:
+            if(i < len(column)):
+                row.append(column[i])
+            else:
+                row.append("")
+        rows.append(row)
+    return(rows)
+
+def columns_to_row(columns):
+    """
+    Convert a single row range fetched as columns into a list of cells
+    """
+    row = []
+    for column in columns:
+        if(len(column)):
+            row.append(column[0])
+        else:
+            row.append("")
+    return(row)
+
 def idx2col(idx):
     """
     Convert an index to a column heading code
@@ -0,0 +1,99 @@
+import logging
+from collections import deque
+
+# register logger
+logging.getLogger("reconcile")
+
+class Reconciliation:
+    def __init__(self):
+        # People from the sheet that do not exist in Google Contacts yet
+        self.create = []
+        
+        # Existing contacts that were updated with data from the sheet
+        self.update = []
+        
+        # Existing contacts that no longer appear in the sheet
+        self.delete = []
+        
+        # Number of existing contacts that matched a person in the sheet
+        self.matched = 0
+
+#===============================================================================
+def person_key(P):
+    """
+    Key used to match a person in the sheet with an existing contact
+    """
+    return((P.first_name, P.last_name))
+
+#-------------------------------------------------------------------------------
+def reconcile(sPeople, cPeople, use_hash=True, registry=None):
+    """
+    Determine which contacts need to be created, updated or deleted so that
+    the existing contacts (cPeople) match the people in the sheet (sPeople).
+    
+    Existing contacts are matched to people in the sheet by first and last
+    name, and matches are updated using Person.update(). registry is the
+    GroupRegistry the group masks of both sides came from, if any.
+    
+    If use_hash is set, a match whose sync_hash equals the fingerprint of the
+    person in the sheet is considered current without comparing each field.
+    Changes made to those fields directly in Google Contacts are then not
+    reverted until the person changes in the sheet. Matches whose sync_hash
+    differs are updated even if no field changed, to store the current hash.
+    
+    If the same name appears more than once, matches are paired up in the
+    order they appear on each side: The first contact with that name is
+    matched with the first person in the sheet with that name, and so on.
+    Unpaired duplicates are created or deleted.
+    
+    The sheet side is indexed in one pass and cPeople is only iterated once,
+    so it may be any iterable.
+    
+    Returns a Reconciliation object
+    """
+    log = logging.getLogger("reconcile")
+    R = Reconciliation()
+    
+    # Index people from the sheet by name
+    index = {}
+    for P in sPeople:
+        P.sync_hash = P.fingerprint()
+        k = person_key(P)
+        if(k in index):
+            index[k].append(P)
+        else:
+            index[k] = deque([P])
+    
+    matched = set()
+    for cP in cPeople:
+        candidates = index.get(person_key(cP))
+        if(candidates):
+            # Found match! Update
+            P = candidates.popleft()
+            matched.add(id(P))
+            R.matched += 1
+            if(use_hash and (cP.sync_hash == P.sync_hash)):
+                continue
+            if(cP.update(P, registry)):
+                log.debug("Need to update: '%s %s'" % (cP.first_name, cP.last_name))
+            elif(cP.sync_hash != P.sync_hash):
+                # Already up to date, but without the current hash, e.g. if
+                # it was synced before hashes were stored. Store it, so the
+                # next sync can skip the comparison
+                log.debug("Need to store sync hash: '%s %s'" % (cP.first_name, cP.last_name))
+            else:
+                continue
+            cP.sync_hash = P.sync_hash
+            R.update.append(cP)
+        else:
+            # Contact is not in the sheet
+            log.debug("Need to delete: '%s %s'" % (cP.first_name, cP.last_name))
+            R.delete.append(cP)
+    
+    # Anyone in the sheet that was not matched needs to be created
+    for P in sPeople:
+        if(id(P) not in matched):
+            log.debug("Need to create: '%s %s'" % (P.first_name, P.last_name))
+            R.create.append(P)
+    
+    return(R)
@@ -0,0 +1,177 @@
+import time
+import logging
+
+from . import contact_defs
+from . import cache
+
+# register logger
+logging.getLogger("snapshot")
+
+# Bump this if the layout of the snapshot file changes
+SNAPSHOT_VERSION = 2
+
+class Snapshot:
+    """
+    Local copy of the synced contacts in a Google account, as of the last run.
+    
+    Stores enough of each contact to reconcile it against the sheet, so that
+    later runs only need to fetch the contacts that changed since then.
+    """
+    def __init__(self, email):
+        self.path = cache.get_cache_path("snapshot.%s.json" % email)
+        self.email = email
+        
+        # ID of the "Synced with sheets2contacts" group
+        self.group_id = None
+        
+        # Server timestamp of the contacts feed when the snapshot was taken
+        self.updated = None
+        
+        # Local time when the snapshot was saved
+        self.saved = None
+        
+        # Snapshot records, keyed by contact entry ID
+        self.records = {}
+        
+        self.log = logging.getLogger("snapshot")
+    
+    #---------------------------------------------------------------------------
+    def load(self, group_id, max_age):
+        """
+        Load the snapshot from disk
+        Returns False if the snapshot does not exist, is corrupt, belongs to a
+        different sync group or is older than max_age seconds.
+        """
+        data = cache.load_json(self.path)
+        if(data is None):
+            self.log.debug("No usable snapshot at %s" % self.path)
+            return(False)
+        
+        try:
+            if(data["version"] != SNAPSHOT_VERSION):
+                self.log.debug("Snapshot version mismatch")
+                return(False)
+            if(data["email"] != self.email):
+                self.log.debug("Snapshot belongs to a different account")
+                return(False)
+            if(data["group_id"] != group_id):
+                self.log.debug("Snapshot belongs to a different sync group")
+                return(False)
+            if(time.time() - data["saved"] > max_age):
+                self.log.debug("Snapshot is stale")
+                return(False)
+            
+            records = {}
+            for rec in data["records"]:
+                records[rec["id"]] = rec
+            
+            self.updated = data["updated"]
+            self.saved = data["saved"]
+        except (KeyError, TypeError):
+            self.log.debug("Snapshot is corrupt")
+            return(False)
+        
+        self.group_id = group_id
+        self.records = records
+        return(True)
+    
+    #---------------------------------------------------------------------------
+    def save(self, updated):
+        """
+        Save the snapshot to disk
+        updated is the server timestamp that the next run will fetch changes
+        from
+        """
+        self.updated = updated
+        self.saved = time.time()
+        data = {
+            "version": SNAPSHOT_VERSION,
+            "email": self.email,
+            "group_id": self.group_id,
+            "updated": self.updated,
+            "saved": self.saved,
+            "records": list(self.records.values())
+        }
+        cache.save_json(self.path, data)
+    
+    #---------------------------------------------------------------------------
+    def clear(self, group_id):
+        """
+        Start a new, empty snapshot
+        """
+        self.group_id = group_id
+        self.updated = None
+        self.records = {}
+    
+    #---------------------------------------------------------------------------
+    def record(self, P):
+        """
+        Store a person fetched from Google Contacts in the snapshot
+        """
+        if(P._group_hrefs):
+            group_hrefs = list(P._group_hrefs)
+        else:
+            group_hrefs = [G.entry.id.text for G in P.groups if G.entry]
+        
+        self.records[P.entry_id] = {
+            "id": P.entry_id,
+            "etag": P.etag,
+            "first_name": P.first_name,
+            "last_name": P.last_name,
+            "nickname": P.nickname,
+            "email": P.email,
+            "phone": P.phone,
+            "sync_hash": P.sync_hash,
+            "groups": group_hrefs
+        }
+    
+    #---------------------------------------------------------------------------
+    def record_people(self, People):
+        """
+        Record each person in People as they are iterated
+        """
+        for P in People:
+            self.record(P)
+            yield P
+    
+    #---------------------------------------------------------------------------
+    def apply_changes(self, People):
+        """
+        Merge contacts that changed since the snapshot was taken.
+        Contacts that were deleted, or are no longer in the sync group, are
+        dropped from the snapshot.
+        Returns the number of changes applied
+        """
+        n_changes = 0
+        for P in People:
+            n_changes += 1
+            if(P.deleted or (self.group_id not in P._group_hrefs)):
+                self.records.pop(P.entry_id, None)
+            else:
+                self.record(P)
+        return(n_changes)
+    
+    #---------------------------------------------------------------------------
+    def iter_people(self, Groups):
+        """
+        Yields Person objects for each contact in the snapshot.
+        Their group references are resolved using Groups.
+        These people do not have a contact entry, only its ID and etag.
+        """
+        for entry_id in sorted(self.records):
+            rec = self.records[entry_id]
+            P = contact_defs.Person()
+            P.entry_id = rec["id"]
+            P.etag = rec["etag"]
+            P.first_name = rec["first_name"]
+            P.last_name = rec["last_name"]
+            P.nickname = rec["nickname"]
+            P.email = rec["email"]
+            P.phone = rec["phone"]
+            P.sync_hash = rec["sync_hash"]
+            for href in rec["groups"]:
+                G = Groups.get_by_id(href)
+                if(G):
+                    P.groups.append(G)
+            P.group_mask = Groups.mask(P.groups)
+            yield P
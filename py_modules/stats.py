@@ -0,0 +1,230 @@
+import time
+import json
+import logging
+import threading
+
+# register logger
+logging.getLogger("stats")
+
+class Stats:
+    """
+    Collects the time spent in each phase of a sync, and the number of API
+    calls, their latency and payload sizes.
+    
+    API calls are recorded against the phase that is active when they are
+    made. Calls can be recorded from multiple threads.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        
+        # List of phases, in the order they started
+        self.phases = []
+        self.current = None
+        
+        # API call totals, keyed by API name
+        self.api = {}
+        
+        # Arbitrary values to include in the report
+        self.result = {}
+        
+        self.total_seconds = None
+        
+        # Connection reuse statistics of the HTTP transport
+        self.transport = None
+        
+        self.log = logging.getLogger("stats")
+    
+    #---------------------------------------------------------------------------
+    def reset(self):
+        """
+        Clear all statistics, to start collecting them for another sync.
+        Instrumented clients keep recording into this object.
+        """
+        with self.lock:
+            self.started = time.time()
+            self.phases = []
+            self.current = None
+            self.api = {}
+            self.result = {}
+            self.total_seconds = None
+    
+    #---------------------------------------------------------------------------
+    def phase(self, name):
+        """
+        End the current phase, if any, and start a new one
+        """
+        now = time.time()
+        with self.lock:
+            if(self.current):
+                self.current["seconds"] = now - self.current["started"]
+            self.current = {
+                "name": name,
+                "started": now,
+                "seconds": None,
+                "api": {}
+            }
+            self.phases.append(self.current)
+    
+    #---------------------------------------------------------------------------
+    def finish(self):
+        """
+        End the current phase
+        """
+        now = time.time()
+        with self.lock:
+            if(self.current):
+                self.current["seconds"] = now - self.current["started"]
+            self.current = None
+        self.total_seconds = now - self.started
+    
+    #---------------------------------------------------------------------------
+    def record_call(self, api, seconds, bytes_sent=0, bytes_received=0, error=False):
+        """
+        Record a single API call
+        Returns the phase the call was recorded against
+        """
+        with self.lock:
+            phase = self.current
+            totals = [self.api]
+            if(phase):
+                totals.append(phase["api"])
+            for t in totals:
+                c = t.get(api)
+                if(c is None):
+                    c = t[api] = {
+                        "calls": 0,
+                        "errors": 0,
+                        "seconds": 0.0,
+                        "bytes_sent": 0,
+                        "bytes_received": 0
+                    }
+                c["calls"] += 1
+                c["seconds"] += seconds
+                c["bytes_sent"] += bytes_sent
+                c["bytes_received"] += bytes_received
+                if(error):
+                    c["errors"] += 1
+        return(phase)
+    
+    #---------------------------------------------------------------------------
+    def record_bytes_received(self, api, phase, n):
+        """
+        Add to the bytes received by a call that was already recorded.
+        Used for responses that are read after the call returned.
+        """
+        with self.lock:
+            self.api[api]["bytes_received"] += n
+            if(phase):
+                phase["api"][api]["bytes_received"] += n
+    
+    #---------------------------------------------------------------------------
+    def report(self):
+        """
+        Returns the statistics as a JSON-serializable dict
+        """
+        with self.lock:
+            phases = []
+            for p in self.phases:
+                phases.append({
+                    "name": p["name"],
+                    "seconds": p["seconds"],
+                    "api": p["api"]
+                })
+            return({
+                "started": self.started,
+                "seconds": self.total_seconds,
+                "phases": phases,
+                "api": self.api,
+                "result": self.result,
+                "transport": self.transport
+            })
+    
+    #---------------------------------------------------------------------------
+    def save(self, path):
+        """
+        Write the JSON report to a file
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+    
+    #---------------------------------------------------------------------------
+    def log_summary(self):
+        """
+        Log the time and API calls of each phase at debug level
+        """
+        for p in self.report()["phases"]:
+            calls = sum(c["calls"] for c in p["api"].values())
+            self.log.debug("%-16s %8.3fs %5d API calls" % (p["name"], p["seconds"] or 0, calls))
+        if(self.transport):
+            self.log.debug("HTTP connections opened: %d, reused: %d" % (
+                self.transport["connections_opened"],
+                self.transport["connections_reused"]
+            ))
+    
+    #---------------------------------------------------------------------------
+    def instrument_http(self, http, api):
+        """
+        Record each request made by an httplib2.Http object, as used by the
+        Google API client libraries.
+        Must be applied after the Http object is authorized, so that token
+        refreshes are counted as part of the request.
+        """
+        request_orig = http.request
+        def request(uri, method="GET", body=None, *args, **kwargs):
+            t_start = time.time()
+            error = True
+            content = ""
+            try:
+                resp, content = request_orig(uri, method, body, *args, **kwargs)
+                error = (resp.status >= 400)
+                return(resp, content)
+            finally:
+                self.record_call(api, time.time() - t_start,
+                                 len(body or ""), len(content or ""), error)
+        http.request = request
+        return(http)
+    
+    #---------------------------------------------------------------------------
+    def instrument_gdata(self, client, api_for_uri):
+        """
+        Record each request made by a gdata client.
+        api_for_uri(uri) returns the API name to record a request as.
+        
+        The response body is read by gdata after the request returns, so the
+        received bytes are counted as the response is read.
+        """
+        request_orig = client.http_client.request
+        def request(http_request):
+            api = api_for_uri(http_request.uri)
+            t_start = time.time()
+            error = True
+            response = None
+            try:
+                response = request_orig(http_request)
+                error = (response.status >= 400)
+            finally:
+                phase = self.record_call(api, time.time() - t_start,
+                    int(http_request.headers.get('Content-Length', 0)), 0, error)
+            return(CountingResponse(response, self, api, phase))
+        client.http_client.request = request
+        return(client)
+
+#===============================================================================
+class CountingResponse(object):
+    """
+    Wraps an HTTP response to count the bytes read from it
+    """
+    def __init__(self, response, stats, api, phase):
+        self._response = response
+        self._stats = stats
+        self._api = api
+        self._phase = phase
+    
+    def read(self, *args):
+        data = self._response.read(*args)
+        self._stats.record_bytes_received(self._api, self._phase, len(data))
+        return(data)
+    
+    def __getattr__(self, name):
+        return(getattr(self._response, name))
@@ -0,0 +1,75 @@
+import time
+import logging
+
+from . import cache
+
+# register logger
+logging.getLogger("sync_state")
+
+class SyncState:
+    """
+    Record of the last successful sync of a sheet into a Google account
+    source_id identifies the sheet, or other contact source
+    """
+    def __init__(self, source_id, email):
+        self.path = cache.get_cache_path("state.%s.%s.json" % (source_id, email))
+        
+        # Fingerprint of the sheet data that was synced
+        self.fingerprint = None
+        
+        # Server timestamp of the contacts feed when the sync was done
+        self.updated = None
+        
+        # Local time of the sync
+        self.synced = None
+        
+        # Number of contacts created, updated and deleted by the sync
+        self.result = None
+        
+        # Column mapping of the sheet. See Sheets.fetch_column_data()
+        self.sheet_map = None
+        
+        self.log = logging.getLogger("sync_state")
+    
+    #---------------------------------------------------------------------------
+    def load(self):
+        """
+        Load the state from disk
+        Returns False if it does not exist or is corrupt
+        """
+        data = cache.load_json(self.path)
+        if(data is None):
+            return(False)
+        
+        try:
+            fingerprint = data["fingerprint"]
+            updated = data["updated"]
+            synced = data["synced"]
+            result = data["result"]
+            sheet_map = data.get("sheet_map")
+        except (KeyError, TypeError, AttributeError):
+            self.log.debug("Sync state is corrupt")
+            return(False)
+        
+        self.fingerprint = fingerprint
+        self.updated = updated
+        self.synced = synced
+        self.result = result
+        self.sheet_map = sheet_map
+        return(True)
+    
+    #---------------------------------------------------------------------------
+    def save(self, fingerprint, updated, result, sheet_map=None):
+        self.fingerprint = fingerprint
+        self.updated = updated
+        self.synced = time.time()
+        self.result = result
+        self.sheet_map = sheet_map
+        data = {
+            "fingerprint": self.fingerprint,
+            "updated": self.updated,
+            "synced": self.synced,
+            "result": self.result,
+            "sheet_map": self.sheet_map
+        }
+        cache.save_json(self.path, data)
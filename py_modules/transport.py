@@ -0,0 +1,214 @@
+import logging
+import threading
+
+# httplib and httplib2 are only imported once the first request is made, to
+# keep startup fast
+
+# register logger
+logging.getLogger("transport")
+
+# Same as httplib2.DEFAULT_MAX_REDIRECTS
+DEFAULT_MAX_REDIRECTS = 5
+
+class HttpPool:
+    """
+    Pool of keep-alive HTTP connections, shared by all API clients.
+    
+    httplib2.Http keeps connections open between requests, but is not safe
+    to use from multiple threads. The pool hands each request an Http object
+    that no other thread is using, and puts it back for reuse afterwards.
+    Requests made one after another therefore reuse the same connections,
+    and concurrent requests get as many connections as they need.
+    
+    Use client() to get an httplib2-compatible object for the Google API
+    client library, and gdata_client() for gdata clients.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = []
+        self.n_http = 0
+        
+        self.requests = 0
+        self.connections_opened = 0
+        
+        self.log = logging.getLogger("transport")
+    
+    #---------------------------------------------------------------------------
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=DEFAULT_MAX_REDIRECTS, connection_type=None):
+        """
+        Same as httplib2.Http.request()
+        """
+        http = self._acquire()
+        try:
+            before = connection_state(http)
+            return(http.request(uri, method, body, headers, redirections, connection_type))
+        finally:
+            after = connection_state(http)
+            n_opened = 0
+            for k, (conn, sock) in after.items():
+                if((sock is not None) and (before.get(k) != (conn, sock))):
+                    n_opened += 1
+            with self.lock:
+                self.requests += 1
+                self.connections_opened += n_opened
+            self._release(http)
+    
+    #---------------------------------------------------------------------------
+    def _acquire(self):
+        with self.lock:
+            if(self.idle):
+                return(self.idle.pop())
+            self.n_http += 1
+            self.log.debug("Adding connection set %d to the pool" % self.n_http)
+        import httplib2
+        return(httplib2.Http(timeout=self.timeout))
+    
+    def _release(self, http):
+        with self.lock:
+            self.idle.append(http)
+    
+    #---------------------------------------------------------------------------
+    def client(self):
+        """
+        Get an object that can be used in place of an httplib2.Http object,
+        and sends its requests through the pool.
+        Each client can be authorized separately.
+        """
+        return(PooledHttp(self))
+    
+    def gdata_client(self):
+        """
+        Get an object that can be used as the http_client of a gdata client
+        """
+        return(GDataHttpClient(self))
+    
+    #---------------------------------------------------------------------------
+    def get_stats(self):
+        """
+        Returns the number of requests made and connections opened
+        """
+        with self.lock:
+            return({
+                "requests": self.requests,
+                "connections_opened": self.connections_opened,
+                "connections_reused": self.requests - self.connections_opened,
+                "http_objects": self.n_http
+            })
+    
+    #---------------------------------------------------------------------------
+    def close(self):
+        """
+        Close all idle connections
+        """
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for http in idle:
+            for conn in http.connections.values():
+                conn.close()
+
+#===============================================================================
+class PooledHttp(object):
+    """
+    Stand-in for httplib2.Http that sends requests through an HttpPool
+    """
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def request(self, uri, method="GET", body=None, headers=None,
+                redirections=DEFAULT_MAX_REDIRECTS, connection_type=None):
+        return(self.pool.request(uri, method, body, headers, redirections, connection_type))
+
+#===============================================================================
+class GDataHttpClient(object):
+    """
+    Stand-in for atom.http_core.HttpClient that sends requests through an
+    HttpPool.
+    The default gdata client opens a new connection for every request.
+    """
+    debug = False
+    
+    def __init__(self, pool):
+        self.pool = pool
+    
+    def request(self, http_request):
+        body = []
+        for part in http_request._body_parts:
+            if(isinstance(part, unicode)):
+                part = part.encode('utf-8')
+            elif(not isinstance(part, str)):
+                # File-like body part
+                part = part.read()
+            body.append(part)
+        
+        headers = {}
+        for k, v in http_request.headers.items():
+            headers[k] = str(v)
+        
+        resp, content = self.pool.request(
+            str(http_request.uri), http_request.method,
+            "".join(body) or None, headers
+        )
+        return(GDataResponse(resp, content))
+
+#-------------------------------------------------------------------------------
+class GDataResponse(object):
+    """
+    Presents an httplib2 response like the httplib response that gdata
+    expects
+    """
+    def __init__(self, resp, content):
+        self.status = resp.status
+        self.reason = resp.reason
+        self._resp = resp
+        self._content = content
+    
+    def read(self, amt=None):
+        if(amt is None):
+            data = self._content
+            self._content = ""
+        else:
+            data = self._content[:amt]
+            self._content = self._content[amt:]
+        return(data)
+    
+    def getheader(self, name, default=None):
+        return(self._resp.get(name.lower(), default))
+    
+    def getheaders(self):
+        # httplib2 adds some pseudo-headers of its own
+        return([(k, v) for k, v in self._resp.items()
+                if (k != 'status') and (not k.startswith('-'))])
+
+#===============================================================================
+def new_http(pool=None):
+    """
+    Get an Http object for a Google API client
+    Uses the pool if one is given
+    """
+    if(pool):
+        return(pool.client())
+    import httplib2
+    return(httplib2.Http())
+
+#-------------------------------------------------------------------------------
+def network_errors():
+    """
+    Exceptions raised when a request fails without a response
+    """
+    import httplib
+    import httplib2
+    return((IOError, httplib.HTTPException, httplib2.HttpLib2Error))
+
+#-------------------------------------------------------------------------------
+def connection_state(http):
+    """
+    Identify the connections, and their sockets, that an Http object holds.
+    A socket that differs between two states was opened in between.
+    """
+    state = {}
+    for k, conn in http.connections.items():
+        state[k] = (conn, conn.sock)
+    return(state)
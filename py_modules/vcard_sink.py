@@ -0,0 +1,99 @@
+import logging
+from .contact_sink import FileSink
+
+# register logger
+logging.getLogger("vcard")
+
+# vCard versions that can be written
+VCARD_VERSIONS = ["3.0", "4.0"]
+
+# Longest line allowed before folding, in octets (RFC 6350 section 3.2)
+MAX_LINE = 75
+
+class VCardSink(FileSink):
+    def __init__(self, path, version="3.0"):
+        """
+        Exports contacts to a vCard file, in vCard 3.0 (RFC 2426) or 4.0
+        (RFC 6350) format. Text is written as UTF-8.
+        
+        Groups are written as CATEGORIES, which is how most address books
+        import them
+        """
+        self.version = version
+        FileSink.__init__(self, path)
+        self.log = logging.getLogger("vcard")
+        self.open()
+    
+    #---------------------------------------------------------------------------
+    def write_person(self, P):
+        lines = ["BEGIN:VCARD", "VERSION:" + self.version]
+        if(self.version == "4.0"):
+            lines.append("KIND:individual")
+        
+        lines.append("FN:" + vcard_text(full_name(P)))
+        lines.append("N:%s;%s;;;" % (vcard_text(P.last_name), vcard_text(P.first_name)))
+        if(P.nickname):
+            lines.append("NICKNAME:" + vcard_text(P.nickname))
+        if(P.email):
+            if(self.version == "4.0"):
+                lines.append("EMAIL;TYPE=work:" + vcard_text(P.email))
+            else:
+                lines.append("EMAIL;TYPE=INTERNET,WORK:" + vcard_text(P.email))
+        if(P.phone):
+            if(self.version == "4.0"):
+                lines.append("TEL;TYPE=work;VALUE=text:" + vcard_text(P.phone))
+            else:
+                lines.append("TEL;TYPE=WORK:" + vcard_text(P.phone))
+        if(P.groups):
+            lines.append("CATEGORIES:" + ",".join(
+                vcard_text(G.name) for G in P.groups
+            ))
+        lines.append("END:VCARD")
+        
+        self.f.write("".join(fold_line(line) for line in lines))
+
+
+def full_name(P):
+    """
+    Formatted name of a person. vCards require one, so fall back on the
+    nickname, email or phone number if there is no name
+    """
+    name = " ".join(n for n in [P.first_name, P.last_name] if n)
+    return(name or P.nickname or P.email or P.phone or "")
+
+def vcard_text(s):
+    """
+    Escape a text value (RFC 6350 section 3.4)
+    """
+    if(s is None):
+        return(u"")
+    s = s.replace(u"\\", u"\\\\")
+    s = s.replace(u",", u"\\,").replace(u";", u"\\;")
+    s = s.replace(u"\r\n", u"\\n").replace(u"\n", u"\\n").replace(u"\r", u"\\n")
+    return(s)
+
+def fold_line(line):
+    """
+    Encode a content line as UTF-8, folded so no line is longer than
+    MAX_LINE octets. Multi-octet characters are never split.
+    Returns the folded line, including its CRLF
+    """
+    if(type(line) is unicode):
+        line = line.encode('utf-8')
+    if(len(line) <= MAX_LINE):
+        return(line + "\r\n")
+    
+    out = []
+    start = 0
+    width = MAX_LINE
+    while(len(line) - start > width):
+        end = start + width
+        # Back up to the start of a UTF-8 character
+        while((ord(line[end]) & 0xC0) == 0x80):
+            end -= 1
+        out.append(line[start:end])
+        start = end
+        # Continuation lines start with a space, which counts towards the limit
+        width = MAX_LINE - 1
+    out.append(line[start:])
+    return("\r\n ".join(out) + "\r\n")
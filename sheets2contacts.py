@@ -3,26 +3,108 @@
 import re
 import os
 import sys
+import time
 import logging
+import argparse
 
 from py_modules.app import App
 import py_modules.google_auth as g_auth
-from py_modules.google_contacts import Contacts
+from py_modules.google_contacts import Contacts, ChangesUnavailable
 from py_modules.google_sheets import Sheets
+from py_modules.google_people import People
+from py_modules import google_contacts
+from py_modules import google_sheets
 import py_modules.contact_defs as cd
+from py_modules.reconcile import reconcile
+from py_modules.snapshot import Snapshot
+from py_modules.sync_state import SyncState
+from py_modules.stats import Stats
+from py_modules.transport import HttpPool
+from py_modules.batch import RetryPolicy, Background, prefetch
+
+# --export-format choices, and the file extensions that select them by default
+EXPORT_FORMATS = ["vcard3", "vcard4", "csv"]
+EXPORT_EXTENSIONS = {
+    ".vcf": "vcard3",
+    ".vcard": "vcard3",
+    ".csv": "csv",
+    ".tsv": "csv",
+    ".tab": "csv",
+}
 
 class sheets2contacts(App):
+    def __init__(self):
+        App.__init__(self)
+        
+        # Clients are kept across syncs in --watch mode
+        self.sheets = None
+        self.contacts = None
+        self.stats = None
+        
+        # Keep-alive connections shared by all API clients
+        self.pool = HttpPool()
+        
+    #---------------------------------------------------------------------------
     def set_cmdline_args(self, parser):
         App.set_cmdline_args(self, parser)
         parser.description = "Synchronize Gmail contacts with a Google Sheet"
         
         parser.add_argument('--sheet', dest='sheet_id', default=None,
                             help='Google Sheet ID or URL')
+        parser.add_argument('--csv', dest='csv_path', default=None,
+                            help='Sync from a local CSV or TSV file instead of a Google Sheet. Needs --mapping')
+        parser.add_argument('--mapping', dest='mapping_path', default=None,
+                            help='CSV or TSV file with the column mapping for --csv, laid out like the sheets2contacts tab')
         parser.add_argument('--email', dest='email', default=None,
                             help='Email of existing stored credentials to sync to')
+        parser.add_argument('--export', dest='export_path', default=None,
+                            help='Export the contacts to this file instead of syncing them to Google Contacts. Use - for stdout')
+        parser.add_argument('--export-format', dest='export_format', default=None,
+                            choices=EXPORT_FORMATS,
+                            help='Format of the --export file. By default, guessed from its extension, or vcard3 for stdout')
         parser.add_argument('-n --dry-run', dest='dry_run', default=False,
                             action="store_true",
                             help='Google Sheet ID or URL')
+        parser.add_argument('--fetch-workers', dest='fetch_workers', default=1,
+                            type=int,
+                            help='Number of contact feed pages to fetch concurrently')
+        parser.add_argument('--batch-workers', dest='batch_workers', default=1,
+                            type=int,
+                            help='Number of batch requests to submit concurrently')
+        parser.add_argument('--batch-retries', dest='batch_retries', default=4,
+                            type=int,
+                            help='Number of times to retry contacts and groups that failed to be submitted (default: %(default)s)')
+        parser.add_argument('--full-refresh', dest='full_refresh', default=False,
+                            action="store_true",
+                            help='Fetch all contacts instead of only the ones that changed since the last run')
+        parser.add_argument('--snapshot-max-age', dest='snapshot_max_age', default=168,
+                            type=float,
+                            help='Do a full refresh if the last run was more than this many hours ago (default: %(default)s)')
+        parser.add_argument('-f', '--force', dest='force', default=False,
+                            action="store_true",
+                            help='Sync even if nothing changed since the last sync')
+        parser.add_argument('--discovery-ttl', dest='discovery_ttl', default=24,
+                            type=float,
+                            help='Hours to use cached Google API discovery documents for (default: %(default)s)')
+        parser.add_argument('--full-diff', dest='full_diff', default=False,
+                            action="store_true",
+                            help='Compare every field of existing contacts, even if their stored sync hash matches the sheet')
+        parser.add_argument('--api-root', dest='api_root', default=None,
+                            help=argparse.SUPPRESS)
+        parser.add_argument('--keep-entries', dest='keep_entries', default=False,
+                            action="store_true",
+                            help='Fetch full contact entries and keep them in memory, so contacts are not fetched again before being updated or deleted. Slower, and uses more memory')
+        parser.add_argument('--stats', dest='stats_path', default=None,
+                            help='Write a JSON report of the time and API calls spent in each phase of the sync to this file')
+        parser.add_argument('--watch', dest='watch', default=False,
+                            action="store_true",
+                            help='Keep running, and sync again whenever the sheet or the contacts change')
+        parser.add_argument('--poll-interval', dest='poll_interval', default=30,
+                            type=float,
+                            help='Seconds between checks for changes in --watch mode (default: %(default)s)')
+        parser.add_argument('--max-poll-interval', dest='max_poll_interval', default=600,
+                            type=float,
+                            help='Checks back off up to this many seconds while nothing changes (default: %(default)s)')
         
         g_auth.add_oauth2client_args(parser)
         
@@ -34,80 +116,118 @@ class sheets2contacts(App):
         #-----------------------------------------------------------------------
         # Determine which sheet to sync to
         #-----------------------------------------------------------------------
+        if(self.options.csv_path and not self.options.mapping_path):
+            self.log.error("--csv needs a --mapping file")
+            sys.exit(1)
+        
         # If no sheet specified, ask
-        if(self.options.sheet_id == None):
+        if((self.options.sheet_id == None) and (self.options.csv_path == None)):
             print("Enter the Google Sheets URL to sync from:")
             self.options.sheet_id = raw_input('> ')
         
-        # Sanitize sheet ID URL
-        m = re.search(r'docs.google.com\/spreadsheets\/d\/([^\/]+)\/', self.options.sheet_id)
-        if(m):
-            # --sheet option is a URL. Extract
-            self.options.sheet_id = m.group(1)
+        if(self.options.export_path):
+            if(self.options.watch):
+                self.log.error("--watch can't be used with --export")
+                sys.exit(1)
+            if(self.options.export_format == None):
+                self.options.export_format = get_export_format(self.options.export_path)
+            if(self.options.export_format == None):
+                self.log.error("Can't tell the format of %s. Use --export-format" % self.options.export_path)
+                sys.exit(1)
+        
+        # Exporting a CSV file needs no Google account at all
+        if(self.options.export_path and self.options.csv_path):
+            credentials = None
+        else:
+            credentials = self.get_credentials()
+        if(self.options.watch):
+            self.watch(credentials)
+        else:
+            result = self.sync(credentials)
+            if(result.get("failed")):
+                sys.exit(1)
+    
+    #---------------------------------------------------------------------------
+    def sync(self, credentials):
+        """
+        Sync the sheet, or CSV file, in self.options to the Google account of
+        credentials
+        Returns the result of the sync, as recorded in self.stats.result
+        
+        The contact source (Sheets or CsvSource) and the Contacts client are
+        kept in self.sheets and self.contacts, and reused by later syncs
+        """
+        if(self.stats is None):
+            self.stats = Stats()
+        else:
+            self.stats.reset()
+        retry = RetryPolicy(max_attempts=self.options.batch_retries + 1)
+        
+        # --api-root points all API requests at a stand-in server for testing
+        if(self.options.api_root):
+            self.sheets_discovery_url = self.options.api_root + "/sheets/$discovery/rest?version=v4"
+            self.contacts_feeds_url = self.options.api_root + "/m8/feeds"
+        else:
+            self.sheets_discovery_url = google_sheets.DISCOVERY_URL
+            self.contacts_feeds_url = google_contacts.FEEDS_URL
         
         #-----------------------------------------------------------------------
-        # Determine which credentials to use
+        # Fetch contact data from Google Sheets spreadsheet, or CSV file
+        # This runs in the background, while the existing contacts are fetched
         #-----------------------------------------------------------------------
-        credential_dir = os.path.join(os.path.expanduser('~'), '.credentials')
+        self.stats.phase("fetch")
+        if(self.sheets is None):
+            if(self.options.csv_path):
+                from py_modules.csv_source import CsvSource
+                self.sheets = CsvSource(self.options.csv_path, self.options.mapping_path)
+            else:
+                self.options.sheet_id = parse_sheet_id(self.options.sheet_id)
+                self.sheets = Sheets(credentials, self.options.sheet_id,
+                                     discovery_ttl=self.options.discovery_ttl * 3600,
+                                     discovery_url=self.sheets_discovery_url,
+                                     stats=self.stats, pool=self.pool)
+        S = self.sheets
         
-        if(self.options.email == None):
-            emails = []
-            for f in os.listdir(credential_dir):
-                m = re.search(r'sheets2contacts\.(.+)\.json', f)
-                if(m): emails.append(m.group(1))
-            
-            if(len(emails)):
-                print("Choose which email account to sync to:")
-                for i,e in enumerate(emails):
-                    print("  %d: %s" % (i+1,e))
-                print("  0: Authenticate New")
-                sel = int(raw_input('> '))
-                if(sel > 0 and sel <= len(emails)):
-                    self.options.email = emails[sel-1]
+        # Load the state of the last sync
+        state = None
+        if(self.options.email != None):
+            state = SyncState(S.source_id, self.options.email)
+            state.load()
         
-        if(self.options.email == None):
-            credential_file = None
+        if(self.options.csv_path):
+            self.log.info("Reading contact info from %s..." % self.options.csv_path)
         else:
-            credential_file = os.path.join(credential_dir, "sheets2contacts.%s.json" % self.options.email)
-            if(not os.path.exists(credential_file)): credential_file = None
+            self.log.info("Fetching contact info from Google Sheets spreadsheet...")
+        # Only the columns are fetched in the background. Turning them into
+        # people is left until it is known that the sheet needs to be synced
+        sheet_stage = Background(S.fetch_column_data, state and state.sheet_map)
         
-        credentials = g_auth.get_credentials(self.options, credential_file)
+        if(self.options.export_path):
+            sGroups, sPeople = S.elaborate_column_data(*sheet_stage.result())
+            self.log.info("Found %d contacts and %d groups" % (len(sPeople), len(sGroups)))
+            return(self.export(sGroups, sPeople, retry))
         
         #-----------------------------------------------------------------------
-        # Fetch contact data from Google Sheets spreadsheet
+        # Fetch contact data from Google Contacts (only ones in sheets2contacts
+        # group), unless neither the sheet nor the contacts changed since the
+        # last sync
         #-----------------------------------------------------------------------
-        self.log.info("Fetching contact info from Google Sheets spreadsheet...")
-        S = Sheets(credentials, self.options.sheet_id)
-        sGroups, sPeople = S.fetch_sheet_data()
+        contacts = self.fetch_contacts(credentials, state, sheet_stage)
+        if(contacts is None):
+            self.log.info("Nothing changed since the last sync")
+            self.stats.result["unchanged"] = True
+            self.save_stats()
+            return(self.stats.result)
+        sGroups, sPeople = S.elaborate_column_data(*sheet_stage.result())
         self.log.info("Found %d contacts and %d groups" % (len(sPeople), len(sGroups)))
+        C, cGroups, sheets2contacts_group, groups_to_create, cPeople = contacts
         
-        #-----------------------------------------------------------------------
-        # Fetch contact data from Google Contacts (only ones in sheets2contacts group)
-        #-----------------------------------------------------------------------
-        self.log.info("Fetching existing synced contacts from Google Contacts...")
-        groups_to_create = []
-        C = Contacts(credentials)
-        cGroups = C.fetch_groups()
-        sheets2contacts_group = cd.get_group_by_name(cGroups, "Synced with sheets2contacts")
-        if(sheets2contacts_group == None):
-            # "sheets2contacts" group doesn't exist. Create it
-            cPeople = []
-            sheets2contacts_group = cd.Group("Synced with sheets2contacts")
-            groups_to_create.append(sheets2contacts_group)
-            cGroups.append(sheets2contacts_group)
-        else:
-            cPeople = C.fetch_people(in_Group=sheets2contacts_group)
-            C.resolve_group_refs(cPeople, cGroups)
-        self.log.info("Found %d contacts and %d groups" % (len(cPeople), len(cGroups)))
         #-----------------------------------------------------------------------
         # Determine which groups need to be created
         #-----------------------------------------------------------------------
         new_groups = []
         for sG in sGroups:
-            for cG in cGroups:
-                if(sG.name == cG.name):
-                    break
-            else:
+            if(cGroups.get_by_name(sG.name) is None):
                 # Group was not found. Create a new one
                 self.log.debug("Need to create group: '%s'" % sG.name)
                 new_groups.append(sG)
@@ -118,11 +238,18 @@ class sheets2contacts(App):
         #-----------------------------------------------------------------------
         # Submit new groups to Google
         #-----------------------------------------------------------------------
+        self.stats.phase("create_groups")
         if(self.options.dry_run):
             self.log.info("Would create %d new groups..." % len(groups_to_create))
         else:
             self.log.info("Creating %d new groups..." % len(groups_to_create))
-            C.batch_create_groups(groups_to_create)
+            BR = C.batch_create_groups(groups_to_create, cGroups,
+                                       workers=self.options.batch_workers,
+                                       retry=retry)
+            if(BR.failed):
+                for G, code, reason in BR.failed:
+                    self.log.error("Unable to create group '%s': %s %s" % (G.name, code, reason))
+                sys.exit(1)
         
         for G in groups_to_create:
             self.log.debug("  %s" % G.name)
@@ -132,56 +259,36 @@ class sheets2contacts(App):
         # All people to be synced also need to be in the "sheets2contacts" group
         #  as well as the builtin "My Contacts" group
         #-----------------------------------------------------------------------
-        my_contacts_group = cd.get_group_by_name(cGroups, "System Group: My Contacts")
+        my_contacts_group = cGroups.get_by_name("System Group: My Contacts")
         for P in sPeople:
             new_groups = [my_contacts_group, sheets2contacts_group]
             for G in P.groups:
-                new_G = cd.get_group_by_name(cGroups, G.name)
+                new_G = cGroups.get_by_name(G.name)
                 if(new_G == None):
                     self.log.error("Something went wrong. Group should exist")
                     sys.exit(1)
                 new_groups.append(new_G)
             P.groups = new_groups
+            P.group_mask = cGroups.mask(new_groups)
         
         
         #-----------------------------------------------------------------------
         # Update contacts as necessary
+        # Any contacts that were not in the sheet get deleted
+        # Existing contacts are fetched in the background from the "fetch"
+        # phase on. This phase includes whatever is left of their fetch
         #-----------------------------------------------------------------------
-        contacts_to_update = []
-        contacts_to_create = []
-        
-        while(len(sPeople)):
-            P = sPeople.pop()
-            for cP in cPeople:
-                if((P.first_name == cP.first_name) and (P.last_name == cP.last_name)):
-                    # Found match! Update
-                    changed = cP.update(P)
-                    if(changed):
-                        self.log.debug("Need to update: '%s %s'" % (cP.first_name, cP.last_name))
-                        contacts_to_update.append(cP)
-                        
-                    
-                    # Contact was handled. remove
-                    cPeople.remove(cP)
-                    break
-            else:
-                # Person not found in existing contacts.
-                self.log.debug("Need to create: '%s %s'" % (P.first_name, P.last_name))
-                contacts_to_create.append(P)
-                
-        
-        #-----------------------------------------------------------------------
-        # Any contacts left over in cPeople are ones that were not in the sheet
-        # Delete them
-        #-----------------------------------------------------------------------
-        contacts_to_delete = cPeople
-        
-        for PD in contacts_to_delete:
-            self.log.debug("Need to delete: '%s %s'" % (PD.first_name, PD.last_name))
+        self.stats.phase("reconcile")
+        R = reconcile(sPeople, cPeople, use_hash=not self.options.full_diff, registry=cGroups)
+        self.log.info("Found %d contacts" % (R.matched + len(R.delete)))
+        contacts_to_create = R.create
+        contacts_to_update = R.update
+        contacts_to_delete = R.delete
         
         #-----------------------------------------------------------------------
         # Submit updates to Google
         #-----------------------------------------------------------------------
+        self.stats.phase("batch")
         if(self.options.dry_run):
             self.log.info("Would create %d, update %d, delete %d contacts ..." % (
                 len(contacts_to_create), len(contacts_to_update), len(contacts_to_delete)
@@ -191,13 +298,295 @@ class sheets2contacts(App):
                 len(contacts_to_create), len(contacts_to_update), len(contacts_to_delete)
             ))
             
-            C.batch_contacts_job(
+            BR = C.batch_contacts_job(
                 create=contacts_to_create,
                 update=contacts_to_update,
-                delete=contacts_to_delete
+                delete=contacts_to_delete,
+                workers=self.options.batch_workers,
+                retry=retry
             )
+            for (op, P), code, reason in BR.failed:
+                self.log.warning("Unable to %s contact '%s %s': %s %s" % (
+                    op, P.first_name, P.last_name, code, reason
+                ))
+            if(BR.failed):
+                self.log.error("%d contacts could not be synced" % len(BR.failed))
+            self.stats.result["failed"] = len(BR.failed)
+            self.stats.result["retries"] = BR.retries
+        
+        #-----------------------------------------------------------------------
+        # Save snapshot of the synced contacts for the next run
+        #-----------------------------------------------------------------------
+        self.stats.phase("save")
+        if(self.snapshot):
+            self.snapshot.save(C.feed_updated)
+        
+        #-----------------------------------------------------------------------
+        # Record the successful sync
+        # If anything failed, the next run must not skip the sync
+        #-----------------------------------------------------------------------
+        if(state and (not self.options.dry_run) and C.feed_updated
+            and (not self.stats.result.get("failed"))
+        ):
+            state.save(S.fingerprint, C.feed_updated, {
+                "created": len(contacts_to_create),
+                "updated": len(contacts_to_update),
+                "deleted": len(contacts_to_delete)
+            }, S.sheet_map)
+        
+        self.stats.result.update({
+            "created": len(contacts_to_create),
+            "updated": len(contacts_to_update),
+            "deleted": len(contacts_to_delete)
+        })
+        self.save_stats()
+        return(self.stats.result)
+    
+    #---------------------------------------------------------------------------
+    def fetch_contacts(self, credentials, state, sheet_stage):
+        """
+        Fetch the groups and synced people from Google Contacts, while the
+        sheet is fetched by the batch.Background sheet_stage.
+        
+        The people are fetched by a background thread as well. It starts as
+        soon as the groups are in, so their fetch carries on while the sheet
+        is fetched, groups are created and the sheet data is processed.
+        Returns (Contacts client, groups, "Synced with sheets2contacts" group,
+        groups to create, people), or None if neither the sheet nor the
+        contacts changed since the last sync
+        """
+        if(self.contacts is None):
+            self.contacts = Contacts(credentials,
+                                     keep_entries=self.options.keep_entries,
+                                     feeds_url=self.contacts_feeds_url,
+                                     stats=self.stats, pool=self.pool)
+        C = self.contacts
+        C.feed_updated = None
+        
+        # The contacts are checked first, so that nothing more than that is
+        # requested if the sheet did not change either
+        if(state and state.updated and (not self.options.force)
+            and (not C.has_changes_since(state.updated))
+        ):
+            sheet_stage.result()
+            if(state.fingerprint == self.sheets.fingerprint):
+                return(None)
+        
+        self.log.info("Fetching existing synced contacts from Google Contacts...")
+        groups_to_create = []
+        cGroups = C.fetch_groups()
+        sheets2contacts_group = cGroups.get_by_name("Synced with sheets2contacts")
+        if(sheets2contacts_group == None):
+            # "sheets2contacts" group doesn't exist. Create it
+            cPeople = []
+            self.snapshot = None
+            sheets2contacts_group = cd.Group("Synced with sheets2contacts")
+            groups_to_create.append(sheets2contacts_group)
+            cGroups.add(sheets2contacts_group)
+        else:
+            # The people are fetched while the groups are added to. Their
+            # groups are resolved against a copy, which existing contacts
+            # can only refer to anyway
+            # Buffer the pages being fetched, and a couple more
+            cPeople = prefetch(self.fetch_synced_people(C, sheets2contacts_group, cGroups.copy()),
+                               (self.options.fetch_workers + 2) * google_contacts.PAGE_SIZE)
+        self.log.info("Found %d groups" % len(cGroups))
+        
+        return(C, cGroups, sheets2contacts_group, groups_to_create, cPeople)
+    
+    #---------------------------------------------------------------------------
+    def export(self, sGroups, sPeople, retry):
+        """
+        Write the contacts from the sheet to the --export file, instead of
+        syncing them to Google Contacts
+        Returns the result, as recorded in self.stats.result
+        """
+        self.stats.phase("batch")
+        path = self.options.export_path
+        if(self.options.dry_run):
+            self.log.info("Would export %d contacts to %s..." % (len(sPeople), path))
+        else:
+            self.log.info("Exporting %d contacts to %s..." % (len(sPeople), path))
+            K = open_export_sink(path, self.options.export_format)
+            K.batch_create_groups(sGroups, retry=retry)
+            K.batch_contacts_job(create=sPeople, retry=retry)
+            K.close()
+        
+        self.stats.result["created"] = len(sPeople)
+        self.save_stats()
+        return(self.stats.result)
+    
+    #---------------------------------------------------------------------------
+    def watch(self, credentials):
+        """
+        Sync repeatedly until interrupted.
+        
+        Each check costs a single request for the sheet, and two small ones
+        for the contacts, unless something changed. The sheet data is only
+        turned into people if it changed. While nothing changes, the time
+        between checks doubles up to --max-poll-interval. It goes back to
+        --poll-interval as soon as a change is synced.
+        A sync that fails is logged, and tried again at the next check.
+        """
+        if(self.options.email == None):
+            # The account is needed to keep track of the last sync
+            self.options.email = People(credentials, pool=self.pool).get_email_address()
+        
+        interval = self.options.poll_interval
+        while(True):
+            try:
+                result = self.sync(credentials)
+            except KeyboardInterrupt:
+                raise
+            except SystemExit:
+                # The reason was logged before exiting, e.g. a heading that
+                # is missing from the sheet. It may be fixed by the next check
+                self.log.error("Sync aborted")
+                result = None
+            except Exception:
+                self.log.exception("Sync failed")
+                result = None
+            
+            # --force only applies to the first sync
+            self.options.force = False
+            
+            changed = result and not result.get("unchanged")
+            if(changed):
+                interval = self.options.poll_interval
+            
+            self.log.debug("Checking for changes again in %d seconds" % interval)
+            try:
+                time.sleep(interval)
+            except KeyboardInterrupt:
+                return
+            
+            if(not changed):
+                interval = min(interval * 2, self.options.max_poll_interval)
+    
+    #---------------------------------------------------------------------------
+    def save_stats(self):
+        """
+        End the last phase and write the --stats report, if requested
+        """
+        self.stats.finish()
+        self.stats.transport = self.pool.get_stats()
+        self.stats.log_summary()
+        if(self.options.stats_path):
+            self.stats.save(self.options.stats_path)
+    
+    #---------------------------------------------------------------------------
+    def get_credentials(self):
+        """
+        Determine which credentials to use
+        Asks which stored credentials to use if --email was not given
+        """
+        credential_dir = os.path.join(os.path.expanduser('~'), '.credentials')
+        
+        if(self.options.email == None):
+            emails = []
+            for f in os.listdir(credential_dir):
+                m = re.search(r'sheets2contacts\.(.+)\.json', f)
+                if(m): emails.append(m.group(1))
+            
+            if(len(emails)):
+                print("Choose which email account to sync to:")
+                for i,e in enumerate(emails):
+                    print("  %d: %s" % (i+1,e))
+                print("  0: Authenticate New")
+                sel = int(raw_input('> '))
+                if(sel > 0 and sel <= len(emails)):
+                    self.options.email = emails[sel-1]
+        
+        if(self.options.email == None):
+            credential_file = None
+        else:
+            credential_file = os.path.join(credential_dir, "sheets2contacts.%s.json" % self.options.email)
+            if(not os.path.exists(credential_file)): credential_file = None
+        
+        return(g_auth.get_credentials(self.options, credential_file))
+    
+    #---------------------------------------------------------------------------
+    def fetch_synced_people(self, C, sheets2contacts_group, cGroups):
+        """
+        Get the people in the "sheets2contacts" group.
+        
+        If a recent snapshot from the last run exists, only the contacts that
+        changed since then are fetched and merged into it. Otherwise all synced
+        contacts are fetched, and a new snapshot is recorded as they stream by.
+        
+        Sets self.snapshot to the snapshot that should be saved after syncing
+        """
+        self.snapshot = None
+        if(self.options.email == None):
+            # Don't know which account this is yet
+            return(C.iter_people(
+                in_Group=sheets2contacts_group,
+                Groups=cGroups,
+                workers=self.options.fetch_workers
+            ))
+        
+        self.snapshot = Snapshot(self.options.email)
+        group_id = sheets2contacts_group.entry.id.text
+        max_age = self.options.snapshot_max_age * 3600
+        if((not self.options.full_refresh) and self.snapshot.load(group_id, max_age)):
+            self.log.info("Fetching contacts changed since %s..." % self.snapshot.updated)
+            try:
+                n_changes = self.snapshot.apply_changes(C.iter_people(
+                    updated_min=self.snapshot.updated,
+                    workers=self.options.fetch_workers
+                ))
+                self.log.info("Found %d changed contacts" % n_changes)
+                return(self.snapshot.iter_people(cGroups))
+            except ChangesUnavailable:
+                self.log.info("Changes since last run are unavailable. Fetching all contacts...")
+        
+        # Contacts are streamed from the feed during reconciliation
+        self.snapshot.clear(group_id)
+        return(self.snapshot.record_people(C.iter_people(
+            in_Group=sheets2contacts_group,
+            Groups=cGroups,
+            workers=self.options.fetch_workers
+        )))
         
         
+#===============================================================================
+def get_export_format(path):
+    """
+    Guess the --export-format of a file from its extension
+    Returns None if it is not known
+    """
+    if(path == "-"):
+        # stdout has no extension. vCard 3.0 is the most widely supported
+        return("vcard3")
+    ext = os.path.splitext(path)[1].lower()
+    return(EXPORT_EXTENSIONS.get(ext))
+
+def open_export_sink(path, export_format):
+    """
+    Open the ContactSink that exports to path in export_format
+    """
+    # Only import the sink that is needed
+    if(export_format == "vcard3"):
+        from py_modules.vcard_sink import VCardSink
+        return(VCardSink(path, "3.0"))
+    elif(export_format == "vcard4"):
+        from py_modules.vcard_sink import VCardSink
+        return(VCardSink(path, "4.0"))
+    else:
+        from py_modules.csv_sink import CsvSink
+        return(CsvSink(path))
+
+def parse_sheet_id(sheet_id):
+    """
+    Get the sheet ID from a Google Sheets URL
+    IDs that are not a URL are returned as-is
+    """
+    m = re.search(r'docs.google.com\/spreadsheets\/d\/([^\/]+)\/', sheet_id)
+    if(m):
+        # Sheet ID is a URL. Extract
+        return(m.group(1))
+    return(sheet_id)
+
 ################################################################################
 if __name__ == '__main__':
     A = sheets2contacts()
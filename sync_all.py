@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+import sys
+import copy
+import json
+import time
+import logging
+import argparse
+import threading
+
+from py_modules.app import App
+import py_modules.google_auth as g_auth
+from py_modules.batch import parallel_map
+from py_modules.transport import HttpPool
+from sheets2contacts import sheets2contacts
+
+class sync_all(App):
+    """
+    Runs several sheets2contacts syncs, as listed in a config file.
+    
+    The config file is JSON:
+        {
+            "workers": 4,
+            "options": {"batch_workers": 4},
+            "jobs": [
+                {"sheet": "<sheet ID or URL>", "email": "a@example.com"},
+                {"name": "club", "sheet": "...", "email": "b@example.com",
+                 "options": {"dry_run": true}},
+                {"csv": "roster.csv", "mapping": "mapping.csv",
+                 "email": "c@example.com"}
+            ]
+        }
+    
+    Jobs give either a sheet, or a CSV file and its mapping file.
+    
+    Only one job can sync into each account, as a sync deletes any contacts
+    in the "Synced with sheets2contacts" group that are not in its sheet.
+    Jobs that --export instead are not limited.
+    
+    "options" are sheets2contacts options, by their destination name. Options
+    given for a job override the ones given for all jobs.
+    """
+    def set_cmdline_args(self, parser):
+        App.set_cmdline_args(self, parser)
+        parser.description = "Run several sheets2contacts syncs listed in a config file"
+        
+        parser.add_argument('config', help='JSON file listing the syncs to run')
+        parser.add_argument('-j', '--workers', dest='workers', default=None,
+                            type=int,
+                            help='Number of syncs to run concurrently. Overrides the config file')
+        parser.add_argument('-n', '--dry-run', dest='dry_run', default=False,
+                            action="store_true",
+                            help='Do not change any contacts')
+        parser.add_argument('--summary', dest='summary_path', default=None,
+                            help='Write the results of all syncs to this JSON file')
+    
+    #---------------------------------------------------------------------------
+    def main(self):
+        App.main(self)
+        
+        logging.getLogger("googleapiclient.discovery").setLevel(logging.WARNING)
+        
+        config = self.load_config(self.options.config)
+        workers = self.options.workers or config.get("workers", 1)
+        
+        # Credentials are loaded once per account and shared by its jobs.
+        # Jobs for the same account share its cache, so they run one at a
+        # time
+        self.credentials = {}
+        self.account_locks = {}
+        for job in config["jobs"]:
+            if(job["email"] not in self.credentials):
+                self.credentials[job["email"]] = g_auth.get_stored_credentials(job["email"])
+                self.account_locks[job["email"]] = threading.Lock()
+        
+        # All syncs share one pool of keep-alive connections
+        self.pool = HttpPool()
+        
+        self.log.info("Running %d syncs, %d at a time..." % (len(config["jobs"]), workers))
+        results = parallel_map(self.run_job, config["jobs"], workers)
+        
+        self.print_summary(results)
+        if(self.options.summary_path):
+            with open(self.options.summary_path, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        
+        n_failed = len([r for r in results if r["status"] == "failed"])
+        if(n_failed):
+            self.log.error("%d of %d syncs failed" % (n_failed, len(results)))
+            sys.exit(1)
+    
+    #---------------------------------------------------------------------------
+    def load_config(self, path):
+        """
+        Load and validate the config file
+        Each job gets a complete set of sheets2contacts options in job["options"]
+        """
+        try:
+            with open(path, 'r') as f:
+                config = json.load(f)
+        except (IOError, ValueError) as e:
+            self.log.error("Could not read config file %s: %s" % (path, e))
+            sys.exit(1)
+        
+        # Get the default sheets2contacts options
+        parser = argparse.ArgumentParser()
+        sheets2contacts().set_cmdline_args(parser)
+        defaults = parser.parse_args([])
+        
+        common_options = config.get("options", {})
+        synced_emails = {}
+        for i, job in enumerate(config.get("jobs", [])):
+            if((("sheet" not in job) and ("csv" not in job)) or ("email" not in job)):
+                self.log.error("Job %d needs a sheet or csv, and an email" % (i+1))
+                sys.exit(1)
+            if(("csv" in job) and ("mapping" not in job)):
+                self.log.error("Job %d needs a mapping for its csv" % (i+1))
+                sys.exit(1)
+            job.setdefault("name", "%s:%s" % (job["email"], (job.get("sheet") or job["csv"])[-12:]))
+            
+            options = copy.copy(defaults)
+            for k, v in list(common_options.items()) + list(job.get("options", {}).items()):
+                if(not hasattr(options, k)):
+                    self.log.error("Job '%s': Unknown option '%s'" % (job["name"], k))
+                    sys.exit(1)
+                setattr(options, k, v)
+            # -n wins over the config file
+            if(self.options.dry_run):
+                options.dry_run = True
+            options.sheet_id = job.get("sheet")
+            options.csv_path = job.get("csv")
+            options.mapping_path = job.get("mapping")
+            options.email = job["email"]
+            job["options"] = options
+            
+            # Jobs for the same account would delete each other's contacts
+            if(not options.export_path):
+                if(job["email"] in synced_emails):
+                    self.log.error("Jobs '%s' and '%s' both sync into %s. Only one job can sync into each account" % (
+                        synced_emails[job["email"]], job["name"], job["email"]))
+                    sys.exit(1)
+                synced_emails[job["email"]] = job["name"]
+        
+        if(not config.get("jobs")):
+            self.log.error("No jobs in config file %s" % path)
+            sys.exit(1)
+        return(config)
+    
+    #---------------------------------------------------------------------------
+    def run_job(self, job):
+        """
+        Run a single sync
+        Returns a dict describing the outcome
+        """
+        summary = {
+            "name": job["name"],
+            "sheet": job.get("sheet") or job["csv"],
+            "email": job["email"],
+            "status": "failed",
+            "result": None,
+            "error": None,
+            "seconds": 0.0
+        }
+        
+        credentials = self.credentials[job["email"]]
+        if(credentials is None):
+            summary["error"] = "No valid stored credentials. Run sheets2contacts.py --email %s first" % job["email"]
+            self.log.error("%s: %s" % (job["name"], summary["error"]))
+            return(summary)
+        
+        A = sheets2contacts()
+        A.options = job["options"]
+        A.pool = self.pool
+        A.log = logging.getLogger("%s.%s" % (self.log.name, job["name"]))
+        
+        with self.account_locks[job["email"]]:
+            t_start = time.time()
+            try:
+                result = A.sync(credentials)
+                summary["result"] = result
+                if(result.get("failed")):
+                    summary["error"] = "%d contacts could not be synced" % result["failed"]
+                elif(result.get("unchanged")):
+                    summary["status"] = "unchanged"
+                else:
+                    summary["status"] = "ok"
+            except SystemExit:
+                summary["error"] = "Sync aborted"
+            except Exception as e:
+                A.log.exception("Sync failed")
+                summary["error"] = "%s: %s" % (e.__class__.__name__, e)
+            summary["seconds"] = time.time() - t_start
+        return(summary)
+    
+    #---------------------------------------------------------------------------
+    def print_summary(self, results):
+        print("%-40s %-9s %7s %7s %7s %8s" % ("Job", "Status", "Created", "Updated", "Deleted", "Seconds"))
+        for r in results:
+            counts = r["result"] or {}
+            print("%-40s %-9s %7s %7s %7s %8.1f" % (
+                r["name"][:40], r["status"],
+                counts.get("created", "-"),
+                counts.get("updated", "-"),
+                counts.get("deleted", "-"),
+                r["seconds"]
+            ))
+            if(r["error"]):
+                print("    %s" % r["error"])
+
+################################################################################
+if __name__ == '__main__':
+    A = sync_all()
+    A.main()